@@ -0,0 +1,408 @@
+"""
+Benchmarks every stage of HydraNet on synthetic brain-like phantoms, writing the timings to JSON
+"""
+
+import argparse
+import os
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'  # Suppress TensorFlow logging (1)
+import sys
+import json
+import time
+import shutil
+import socket
+import platform
+import datetime
+import tempfile
+import subprocess
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.models import load_model
+from skimage.metrics import peak_signal_noise_ratio, structural_similarity
+from typing import List, Dict, Tuple
+from utilities import image_utils, model_functions, phantoms, pyramid_cache
+from utilities.denoiser import HydraNetDenoiser, SimilarityRouter, NOISE_CATEGORIES
+from utilities.patch_dataset import PatchDataset
+
+# The directory of this script
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Every benchmarked stage, in the order that they run
+STAGES = ['patch_generation', 'reference_bank_build', 'routing', 'single_inference', 'routed_inference', 'cleanup',
+          'evaluation']
+
+
+def parse_args():
+    """
+    Parses Command Line arguments
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='8x128x128,16x192x192', type=str,
+                        help='comma-separated phantom volume sizes to benchmark, each as <slices>x<height>x<width>')
+    parser.add_argument('--stages', default=','.join(STAGES), type=str,
+                        help=f'comma-separated stages to benchmark, out of {",".join(STAGES)}')
+    parser.add_argument('--output', default='benchmark.json', type=str, help='path of the JSON results')
+    parser.add_argument('--baseline', default=None, type=str,
+                        help='optional JSON results of an earlier run (e.g. another commit) to compare against')
+    parser.add_argument('--max_slowdown', default=1.25, type=float,
+                        help='exit with an error if a stage is more than this many times slower than the baseline')
+    parser.add_argument('--repeats', default=3, type=int, help='number of timed runs of each stage')
+    parser.add_argument('--warmup', default=1, type=int, help='number of untimed runs of each inference stage')
+    parser.add_argument('--psnr_low', default=15, type=float, help='lowest PSNR in dB of the noisy phantom slices')
+    parser.add_argument('--psnr_high', default=45, type=float, help='highest PSNR in dB of the noisy phantom slices')
+    parser.add_argument('--seed', default=0, type=int, help='seed of the phantoms and of the model weights')
+    parser.add_argument('--model_depth', default=17, type=int, help='depth of the (untrained) benchmarked models')
+    parser.add_argument('--model_filters', default=64, type=int,
+                        help='number of filters of the (untrained) benchmarked models')
+    parser.add_argument('--backend', default='keras', type=str, choices=['keras', 'tf_function'],
+                        help="backend of the denoisers, 'keras' or 'tf_function'")
+    parser.add_argument('--batch_size', default=128, type=int, help='number of patches sent through a model at once')
+    parser.add_argument('--skip_every', default=3, type=int, help='keep every skip_every-th reference patch')
+    parser.add_argument('--work_dir', default=None, type=str,
+                        help='directory of the phantoms and models. If not given, a temporary directory is used')
+    parser.add_argument('--keep_work_dir', default=0, type=int,
+                        help='keep the phantoms and models after the benchmark, 1 for yes or 0 for no')
+    return parser.parse_args()
+
+
+def parse_size(size: str) -> Tuple[int, int, int]:
+    """ Parses a '<slices>x<height>x<width>' volume size """
+    try:
+        depth, height, width = (int(dimension) for dimension in size.lower().split('x'))
+    except ValueError:
+        sys.exit(f"ERROR: '{size}' is not a volume size of the form <slices>x<height>x<width>")
+    return depth, height, width
+
+
+def get_git_commit() -> str:
+    """ Gets the commit of the checked out code, or None if it isn't in a git repository """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=SCRIPTS_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_environment() -> Dict:
+    """ Gets a description of the machine and the library versions, to tell whether two runs are comparable """
+    return {
+        'hostname': socket.gethostname(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'tensorflow': tf.__version__,
+        'gpus': [device.name for device in tf.config.list_physical_devices('GPU')]
+    }
+
+
+def save_untrained_models(model_root: str, depth: int, filters: int, seed: int) -> Dict[str, str]:
+    """
+    Saves a randomly initialized MyDnCNN as model_001.hdf5 for each model that the benchmark runs. Untrained weights
+    denoise badly, but take exactly as long to run as trained ones
+
+    Parameters
+    ----------
+    model_root: The directory in which to save each model's directory
+    depth: The depth of each model
+    filters: The number of filters of each model
+    seed: The seed of the model weights
+
+    Returns
+    -------
+    A dictionary mapping 'all', 'low', 'medium', 'high', and 'cleanup' to the directory of that model
+    """
+    model_dirs = {}
+    for n, name in enumerate(['all'] + NOISE_CATEGORIES + ['cleanup']):
+        tf.random.set_seed(seed + n)
+        model_dirs[name] = os.path.join(model_root, name)
+        os.makedirs(model_dirs[name], exist_ok=True)
+        model_functions.MyDnCNN(depth=depth, filters=filters).save(os.path.join(model_dirs[name], 'model_001.hdf5'))
+    return model_dirs
+
+
+def load_volume(root_dir: str, image_dir: str) -> np.ndarray:
+    """ Loads a phantom's slices from <root_dir>/<image_dir> as a (slices, height, width) volume """
+    return image_utils.get_3d_image_volume(os.path.join(root_dir, image_dir))
+
+
+def time_stage(function, repeats: int, warmup: int = 0, before=None):
+    """
+    Times a stage
+
+    Parameters
+    ----------
+    function: The stage, a function without arguments
+    repeats: The number of timed runs
+    warmup: The number of untimed runs first, e.g. to trace and compile the models
+    before: An optional function run (untimed) before each run, e.g. to clear a cache
+
+    Returns
+    -------
+    (seconds, result): The seconds of each timed run, and the result of the last run
+    """
+    result = None
+    seconds = []
+    for n in range(warmup + repeats):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        result = function()
+        if n >= warmup:
+            seconds.append(time.perf_counter() - start)
+    return seconds, result
+
+
+def summarize(seconds: List[float], items: int, unit: str) -> Dict:
+    """ Summarizes the timed runs of a stage that processed items of a unit (e.g. 64 'slices') in each run """
+    median_seconds = float(np.median(seconds))
+    return {
+        'seconds': [round(run_seconds, 6) for run_seconds in seconds],
+        'median_seconds': round(median_seconds, 6),
+        'min_seconds': round(min(seconds), 6),
+        'items': items,
+        'unit': unit,
+        'items_per_second': round(items / median_seconds, 3) if median_seconds > 0 else None
+    }
+
+
+def cleanup_volume(model, volume: np.ndarray) -> np.ndarray:
+    """ Runs the cleanup model on every whole patch-denoised slice, as inference.cleanup does """
+    cleaned_slices = []
+    for image in volume:
+        y, y_orig_mean, y_orig_std = image_utils.standardize(image)
+        x_pred = np.squeeze(model.predict(image_utils.to_tensor(y), verbose=0))
+        x_pred = image_utils.reverse_standardize(x_pred, original_mean=y_orig_mean, original_std=y_orig_std)
+        cleaned_slices.append(np.clip(x_pred, 0, 255).astype('uint8'))
+    return np.stack(cleaned_slices)
+
+
+def evaluate(clear_volume: np.ndarray, volume: np.ndarray) -> Tuple[float, float]:
+    """ Gets the average PSNR and SSIM of every slice of a volume against the clear volume """
+    psnrs = [peak_signal_noise_ratio(clear, image) for clear, image in zip(clear_volume, volume)]
+    ssims = [structural_similarity(clear, image) for clear, image in zip(clear_volume, volume)]
+    return float(np.mean(psnrs)), float(np.mean(ssims))
+
+
+def get_route_patches(volume: np.ndarray, mask_volume: np.ndarray, patch_size: int = 40,
+                      stride: int = 30) -> List[np.ndarray]:
+    """ Gets the foreground patches that a routed HydraNetDenoiser would route, with its default tiling """
+    patches = []
+    for image, mask in zip(volume, mask_volume):
+        height, width = image.shape
+        for i in range(0, height - patch_size + 1, stride):
+            for j in range(0, width - patch_size + 1, stride):
+                if np.max(mask[i:i + patch_size, j:j + patch_size]) > 0:
+                    patches.append(image[i:i + patch_size, j:j + patch_size, np.newaxis])
+    return patches
+
+
+def benchmark_size(args, shape: Tuple[int, int, int], stages: List[str], model_dirs: Dict[str, str],
+                   phantom_dir: str) -> Dict:
+    """
+    Benchmarks the chosen stages on a training phantom and a test phantom of one volume size
+
+    Parameters
+    ----------
+    args: The command-line arguments
+    shape: The (slices, height, width) of the phantoms
+    stages: The stages to benchmark
+    model_dirs: The model directories, from save_untrained_models
+    phantom_dir: The directory in which to write the phantoms
+
+    Returns
+    -------
+    A dictionary of the size's results, with a summary of each stage
+    """
+    # Write a training phantom (the reference bank and patch dataset) and a different test phantom
+    train_dir = os.path.join(phantom_dir, 'train')
+    test_dir = os.path.join(phantom_dir, 'test')
+    psnr_range = (args.psnr_low, args.psnr_high)
+    phantoms.write_phantom_subject(train_dir, shape, psnr_range=psnr_range, seed=args.seed)
+    test_psnrs = phantoms.write_phantom_subject(test_dir, shape, psnr_range=psnr_range, seed=args.seed + 1)
+    clear_volume = load_volume(test_dir, 'ClearImages')
+    blurry_volume = load_volume(test_dir, 'CoregisteredBlurryImages')
+    mask_volume = load_volume(test_dir, 'Masks')
+
+    def clear_pyramid_cache():
+        # Time patch generation from the PNGs, rather than from the pyramid levels cached by the previous run
+        shutil.rmtree(os.path.join(train_dir, pyramid_cache.PYRAMID_DIR_NAME), ignore_errors=True)
+
+    results = {'shape': list(shape), 'target_psnrs': [round(psnr, 2) for psnr in test_psnrs], 'stages': {}}
+    num_slices = shape[0]
+
+    if 'patch_generation' in stages:
+        seconds, dataset = time_stage(lambda: PatchDataset.from_train_data([train_dir]), args.repeats,
+                                      before=clear_pyramid_cache)
+        results['stages']['patch_generation'] = summarize(seconds, len(dataset), 'patches')
+        del dataset
+
+    # Routing and routed inference need a reference bank, even if its build isn't benchmarked
+    router = None
+    if any(stage in stages for stage in ('reference_bank_build', 'routing', 'routed_inference')):
+        seconds, router = time_stage(lambda: SimilarityRouter.from_train_data([train_dir],
+                                                                              skip_every=args.skip_every),
+                                     args.repeats if 'reference_bank_build' in stages else 1,
+                                     before=clear_pyramid_cache)
+        if 'reference_bank_build' in stages:
+            num_reference_patches = sum(len(router.training_patches[category + '_noise']['y'])
+                                        for category in NOISE_CATEGORIES)
+            results['stages']['reference_bank_build'] = summarize(seconds, num_reference_patches, 'patches')
+
+    if 'routing' in stages:
+        patches = get_route_patches(blurry_volume, mask_volume)
+        seconds, _ = time_stage(lambda: [router.route(patch) for patch in patches], args.repeats)
+        results['stages']['routing'] = summarize(seconds, len(patches), 'patches')
+
+    denoised_volume = None
+    if any(stage in stages for stage in ('single_inference', 'cleanup', 'evaluation')):
+        denoiser = HydraNetDenoiser({'all': model_dirs['all']}, backend=args.backend, batch_size=args.batch_size)
+        seconds, denoised_volume = time_stage(lambda: denoiser.denoise_volume(blurry_volume, mask_volume),
+                                              args.repeats if 'single_inference' in stages else 1,
+                                              warmup=args.warmup if 'single_inference' in stages else 0)
+        if 'single_inference' in stages:
+            results['stages']['single_inference'] = summarize(seconds, num_slices, 'slices')
+
+    routed_volume = None
+    if 'routed_inference' in stages:
+        routed_denoiser = HydraNetDenoiser({category: model_dirs[category] for category in NOISE_CATEGORIES},
+                                           router=router, backend=args.backend, batch_size=args.batch_size)
+        seconds, routed_volume = time_stage(lambda: routed_denoiser.denoise_volume(blurry_volume, mask_volume),
+                                            args.repeats, warmup=args.warmup)
+        results['stages']['routed_inference'] = summarize(seconds, num_slices, 'slices')
+
+        # Break the routed inference down into the denoiser's own stages, per timed run
+        breakdown = routed_denoiser.instrumentation.snapshot()
+        runs = args.warmup + args.repeats
+        results['routed_inference_breakdown'] = {
+            'seconds_per_run': {path: round(timing['seconds'] / runs, 6)
+                                for path, timing in breakdown['timings'].items()},
+            'patches_per_run': {category: count // runs
+                                for category, count in routed_denoiser.patches_per_category.items()}
+        }
+
+    cleaned_volume = None
+    if 'cleanup' in stages:
+        cleanup_model = load_model(os.path.join(model_dirs['cleanup'], 'model_001.hdf5'), compile=False)
+        seconds, cleaned_volume = time_stage(lambda: cleanup_volume(cleanup_model, denoised_volume), args.repeats,
+                                             warmup=args.warmup)
+        results['stages']['cleanup'] = summarize(seconds, num_slices, 'slices')
+
+    if 'evaluation' in stages:
+        seconds, _ = time_stage(lambda: evaluate(clear_volume, denoised_volume), args.repeats)
+        results['stages']['evaluation'] = summarize(seconds, num_slices, 'slices')
+
+        # Record the quality of every output too. With untrained models it is meaningless as a result, but a change
+        # in it between two runs with the same settings means that a stage's output changed
+        results['quality'] = {}
+        for name, volume in [('blurry', blurry_volume), ('single', denoised_volume), ('routed', routed_volume),
+                             ('cleanup', cleaned_volume)]:
+            if volume is not None:
+                psnr, ssim = evaluate(clear_volume, volume)
+                results['quality'][name] = {'psnr': round(psnr, 4), 'ssim': round(ssim, 6)}
+
+    return results
+
+
+def compare_to_baseline(results: Dict, baseline: Dict, max_slowdown: float) -> List[str]:
+    """
+    Compares the median time of every stage of every volume size with a baseline run, printing a table
+
+    Parameters
+    ----------
+    results: The results of this run
+    baseline: The results of the baseline run
+    max_slowdown: The ratio of this run's median time to the baseline's above which a stage has regressed
+
+    Returns
+    -------
+    A description of every stage that regressed
+    """
+    baseline_sizes = {tuple(size['shape']): size for size in baseline['sizes']}
+    regressions = []
+    print(f'\nCompared with the baseline at commit {baseline.get("commit")}:')
+    print('%-14s %-22s %12s %12s %8s' % ('size', 'stage', 'baseline (s)', 'this run (s)', 'ratio'))
+    for size in results['sizes']:
+        shape = tuple(size['shape'])
+        if shape not in baseline_sizes:
+            continue
+        size_name = 'x'.join(str(dimension) for dimension in shape)
+        for stage, summary in size['stages'].items():
+            baseline_summary = baseline_sizes[shape]['stages'].get(stage)
+            if baseline_summary is None or baseline_summary['median_seconds'] <= 0:
+                continue
+            ratio = summary['median_seconds'] / baseline_summary['median_seconds']
+            print('%-14s %-22s %12.4f %12.4f %8.2f' % (size_name, stage, baseline_summary['median_seconds'],
+                                                       summary['median_seconds'], ratio))
+            if ratio > max_slowdown:
+                regressions.append(f'{stage} at {size_name} is {ratio:.2f}x slower')
+    return regressions
+
+
+def main(args) -> Dict:
+    """
+    Runs the benchmark of every volume size and writes the results to args.output
+
+    :param args: The command-line arguments
+
+    :return: The results
+    """
+    stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()]
+    unknown_stages = [stage for stage in stages if stage not in STAGES]
+    if unknown_stages:
+        sys.exit(f'ERROR: unknown stages {unknown_stages}, choose from {STAGES}')
+    if 'cleanup' in stages or 'evaluation' in stages:
+        # Both run on the output of single_inference
+        stages = sorted(set(stages) | {'single_inference'}, key=STAGES.index)
+    shapes = [parse_size(size) for size in args.sizes.split(',')]
+
+    work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix='hydranet_benchmark_')
+    os.makedirs(work_dir, exist_ok=True)
+
+    results = {
+        'commit': get_git_commit(),
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'environment': get_environment(),
+        'settings': vars(args),
+        'sizes': []
+    }
+    try:
+        model_dirs = save_untrained_models(os.path.join(work_dir, 'models'), depth=args.model_depth,
+                                           filters=args.model_filters, seed=args.seed)
+        for shape in shapes:
+            size_name = 'x'.join(str(dimension) for dimension in shape)
+            print(f'\nBenchmarking {", ".join(stages)} on {size_name} phantoms')
+            results['sizes'].append(benchmark_size(args, shape, stages, model_dirs,
+                                                   os.path.join(work_dir, size_name)))
+            for stage, summary in results['sizes'][-1]['stages'].items():
+                print('%-22s %10.4f s (median of %d), %10.1f %s/s' % (stage, summary['median_seconds'],
+                                                                     len(summary['seconds']),
+                                                                     summary['items_per_second'] or 0,
+                                                                     summary['unit']))
+    finally:
+        if args.work_dir is None and not args.keep_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f'\nWrote the benchmark results to {args.output}')
+    return results
+
+
+if __name__ == '__main__':
+
+    # Get command-line arguments
+    args = parse_args()
+
+    # Run the benchmark
+    results = main(args)
+
+    # Compare with the baseline run, if any, and exit with an error if a stage regressed
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare_to_baseline(results, baseline, args.max_slowdown)
+        if regressions:
+            sys.exit(f'ERROR: {len(regressions)} stages regressed by more than {args.max_slowdown}x: {regressions}')
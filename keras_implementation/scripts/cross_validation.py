@@ -0,0 +1,167 @@
+"""
+Runs a whole leave-one-subject-out cross-validation of HydraNet as a DAG of cached, parallel jobs
+"""
+
+import argparse
+import os
+import sys
+import numpy as np
+from typing import List
+from utilities import data_generator, pyramid_cache
+from utilities.job_dag import Job, JobDAG
+
+# The directory of this script (and of train.py and inference.py)
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_args():
+    """
+    Parses Command Line arguments
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', default='data', type=str, help='directory housing the data of every subject')
+    parser.add_argument('--subjects', action='append', default=[], type=str,
+                        help='subjects to cross-validate over (repeat for each). Defaults to subj1 through subj6')
+    parser.add_argument('--noise_levels', default='low,medium,high', type=str,
+                        help="comma-separated noise-level experts to train per fold, or 'all' for a single denoiser")
+    parser.add_argument('--model_root', default='psnr_models', type=str,
+                        help='directory in which the models of each fold are saved, as AllBut<subject>Trained')
+    parser.add_argument('--result_root', default='psnr_results', type=str,
+                        help='directory in which the results of each fold are saved, as <subject>_results')
+    parser.add_argument('--epoch', default=80, type=int, help='number of train epochs of each model')
+    parser.add_argument('--state_dir', default='cross_validation_state', type=str,
+                        help='directory of the completion records and logs of every job')
+    parser.add_argument('--max_cpus', default=0, type=int,
+                        help='total number of CPU cores that running jobs may use. If 0, every core')
+    parser.add_argument('--max_memory_mb', default=0, type=float,
+                        help='total memory in MB that running jobs may use. If 0, there is no memory budget')
+    parser.add_argument('--train_cpus', default=4, type=int, help='number of CPU cores of each train job')
+    parser.add_argument('--train_memory_mb', default=8192, type=float, help='peak memory in MB of each train job')
+    parser.add_argument('--infer_cpus', default=2, type=int, help='number of CPU cores of each inference job')
+    parser.add_argument('--infer_memory_mb', default=4096, type=float,
+                        help='peak memory in MB of each inference job')
+    parser.add_argument('--dry_run', default=0, type=int,
+                        help='only print the jobs that would run, 1 for yes or 0 for no')
+    return parser.parse_args()
+
+
+def get_image_dirs(root_dir: str) -> List[str]:
+    """ Gets the image directories of a data directory, which are the inputs of the jobs that read it """
+    return [os.path.join(root_dir, 'ClearImages'), os.path.join(root_dir, 'CoregisteredBlurryImages')]
+
+
+def build_data(train_dir: str) -> None:
+    """
+    Builds the cached pyramid levels and the statistics of a subject's training data, so that every train job of
+    every fold only loads them
+
+    :param train_dir: The training data directory of the subject
+
+    :return: None
+    """
+    pyramid_cache.build_pyramids([train_dir])
+    data_generator.get_subject_statistics(train_dir)
+
+
+def evaluate(result_dirs: List[str], summary_path: str) -> None:
+    """
+    Summarizes the average PSNR and SSIM of every fold, as saved in its results.txt by inference.py
+
+    :param result_dirs: The result directory of each fold, in order
+    :param summary_path: The path of the summary CSV file to write
+
+    :return: None
+    """
+    rows = []
+    for result_dir in result_dirs:
+        # results.txt holds the PSNRs then the SSIMs of every image, each followed by their average
+        results = np.loadtxt(os.path.join(result_dir, 'results.txt'))
+        psnrs, ssims = np.split(results, 2)
+        rows.append((os.path.basename(os.path.normpath(result_dir)), psnrs[-1], ssims[-1]))
+
+    with open(summary_path, 'w') as file:
+        file.write('fold,psnr,ssim\n')
+        for fold, psnr, ssim in rows:
+            file.write(f'{fold},{psnr:.4f},{ssim:.4f}\n')
+        file.write(f'mean,{np.mean([row[1] for row in rows]):.4f},{np.mean([row[2] for row in rows]):.4f}\n')
+    print(f'Saved the cross-validation summary to {summary_path}')
+
+
+def build_dag(args) -> JobDAG:
+    """
+    Expresses every fold of the cross-validation as jobs: building each subject's data once, training each expert of
+    each fold, running inference on each fold's held-out subject, and finally evaluating every fold
+
+    :param args: The parsed command-line arguments
+
+    :return: A JobDAG
+    """
+    subjects = args.subjects if args.subjects else [f'subj{i}' for i in range(1, 7)]
+    noise_levels = args.noise_levels.split(',')
+    single_denoiser = noise_levels == ['all']
+    dag = JobDAG(args.state_dir, max_cpus=args.max_cpus if args.max_cpus > 0 else None,
+                 max_memory_mb=args.max_memory_mb if args.max_memory_mb > 0 else None)
+
+    # Build the data of every subject once, as it is shared by the folds that train on it
+    for subject in subjects:
+        train_dir = os.path.join(args.data_dir, subject, 'train')
+        dag.add(Job(f'build_data_{subject}', function=lambda train_dir=train_dir: build_data(train_dir),
+                    inputs=get_image_dirs(train_dir), config={'train_dir': train_dir},
+                    outputs=[os.path.join(train_dir, 'statistics.json')], cpus=2, memory_mb=2048))
+
+    result_dirs = []
+    for index, subject in enumerate(subjects):
+        train_subjects = [train_subject for train_subject in subjects if train_subject != subject]
+        train_dirs = [os.path.join(args.data_dir, train_subject, 'train') for train_subject in train_subjects]
+        # Validate on (and take routing reference patches from) the subject after the held-out one
+        reference_dir = os.path.join(args.data_dir, subjects[(index + 1) % len(subjects)], 'train')
+        model_dir = os.path.join(args.model_root, f'AllBut{subject}Trained')
+        result_dir = os.path.join(args.result_root, f'{subject}_results')
+        result_dirs.append(result_dir)
+
+        # Train each expert of this fold
+        train_jobs = []
+        for noise_level in noise_levels:
+            command = [sys.executable, os.path.join(SCRIPTS_DIR, 'train.py'), f'--noise_level={noise_level}',
+                       f'--val_data={reference_dir}', f'--result_dir={model_dir}', f'--epoch={args.epoch}']
+            command += [f'--train_data={train_dir}' for train_dir in train_dirs]
+            train_jobs.append(dag.add(Job(f'train_{noise_level}_{subject}', command=command,
+                                          dependencies=[f'build_data_{train_subject}'
+                                                        for train_subject in train_subjects],
+                                          outputs=[os.path.join(model_dir, f'MyDnCNN_{noise_level}_noise')],
+                                          cpus=args.train_cpus, memory_mb=args.train_memory_mb)).name)
+
+        # Run inference on the held-out subject with this fold's models
+        command = [sys.executable, os.path.join(SCRIPTS_DIR, 'inference.py'),
+                   f'--single_denoiser={int(single_denoiser)}', f'--set_dir={os.path.join(args.data_dir, subject)}',
+                   f'--train_data={reference_dir}', f'--result_dir={result_dir}']
+        for noise_level in noise_levels:
+            noise_level_model_dir = os.path.join(model_dir, f'MyDnCNN_{noise_level}_noise')
+            command.append(f'--model_dir_{noise_level}_noise={noise_level_model_dir}')
+        dag.add(Job(f'infer_{subject}', command=command, dependencies=train_jobs,
+                    inputs=get_image_dirs(os.path.join(args.data_dir, subject)) + get_image_dirs(reference_dir),
+                    outputs=[os.path.join(result_dir, 'results.txt')], cpus=args.infer_cpus,
+                    memory_mb=args.infer_memory_mb))
+
+    # Evaluate every fold
+    summary_path = os.path.join(args.result_root, 'cross_validation_summary.csv')
+    dag.add(Job('evaluate', function=lambda: evaluate(result_dirs, summary_path),
+                dependencies=[f'infer_{subject}' for subject in subjects],
+                config={'result_dirs': result_dirs, 'summary_path': summary_path}, outputs=[summary_path],
+                cpus=1, memory_mb=256))
+    return dag
+
+
+if __name__ == '__main__':
+
+    # Get command-line arguments
+    args = parse_args()
+
+    # Run every job that isn't up to date
+    statuses = build_dag(args).run(dry_run=bool(args.dry_run))
+
+    # Exit with an error if any job failed
+    failed_jobs = [name for name, status in statuses.items() if status in ('failed', 'blocked')]
+    if failed_jobs:
+        sys.exit(f'ERROR: {len(failed_jobs)} jobs failed or were blocked: {failed_jobs}')
@@ -4,6 +4,7 @@ Main script used to run inference with HydraNet and test the results
 
 import argparse
 import os
+import socket
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'  # Suppress TensorFlow logging (1)
 import time
@@ -14,12 +15,16 @@ from skimage.metrics import peak_signal_noise_ratio, structural_similarity
 from skimage.io import imread, imsave
 import tensorflow as tf
 import cv2
-import copy
 from typing import List, Tuple, Dict
 import math
 
 # This is for running normally, where the root directory is MyDenoiser/keras_implementation
 from utilities import image_utils, logger, data_generator, model_functions
+from utilities import result_cache, parallel_inference, work_queue
+from utilities.denoiser import HydraNetDenoiser, HydraNet3dDenoiser, SimilarityRouter
+from utilities.result_cache import ResultCache
+from utilities.instrumentation import Instrumentation
+from utilities.memory_profiler import MemoryProfiler
 
 # # Set Memory Growth to true to fix a small bug in Tensorflow
 # physical_devices = tf.config.list_physical_devices('GPU')
@@ -31,14 +36,6 @@ from utilities import image_utils, logger, data_generator, model_functions
 #     print(err)
 #     pass
 
-# Initialize global variable to keep track of # of patches per noise level
-total_patches_per_category = {
-    'low': 0,
-    'medium': 0,
-    'high': 0
-}
-
-
 def parse_args():
     """
     Parses Command Line arguments
@@ -91,6 +88,43 @@ def parse_args():
                              'patch-based denoising')
     parser.add_argument('--dncnn_denoise', default=False, type=bool,
                         help='True if we are simply using a DnCNN for denoising')
+    parser.add_argument('--cache_dir', default='', type=str,
+                        help='directory of the content-addressed result cache. If empty, no cache is used, and images '
+                             'whose result already exists in result_dir are skipped')
+    parser.add_argument('--cache_max_gb', default=2.0, type=float, help='maximum size of the result cache in GB')
+    parser.add_argument('--skip_background', default=0, type=int,
+                        help='Crop each image to its foreground (from its mask in <set_dir>/<set_name>/Masks, if it '
+                             'exists) and skip background patches, 1 for yes or 0 for no')
+    parser.add_argument('--backend', default='keras', type=str, choices=['keras', 'tf_function'],
+                        help="how models are run: 'keras' (Model.predict) or 'tf_function' (a cached, XLA-compiled "
+                             "tf.function with bucketed input shapes)")
+    parser.add_argument('--tta_modes', default='', type=str,
+                        help='comma-separated data augmentation modes (0 through 7) to average over with test-time '
+                             'augmentation, e.g. 0,1,2,3,4,5,6,7. If empty, no test-time augmentation is used')
+    parser.add_argument('--num_workers', default=1, type=int,
+                        help='number of worker processes that slices are sharded across, each pinned to its own share '
+                             'of the CPU cores. If 1, everything runs in this process')
+    parser.add_argument('--queue_dir', default='', type=str,
+                        help='shared directory of a work queue. If set, this process joins every other process using '
+                             'the same queue (e.g. on other machines) in claiming and denoising slice ranges')
+    parser.add_argument('--queue_num_jobs', default=64, type=int,
+                        help='number of slice-range jobs the datasets are split into in the work queue')
+    parser.add_argument('--lease_seconds', default=600, type=float,
+                        help='seconds after which the job of a work-queue worker that stopped responding is reclaimed')
+    parser.add_argument('--denoise_3d', default=0, type=int,
+                        help='Denoise each dataset as a whole volume with the 3D denoiser, 1 for yes or 0 for no')
+    parser.add_argument('--model_dir_3d',
+                        default=os.path.join('residual_std_models', 'AllButsubj1Trained', 'My3dDenoiser'),
+                        type=str,
+                        help='directory of the 3D denoising model')
+    parser.add_argument('--memory_budget_mb', default=1024, type=float,
+                        help='memory, in MB, that each batch of bricks may use during 3D denoising')
+    parser.add_argument('--brick_overlap', default=8, type=int,
+                        help='number of voxels by which neighbouring bricks overlap during 3D denoising')
+    parser.add_argument('--memory_profile', default=0, type=int,
+                        help='record the RSS and Python allocations (tracemalloc) of the reference-bank build and the '
+                             'slice loop of this process into memory_profile.csv and memory_profile.json next to '
+                             'log.txt. Slows inference down, 1 for yes or 0 for no')
     return parser.parse_args()
 
 
@@ -136,169 +170,6 @@ def show(x, title=None, cbar=False, figsize=None):
     plt.show()
 
 
-def denoise_image_by_patches(y: np.ndarray, file_name: str, set_name: str, original_mean: float, original_std: float,
-                             y_original_mean: float, y_original_std: float, save_patches: bool = True,
-                             single_denoiser: bool = False, model_dict: Dict = None,
-                             training_patches: Dict = None) -> np.ndarray:
-    """
-    Takes an input image and denoises it using a patch-based approach
-
-    :param y: The input image to denoise
-    :param file_name: The name of the file
-    :param set_name: The name of the set containing our test data
-    :param original_mean: The original mean px value of the image that the patch x is part of, which was used to
-                            standardize the image
-    :param original_std: The original standard deviation px value of the image that the patch x is part of, which was
-                            used to standardize the image
-    :param y_original_mean: The original mean px value of the image that the patch y is part of, which was used to
-                            standardize the image
-    :param y_original_std: The original standard deviation px value of the image that the patch y is part of, which was
-                            used to standardize the image
-    :param save_patches: True if we wish to save the individual patches
-    :param single_denoiser: True if we wish to denoise patches using only a single denoiser
-    :param model_dict: A dictionary of all the TF residual_std_models used to denoise image patches
-    :param training_patches: A nested dictionary of training patches and their residual stds
-
-    :return: x_pred: A denoised image as a numpy array
-    :rtype: numpy array
-    """
-
-    # Set the save directory name
-    save_dir_name = os.path.join(args.result_dir, set_name, file_name + '_patches')
-
-    # First, create a denoised x_pred to INITIALLY be a deep copy of y. Then we will modify x_pred in place
-    x_pred = copy.deepcopy(y)
-
-    # Set a new 2d array of lists
-    already_denoised_pixels_mask = np.zeros(shape=(40, 40))
-
-    # Loop over the indices of y to get 40x40 patches from y
-    for i in range(0, len(y[0]), 30):
-        for j in range(0, len(y[1]), 30):
-
-            # If the patch does not 'fit' within the dimensions of y, skip this and do not denoise
-            if i + 40 > len(y[0]) or j + 40 > len(y[1]):
-                continue
-
-            # Get the (40, 40) patch, make a copy as a tensor, and then reshape the original to be a (40, 40, 1) patch
-            y_patch = y[i:i + 40, j:j + 40]
-            y_patch_tensor = image_utils.to_tensor(y_patch)
-            y_patch = y_patch.reshape(y_patch.shape[0], y_patch.shape[1], 1)
-
-            '''Iterate over all of the training patches to get the training patch with the highest 
-            SSIM compared to y_patch. Then, use the category of that training image to determine 
-            which model to use to denoise this patch'''
-
-            # If we wish to use a single denoiser, skip the standard deviation retrieval and parsing into categories,
-            # and just denoise each patch
-            if single_denoiser:
-                print('Calling all-noise model!')
-                # Inference with model_low_noise (Denoise y_patch_tensor to get x_patch_pred)
-                x_patch_pred_tensor = model_dict["all"].predict(y_patch_tensor)
-
-                # Convert the denoised patch from a tensor to an image (numpy array)
-                x_patch_pred = image_utils.from_tensor(x_patch_pred_tensor)
-
-                # Replace the patch in x with the new denoised patch
-                # TODO: Implement patch overlapping here
-                x_pred[i:i + 40, j:j + 40] = x_patch_pred
-
-                if save_patches:
-                    # Reverse the standardization of x
-                    x_patch_pred = image_utils.reverse_standardize(x_patch_pred, original_mean, original_std)
-
-                    # Save the denoised patch
-                    image_utils.save_image(x=x_patch_pred,
-                                           save_dir_name=save_dir_name,
-                                           save_file_name=file_name + '_i-' + str(i) + '_j-' + str(j) + '.png')
-
-                # Finally, skip to the next loop
-                continue
-
-            # Get the Max SSIM value between y_patch and the most similar x in every category
-            reversed_y_patch = image_utils.reverse_standardize(y_patch, y_original_mean, y_original_std)
-            low_max_ssim = compare_to_closest_training_patch(reversed_y_patch, training_patches["low_noise"]["y"],
-                                                             comparison_metric='ssim')
-            medium_max_ssim = compare_to_closest_training_patch(reversed_y_patch, training_patches["medium_noise"]["y"],
-                                                                comparison_metric='ssim')
-            high_max_ssim = compare_to_closest_training_patch(reversed_y_patch, training_patches["high_noise"]["y"],
-                                                              comparison_metric='ssim')
-
-            # Get the overall max_ssim from those above categorical maxes
-            max_ssim_category = ''
-            max_ssim = max([low_max_ssim, medium_max_ssim, high_max_ssim])
-            if max_ssim == high_max_ssim:
-                max_ssim_category = 'high'
-            elif max_ssim == medium_max_ssim:
-                max_ssim_category = 'medium'
-            elif max_ssim == low_max_ssim:
-                max_ssim_category = 'low'
-
-            # Keep track of total patches called per each category
-            total_patches_per_category[max_ssim_category] += 1
-            print(f'Calling {max_ssim_category}-noise model!')
-
-            # Inference with model_low_noise (Denoise y_patch_tensor to get x_patch_pred)
-            x_patch_pred_tensor = model_dict[max_ssim_category].predict(y_patch_tensor)
-
-            # Convert the denoised patch from a tensor to an image (numpy array)
-            x_patch_pred = image_utils.from_tensor(x_patch_pred_tensor)
-
-            # Replace the patch in x with the new denoised patch
-            x_pred[i:i + 40, j:j + 40] = x_patch_pred
-
-            if save_patches:
-                # Reverse the standardization of x
-                x_patch_pred = image_utils.reverse_standardize(x_patch_pred, original_mean, original_std)
-
-                # Save the denoised patch
-                image_utils.save_image(x=x_patch_pred,
-                                       save_dir_name=save_dir_name,
-                                       save_file_name=file_name + '_i-' + str(i) + '_j-' + str(j) + '.png')
-
-    '''Just logging
-    logger.show_images([("y", y), ("x_pred", x_pred)])
-    '''
-
-    return x_pred
-
-
-def compare_to_closest_training_patch(patch: np.ndarray, training_patches: np.ndarray,
-                                      comparison_metric: str = 'ssim') -> float:
-    """
-    Takes an image patch and compares it with all patches in a given set of training patches to find
-    the one with max similarity. Returns the similarity between the given image patch and that chosen
-    training patch.
-
-    Parameters
-    ----------
-    patch: The patch to find a closest match to
-    training_patches: The set of training patches to compare the input patch with
-    comparison_metric: If 'ssim', we find max SSIM, otherwise, if 'psnr', we find max PSNR
-
-    Returns
-    -------
-    The PSNR or SSIM between the input patch and the closest match in training_patches
-    """
-    max_score = 0
-    for training_patch in training_patches:
-        # First, reshape training_patch and patch to get the ssim
-        training_patch = training_patch.reshape(training_patch.shape[0], training_patch.shape[1])
-        patch = patch.reshape(patch.shape[0], patch.shape[1])
-        if comparison_metric == 'psnr':
-            # Get the PSNR between y_patch and y_low_noise_patch
-            score = peak_signal_noise_ratio(patch, training_patch)
-        elif comparison_metric == 'ssim':
-            # Get the SSIM between y_patch and y_low_noise_patch
-            score = structural_similarity(training_patch, patch)
-        # Then, reshape the input patch back
-        patch = patch.reshape(patch.shape[0], patch.shape[1], 1)
-        # If it's greater than the max, update the max
-        if score > max_score:
-            max_score = score
-    return max_score
-
-
 def cleanup(args):
     """Runs cleanup denoising on patch-denoised images"""
 
@@ -313,6 +184,11 @@ def cleanup(args):
     # Load the cleanup denoiser model
     model = load_model(os.path.join(args.model_dir_all_noise, 'model_%03d.hdf5' % latest_epoch), compile=False)
 
+    # Run the model through a compiled tf.function, if requested, padding each slice to a multiple of 8 px
+    predict = model.predict
+    if args.backend == 'tf_function':
+        predict = model_functions.CompiledPredictor(model, max_batch_size=1, spatial_multiple=8).predict
+
     # If the result directory doesn't exist already, just create it
     if not os.path.exists(args.cleanup_result_dir):
         os.mkdir(args.cleanup_result_dir)
@@ -362,7 +238,7 @@ def cleanup(args):
                 start_time = time.time()
 
                 # Denoise the image
-                x_pred = model.predict(y_tensor)
+                x_pred = predict(y_tensor)
 
                 # Reshape the prediction from (1, x, x, 1) to (x, x) by squeezing size 1 dimensions
                 x_pred = np.squeeze(x_pred)
@@ -449,6 +325,11 @@ def dncnn_main(args):
     # Load the cleanup denoiser model
     model = load_model(os.path.join(args.model_dir_dncnn, 'model_%03d.hdf5' % latest_epoch), compile=False)
 
+    # Run the model through a compiled tf.function, if requested, padding each slice to a multiple of 8 px
+    predict = model.predict
+    if args.backend == 'tf_function':
+        predict = model_functions.CompiledPredictor(model, max_batch_size=1, spatial_multiple=8).predict
+
     # For each dataset that we wish to test on...
     for set_name in args.set_names:
 
@@ -495,7 +376,7 @@ def dncnn_main(args):
                 start_time = time.time()
 
                 # Denoise the image
-                x_pred = model.predict(y_tensor)
+                x_pred = predict(y_tensor)
 
                 # Reshape the prediction from (1, x, x, 1) to (x, x) by squeezing size 1 dimensions
                 x_pred = np.squeeze(x_pred)
@@ -538,61 +419,57 @@ def dncnn_main(args):
                                                                                              ssim_avg))
 
 
-def main(args):
-    """The main function of the program"""
+def build_denoiser(args, profiler: MemoryProfiler = None) -> HydraNetDenoiser:
+    """
+    Creates the HydraNetDenoiser described by the command-line arguments, loading its models
+    (and, for routed denoising, its reference bank of training patches) once
 
-    print('\n\n\nInside of the main function of inference.py\n\n\n')
+    :param args: The parsed command-line arguments
+    :param profiler: An optional MemoryProfiler that records the reference-bank build
 
-    # Get the latest epoch numbers
-    # latest_epoch_original = model_functions.findLastCheckpoint(save_dir=args.model_dir_original)
-    latest_epoch_all_noise = model_functions.findLastCheckpoint(save_dir=args.model_dir_all_noise)
-    latest_epoch_low_noise = model_functions.findLastCheckpoint(save_dir=args.model_dir_low_noise)
-    latest_epoch_medium_noise = model_functions.findLastCheckpoint(save_dir=args.model_dir_medium_noise)
-    latest_epoch_high_noise = model_functions.findLastCheckpoint(save_dir=args.model_dir_high_noise)
+    :return: A HydraNetDenoiser
+    """
+    profiler = profiler if profiler is not None else MemoryProfiler(enabled=False)
 
-    # Create dictionaries to store residual_std_models and training patches
-    model_dict = {}
-    training_patches = {}
+    # Get the test-time augmentation modes, if any
+    tta_modes = [int(mode) for mode in args.tta_modes.split(',')] if args.tta_modes else None
 
-    # If we are denoising with a single denoiser...
+    # If we are denoising with a single denoiser, load our single all-noise denoising model
     if args.single_denoiser:
-        # Load our single all-noise denoising model
-        # latest_epoch_all_noise = 20  # TODO: Delete this line
-        model_dict["all"] = load_model(os.path.join(args.model_dir_all_noise,
-                                                    'model_%03d.hdf5' % latest_epoch_all_noise),
-                                       compile=False)
-        log(f'Loaded single all-noise model: '
-            f'{os.path.join(args.model_dir_all_noise, "model_%03d.hdf5" % latest_epoch_all_noise)}. ')
-
-    # Otherwise...
+        denoiser = HydraNetDenoiser(model_dirs={'all': args.model_dir_all_noise},
+                                    backend=args.backend, skip_background=bool(args.skip_background),
+                                    tta_modes=tta_modes)
+        log(f'Loaded single all-noise model: {denoiser.model_paths["all"]}. ')
+
+    # Otherwise, load our 3 denoising residual_std_models and the training data used to determine which
+    # denoising network to send each patch through
     else:
-        # Load our 3 denoising residual_std_models
-        ''' TODO: Uncomment this '''
-        # model_dict["all"] = load_model(
-        #     os.path.join(args.model_dir_all_noise, 'model_%03d.hdf5' % latest_epoch_all_noise),
-        #     compile=False)
-        latest_epoch_low_noise = 20  # TODO: Delete this line
-        latest_epoch_medium_noise = 20  # TODO: Delete this line
-        latest_epoch_high_noise = 20  # TODO: Delete this line
-        model_dict["low"] = load_model(
-            os.path.join(args.model_dir_low_noise, 'model_%03d.hdf5' % latest_epoch_low_noise),
-            compile=False)
-        model_dict["medium"] = load_model(
-            os.path.join(args.model_dir_medium_noise, 'model_%03d.hdf5' % latest_epoch_medium_noise),
-            compile=False)
-        model_dict["high"] = load_model(
-            os.path.join(args.model_dir_high_noise, 'model_%03d.hdf5' % latest_epoch_high_noise),
-            compile=False)
-        log(f'Loaded all 3 trained residual_std_models: '
-            f'{os.path.join(args.model_dir_low_noise, "model_%03d.hdf5" % latest_epoch_low_noise)}, '
-            f'{os.path.join(args.model_dir_medium_noise, "model_%03d.hdf5" % latest_epoch_medium_noise)}, and '
-            f'{os.path.join(args.model_dir_high_noise, "model_%03d.hdf5" % latest_epoch_high_noise)}')
-
-    if not args.single_denoiser:
-        # Get our training data to use for determining which denoising network to send each patch through
-        training_patches = data_generator.retrieve_train_data([args.train_data], low_noise_threshold=20.0,
-                                                              high_noise_threshold=40.0, skip_every=3, patch_size=40,
-                                                              stride=20, scales=[1])
+        with profiler.stage('reference_bank_build'):
+            router = SimilarityRouter.from_train_data([args.train_data], low_noise_threshold=20.0,
+                                                      high_noise_threshold=40.0, skip_every=3, patch_size=40,
+                                                      stride=20, scales=[1])
+        denoiser = HydraNetDenoiser(model_dirs={'low': args.model_dir_low_noise,
+                                                'medium': args.model_dir_medium_noise,
+                                                'high': args.model_dir_high_noise},
+                                    router=router,
+                                    epochs={'low': 20, 'medium': 20, 'high': 20},  # TODO: Use the latest epochs
+                                    backend=args.backend, skip_background=bool(args.skip_background),
+                                    tta_modes=tta_modes)
+        log(f'Loaded all 3 trained residual_std_models: {denoiser.model_paths["low"]}, '
+            f'{denoiser.model_paths["medium"]}, and {denoiser.model_paths["high"]}')
+
+    return denoiser
+
+
+def main_3d(args):
+    """Runs tiled 3D denoising on whole volumes"""
+
+    print('\n\n\nInside of the main_3d function of inference.py\n\n\n')
+
+    # Load the 3D denoiser once, up front
+    denoiser = HydraNet3dDenoiser(args.model_dir_3d, memory_budget_mb=args.memory_budget_mb,
+                                  overlap=args.brick_overlap)
+    log(f'Loaded 3D model: {denoiser.model_path}. ')
 
     # For each dataset that we wish to test on...
     for set_name in args.set_names:
@@ -601,97 +478,287 @@ def main(args):
         if not os.path.exists(os.path.join(args.result_dir, set_name)):
             os.mkdir(os.path.join(args.result_dir, set_name))
 
-        # Create a List of Peak Signal-To-Noise ratios (PSNRs) and Structural Similarities (SSIMs)
+        # Load the Clear volume x and the Coregistered Blurry volume y, stacking their slices in order
+        x = image_utils.get_3d_image_volume(os.path.join(args.set_dir, str(set_name), 'ClearImages'))
+        y_dir = os.path.join(args.set_dir, str(set_name), 'CoregisteredBlurryImages')
+        y = image_utils.get_3d_image_volume(y_dir)
+        _, x_orig_mean, x_orig_std = image_utils.standardize(x)
+
+        # Denoise the volume, reversing the standardization with the statistics of x
+        brick_shape, batch_size, corners = denoiser.get_tiling(y.shape)
+        start_time = time.time()
+        x_pred = denoiser.denoise_volume(y, reference_mean=x_orig_mean, reference_std=x_orig_std)
+        print('%10s : %d bricks of shape %s, %d per batch : %2.4f second' % (set_name, len(corners), brick_shape,
+                                                                             batch_size, time.time() - start_time))
+
+        # Get the PSNR and SSIM of each slice
         psnrs = []
         ssims = []
+        for x_slice, x_pred_slice in zip(x, x_pred):
+            psnr_x = peak_signal_noise_ratio(x_slice, x_pred_slice)
+            if psnr_x > 0:
+                psnrs.append(psnr_x)
+            ssims.append(structural_similarity(x_slice, x_pred_slice))
 
-        for image_name in os.listdir(os.path.join(args.set_dir, set_name, 'CoregisteredBlurryImages')):
-            if image_name.endswith(".jpg") or image_name.endswith(".bmp") or image_name.endswith(".png"):
-
-                # Skip this example if the result already exists
-                if os.path.exists(os.path.join(args.result_dir, set_name, image_name)):
-                    continue
+        # Get the average PSNR and SSIM and add into their respective lists
+        psnr_avg = np.mean(psnrs)
+        ssim_avg = np.mean(ssims)
+        psnrs.append(psnr_avg)
+        ssims.append(ssim_avg)
 
-                # Get the image name minus the file extension
-                image_name_no_extension, _ = os.path.splitext(image_name)
+        # If we want to save the result...
+        if args.save_result:
+            # Then save each denoised slice under the name of its blurry slice
+            for image_name, x_pred_slice in zip(image_utils.get_3d_image_volume_file_names(y_dir), x_pred):
+                cv2.imwrite(filename=os.path.join(args.result_dir, set_name, image_name), img=x_pred_slice)
+            # Save the result to <result_dir>/<set_name>/results.txt
+            save_result(np.hstack((psnrs, ssims)), path=os.path.join(args.result_dir, set_name, 'results.txt'))
 
-                # 1. Load the Clear Image x (as grayscale), and standardize the pixel values, and..
-                # 2. Save the original mean and standard deviation of x
-                x, x_orig_mean, x_orig_std = image_utils.standardize(imread(os.path.join(args.set_dir,
-                                                                                         str(set_name),
-                                                                                         'ClearImages',
-                                                                                         str(image_name)), 0))
+        # Log the average PSNR and SSIM to the Terminal
+        log('Dataset: {0:10s} \n  Average PSNR = {1:2.2f}dB, Average SSIM = {2:1.4f}'.format(set_name, psnr_avg,
+                                                                                             ssim_avg))
 
-                # Load the Coregistered Blurry Image y (as grayscale), and standardize the pixel values, and...
-                # 2. Save the original mean and standard deviation of y
-                y, y_orig_mean, y_orig_std = image_utils.standardize(imread(os.path.join(args.set_dir,
-                                                                                         str(set_name),
-                                                                                         'CoregisteredBlurryImages',
-                                                                                         str(image_name)), 0))
 
-                # Start a timer
-                start_time = time.time()
+def init_inference_worker(args, profiler: MemoryProfiler = None) -> Tuple:
+    """
+    Loads the models (and routing reference bank) and opens the result cache, once per process
 
-                # Denoise the image
-                x_pred = denoise_image_by_patches(y=y, file_name=str(image_name_no_extension), set_name=set_name,
-                                                  original_mean=x_orig_mean, original_std=x_orig_std,
-                                                  y_original_mean=y_orig_mean, y_original_std=y_orig_std,
-                                                  save_patches=False, single_denoiser=args.single_denoiser,
-                                                  model_dict=model_dict, training_patches=training_patches)
+    :param args: The parsed command-line arguments
+    :param profiler: An optional MemoryProfiler that records the reference-bank build
 
-                # Record the inference time
-                print('%10s : %10s : %2.4f second' % (set_name, image_name, time.time() - start_time))
+    :return: A tuple containing: 1. The parsed command-line arguments
+                                 2. The HydraNetDenoiser
+                                 3. The ResultCache, or None if no cache is used
+    """
+    denoiser = build_denoiser(args, profiler=profiler)
 
-                ''' Just logging
-                # Reverse the standardization
-                x_pred_reversed = image_utils.reverse_standardize(x_pred,
-                                                                  original_mean=x_orig_mean,
-                                                                  original_std=x_orig_std)
-                x_reversed = image_utils.reverse_standardize(x,
-                                                             original_mean=x_orig_mean,
-                                                             original_std=x_orig_std)
-                y_reversed = image_utils.reverse_standardize(y,
-                                                             original_mean=y_orig_mean,
-                                                             original_std=y_orig_std)
+    # Set up the result cache, keyed in part by everything that affects the denoiser's output
+    cache = None
+    if args.cache_dir:
+        cache = ResultCache(args.cache_dir, max_bytes=int(args.cache_max_gb * 1024 ** 3))
+    return args, denoiser, cache
 
-                logger.show_images([("x", x),
-                                    ("x_reversed", x_reversed),
-                                    ("x_pred", x_pred),
-                                    ("x_pred_reversed", x_pred_reversed),
-                                    ("y", y),
-                                    ("y_reversed", y_reversed)])
-                '''
 
-                # Reverse the standardization of x and x_pred (we actually don't need y at this point, only for logging)
-                x = image_utils.reverse_standardize(x, original_mean=x_orig_mean, original_std=x_orig_std)
-                x_pred = image_utils.reverse_standardize(x_pred, original_mean=x_orig_mean, original_std=x_orig_std)
-                # y = image_utils.reverse_standardize(y, original_mean=y_orig_mean, original_std=y_orig_std)
+def denoise_shard(state: Tuple, shard: Tuple[str, List[str]]) -> Dict:
+    """
+    Denoises (and saves) a range of images from one dataset, and gets their PSNRs and SSIMs
 
-                ''' Just logging 
-                logger.show_images([("x", x),
-                                    ("x_pred", x_pred),
-                                    ("y", y)])
-                '''
+    :param state: The arguments, denoiser, and result cache, from init_inference_worker
+    :param shard: A tuple containing the name of the dataset, and the names of the images to denoise
 
-                # Get the PSNR and SSIM for x
+    :return: A dictionary with the 'psnrs' and 'ssims' of the images (in order), and an 'instrumentation' snapshot of
+             the time spent in each stage and the patches, images, and cache hits and misses counted while denoising
+             them
+    """
+    args, denoiser, cache = state
+    set_name, image_names = shard
+
+    # Remember the timings and counters from before this shard, so that only this shard's are returned
+    instrumentation = denoiser.instrumentation
+    snapshot_before = instrumentation.snapshot()
+    if cache is not None:
+        denoiser_fingerprint = denoiser.fingerprint()
+
+    # Create a List of Peak Signal-To-Noise ratios (PSNRs) and Structural Similarities (SSIMs)
+    psnrs = []
+    ssims = []
+
+    for image_name in image_names:
+
+        # Skip this example if the result already exists (when using the cache, it decides instead, so that
+        # results from other models are never reused)
+        if cache is None and os.path.exists(os.path.join(args.result_dir, set_name, image_name)):
+            continue
+        instrumentation.count('images')
+
+        with instrumentation.timer('decode'):
+            # Load the Clear Image x (as grayscale)
+            x_original = imread(os.path.join(args.set_dir, str(set_name), 'ClearImages', str(image_name)), 0)
+
+            # Load the Coregistered Blurry Image y (as grayscale)
+            y = imread(os.path.join(args.set_dir, str(set_name), 'CoregisteredBlurryImages', str(image_name)), 0)
+
+            # Load the Mask (as grayscale) if we are skipping background patches and it exists. Otherwise, the
+            # denoiser finds the foreground by thresholding y
+            mask = None
+            mask_path = os.path.join(args.set_dir, str(set_name), 'Masks', str(image_name))
+            if args.skip_background and os.path.exists(mask_path):
+                mask = cv2.imread(mask_path, 0)
+
+        with instrumentation.timer('standardize'):
+            # Standardize the pixel values of x, saving the original mean and standard deviation of x, then reverse
+            # the standardization of x
+            x, x_orig_mean, x_orig_std = image_utils.standardize(x_original)
+            x = image_utils.reverse_standardize(x, original_mean=x_orig_mean, original_std=x_orig_std)
+
+        # Look up the result in the cache
+        cached_result = None
+        if cache is not None:
+            with instrumentation.timer('cache_lookup'):
+                cache_key = result_cache.make_key(kind='denoise', denoiser=denoiser_fingerprint,
+                                                  clear=result_cache.hash_array(x_original),
+                                                  blurry=result_cache.hash_array(y),
+                                                  mask=None if mask is None else result_cache.hash_array(mask))
+                cached_result = cache.get(cache_key)
+            instrumentation.count('cache_misses' if cached_result is None else 'cache_hits')
+
+        # Start a timer
+        start_time = time.time()
+
+        if cached_result is not None:
+            # Serve the denoised image and its metrics from the cache
+            x_pred = cached_result['image']
+            psnr_x = cached_result['metrics']['psnr']
+            ssim_x = cached_result['metrics']['ssim']
+            for category, num_patches in cached_result['metrics']['patches_per_category'].items():
+                instrumentation.count(f'patches_{category}', num_patches)
+            instrumentation.count('skipped_background_patches',
+                                  cached_result['metrics'].get('skipped_background_patches', 0))
+            print('%10s : %10s : cached' % (set_name, image_name))
+        else:
+            # Denoise the image, reversing the standardization with the statistics of x
+            patches_per_category = denoiser.patches_per_category
+            skipped_background_patches = denoiser.skipped_background_patches
+            with instrumentation.timer('denoise'):
+                x_pred = denoiser.denoise_slice(y, reference_mean=x_orig_mean, reference_std=x_orig_std,
+                                                mask=mask)
+
+            # Record the inference time
+            print('%10s : %10s : %2.4f second' % (set_name, image_name, time.time() - start_time))
+
+            ''' Just logging 
+            logger.show_images([("x", x),
+                                ("x_pred", x_pred),
+                                ("y", y)])
+            '''
+
+            # Get the PSNR and SSIM for x
+            with instrumentation.timer('metrics'):
                 psnr_x = peak_signal_noise_ratio(x, x_pred)
                 ssim_x = structural_similarity(x, x_pred, multichannel=True)
 
-                # If we want to save the result...
-                if args.save_result:
-                    ''' Just logging
-                    # Show the images
-                    logger.show_images([("y", y),
-                                        ("x_pred", x_pred)])
-                    '''
+            # Store the result in the cache
+            if cache is not None:
+                cache.put(cache_key, image=x_pred, metrics={
+                    'psnr': float(psnr_x),
+                    'ssim': float(ssim_x),
+                    'patches_per_category': {category: denoiser.patches_per_category[category] - num_patches
+                                             for category, num_patches in patches_per_category.items()},
+                    'skipped_background_patches': denoiser.skipped_background_patches - skipped_background_patches
+                })
+
+        # If we want to save the result...
+        if args.save_result:
+            ''' Just logging
+            # Show the images
+            logger.show_images([("y", y),
+                                ("x_pred", x_pred)])
+            '''
 
-                    # Then save the denoised image
-                    cv2.imwrite(filename=os.path.join(args.result_dir, set_name, image_name), img=x_pred)
+            # Then save the denoised image
+            with instrumentation.timer('encode'):
+                cv2.imwrite(filename=os.path.join(args.result_dir, set_name, image_name), img=x_pred)
 
-                # Add the PSNR and SSIM to the lists of PSNRs and SSIMs, respectively
-                if psnr_x > 0:
-                    psnrs.append(psnr_x)
-                ssims.append(ssim_x)
+        # Add the PSNR and SSIM to the lists of PSNRs and SSIMs, respectively
+        if psnr_x > 0:
+            psnrs.append(psnr_x)
+        ssims.append(ssim_x)
+
+    return {
+        'psnrs': [float(psnr) for psnr in psnrs],
+        'ssims': [float(ssim) for ssim in ssims],
+        'instrumentation': Instrumentation.difference(instrumentation.snapshot(), snapshot_before)
+    }
+
+
+def run_queue_worker(state: Tuple, worker_index: int) -> int:
+    """
+    Claims and denoises jobs from the shared work queue until every job is done
+
+    :param state: The arguments, denoiser, and result cache, from init_inference_worker
+    :param worker_index: The index of this worker process on this machine
+
+    :return: The number of jobs run by this worker
+    """
+    args = state[0]
+    queue = work_queue.WorkQueue(args.queue_dir, lease_seconds=args.lease_seconds,
+                                 worker_id=f'{socket.gethostname()}:{os.getpid()}:{worker_index}')
+    return queue.run(lambda job: denoise_shard(state, (job['set_name'], job['image_names'])))
+
+
+def main(args, instrumentation: Instrumentation, profiler: MemoryProfiler = None):
+    """
+    The main function of the program
+
+    :param args: The parsed command-line arguments
+    :param instrumentation: The Instrumentation of the run, into which the timings and counters of every shard are
+        merged
+    :param profiler: An optional MemoryProfiler that records the reference-bank build and the slice loop. Worker
+        processes are not profiled
+    """
+    profiler = profiler if profiler is not None else MemoryProfiler(enabled=False)
+
+    print('\n\n\nInside of the main function of inference.py\n\n\n')
+
+    # Get the names of the images of each dataset that we wish to test on
+    set_image_names = {}
+    for set_name in args.set_names:
+
+        # If the <result directory>/<dataset name> doesn't exist already, just create it
+        if not os.path.exists(os.path.join(args.result_dir, set_name)):
+            os.mkdir(os.path.join(args.result_dir, set_name))
+
+        # Sort the names, so that every worker of a work queue splits them into the same jobs
+        set_image_names[set_name] = sorted(image_name for image_name in
+                                           os.listdir(os.path.join(args.set_dir, set_name, 'CoregisteredBlurryImages'))
+                                           if image_name.endswith(".jpg") or image_name.endswith(".bmp")
+                                           or image_name.endswith(".png"))
+
+    if args.queue_dir:
+        # Submit the slice ranges of every dataset to the shared work queue (every worker submits the same jobs), then
+        # claim and denoise jobs alongside any other workers until every job is done
+        shards = parallel_inference.shard_items(set_image_names, num_shards=args.queue_num_jobs)
+        job_ids = ['%05d' % index for index in range(len(shards))]
+        queue = work_queue.WorkQueue(args.queue_dir, lease_seconds=args.lease_seconds)
+        queue.submit({job_id: {'set_name': set_name, 'image_names': image_names}
+                      for job_id, (set_name, image_names) in zip(job_ids, shards)})
+        if args.num_workers > 1:
+            num_jobs = sum(parallel_inference.map_shards(init_inference_worker, (args,), run_queue_worker,
+                                                         list(range(args.num_workers)),
+                                                         num_workers=args.num_workers))
+        else:
+            state = init_inference_worker(args, profiler=profiler)
+            with profiler.stage('slice_loop'):
+                num_jobs = run_queue_worker(state, 0)
+        log(f'Ran {num_jobs} of the {len(shards)} jobs in {args.queue_dir}')
+        shard_results = [queue.get_result(job_id) for job_id in job_ids]
+
+    elif args.num_workers > 1:
+        # Shard the slices of every dataset across worker processes, which each load the models once and run on
+        # their own share of the CPU cores. Use a few shards per worker, so that the load stays balanced
+        shards = parallel_inference.shard_items(set_image_names, num_shards=4 * args.num_workers)
+        log(f'Denoising {len(shards)} shards with {args.num_workers} workers')
+        shard_results = parallel_inference.map_shards(init_inference_worker, (args,), denoise_shard, shards,
+                                                      num_workers=args.num_workers)
+    else:
+        # Load the models (and routing reference bank) once, up front, and denoise every dataset in this process
+        state = init_inference_worker(args, profiler=profiler)
+        shards = list(set_image_names.items())
+        with profiler.stage('slice_loop'):
+            shard_results = [denoise_shard(state, shard) for shard in shards]
+
+    # Merge the results of every shard, in order, and their timings and counters, both in total and per (named) dataset
+    set_results = {set_name: {'psnrs': [], 'ssims': []} for set_name in set_image_names}
+    for (set_name, _), shard_result in zip(shards, shard_results):
+        set_results[set_name]['psnrs'] += shard_result['psnrs']
+        set_results[set_name]['ssims'] += shard_result['ssims']
+        instrumentation.merge(shard_result['instrumentation'])
+        if set_name:
+            instrumentation.merge(shard_result['instrumentation'], prefix=set_name)
+
+    for set_name, set_result in set_results.items():
+        psnrs = set_result['psnrs']
+        ssims = set_result['ssims']
 
         # Get the average PSNR and SSIM and add into their respective lists
         psnr_avg = np.mean(psnrs)
@@ -708,9 +775,15 @@ def main(args):
         log('Dataset: {0:10s} \n  Average PSNR = {1:2.2f}dB, Average SSIM = {2:1.4f}'.format(set_name, psnr_avg,
                                                                                              ssim_avg))
 
+    if args.skip_background:
+        log(f'Skipped {instrumentation.get_count("skipped_background_patches")} background patches')
+    if args.cache_dir:
+        log(f'Result cache: {instrumentation.get_count("cache_hits")} hits, '
+            f'{instrumentation.get_count("cache_misses")} misses')
+
 
 def reanalyze_denoised_images(set_dir: str, set_names: List[str], result_dir: str, analyze_denoised_data: bool = True,
-                              save_results: bool = True) -> Tuple[float, float]:
+                              save_results: bool = True, cache: ResultCache = None) -> Tuple[float, float]:
     """
     Analyzes the denoised data to get SSIM and PSNR values compared to the clean data.
     Also applies masking to remove artifacts from patch denoising
@@ -721,6 +794,7 @@ def reanalyze_denoised_images(set_dir: str, set_names: List[str], result_dir: st
     :param analyze_denoised_data: True if we wish to analyze denoised images, and
         False if we wish to analyze blurry images instead
     :param save_results: True if we wish to save our results after masking and reanalyzing
+    :param cache: An optional result cache used to reuse the PSNR and SSIM of masked image pairs analyzed before
 
     :return: Average PSNR and Average SSIM
         (TODO: Make this a generator because multiple set names will break this function!)
@@ -774,9 +848,22 @@ def reanalyze_denoised_images(set_dir: str, set_names: List[str], result_dir: st
                 if save_results:
                     cv2.imwrite(filename=os.path.join(result_dir, set_name, image_name), img=comparison_image)
 
-                # Get the PSNR and SSIM between clear_image and denoised_image
-                psnr = peak_signal_noise_ratio(clear_image, comparison_image)
-                ssim = structural_similarity(clear_image, comparison_image, multichannel=True)
+                # Get the PSNR and SSIM between clear_image and denoised_image, reusing them from the cache if this
+                # exact pair of masked images has been analyzed before
+                cached_result = None
+                if cache is not None:
+                    cache_key = result_cache.make_key(kind='reanalyze',
+                                                      clear=result_cache.hash_array(clear_image),
+                                                      comparison=result_cache.hash_array(comparison_image))
+                    cached_result = cache.get(cache_key)
+                if cached_result is not None:
+                    psnr = cached_result['metrics']['psnr']
+                    ssim = cached_result['metrics']['ssim']
+                else:
+                    psnr = peak_signal_noise_ratio(clear_image, comparison_image)
+                    ssim = structural_similarity(clear_image, comparison_image, multichannel=True)
+                    if cache is not None:
+                        cache.put(cache_key, metrics={'psnr': float(psnr), 'ssim': float(ssim)})
 
                 # Add the psnr and ssim to the psnrs and ssim lists, respectively
                 if psnr > 0:
@@ -801,16 +888,27 @@ def reanalyze_denoised_images(set_dir: str, set_names: List[str], result_dir: st
     return psnr_avg, ssim_avg
 
 
-def log_statistics(log_file_path: str, psnr_avg: float, ssim_avg: float):
-    """Prints and logs final statistics from inference run"""
-    print(f'total low-noise patches: {total_patches_per_category["low"]}')
-    print(f'total medium-noise patches: {total_patches_per_category["medium"]}')
-    print(f'total high-noise patches: {total_patches_per_category["high"]}')
+def log_statistics(log_file_path: str, psnr_avg: float, ssim_avg: float, instrumentation: Instrumentation,
+                   profiler: MemoryProfiler = None):
+    """
+    Prints and logs final statistics from inference run, and writes the timings and counters of the run to
+    instrumentation.json and instrumentation.csv next to the log file (and, if memory was profiled, the memory of
+    each stage to memory_profile.csv and memory_profile.json)
+    """
+    patches_per_category = {category: instrumentation.get_count(f'patches_{category}')
+                            for category in ('low', 'medium', 'high')}
+    print(f'total low-noise patches: {patches_per_category["low"]}')
+    print(f'total medium-noise patches: {patches_per_category["medium"]}')
+    print(f'total high-noise patches: {patches_per_category["high"]}')
     with open(log_file_path, 'w') as file:
         file.write(f'Average PSNR = {psnr_avg:2.2f}dB, Average SSIM = {ssim_avg:1.4f}\n')
-        file.write(f'total low-noise patches: {total_patches_per_category["low"]}\n')
-        file.write(f'total medium-noise patches: {total_patches_per_category["medium"]}\n')
-        file.write(f'total high-noise patches: {total_patches_per_category["high"]}\n')
+        file.write(f'total low-noise patches: {patches_per_category["low"]}\n')
+        file.write(f'total medium-noise patches: {patches_per_category["medium"]}\n')
+        file.write(f'total high-noise patches: {patches_per_category["high"]}\n')
+    instrumentation.write_report(os.path.dirname(log_file_path))
+    if profiler is not None and profiler.enabled:
+        print(profiler.get_table())
+        profiler.write_report(os.path.dirname(log_file_path))
 
 
 if __name__ == '__main__':
@@ -822,25 +920,50 @@ if __name__ == '__main__':
     if args.save_result and not os.path.exists(args.result_dir):
         os.makedirs(args.result_dir)
 
+    # Time each phase of the run, and collect the timings and counters of every stage
+    instrumentation = Instrumentation()
+
+    # Profile the memory of each stage, if requested (a disabled profiler records nothing)
+    profiler = MemoryProfiler(enabled=bool(args.memory_profile))
+    if profiler.enabled and args.num_workers > 1:
+        log('NOTE: the memory profile only covers this process, not its worker processes')
+
+    # Run (tiled 3D) denoising
+    if args.denoise_3d:
+        with instrumentation.timer('run_3d'):
+            main_3d(args)
+
     # Run (patch-based) denoising
-    if not args.reanalyze_data and not args.skip_patch_denoise:
-        main(args)
+    elif not args.reanalyze_data and not args.skip_patch_denoise:
+        with instrumentation.timer('run_patch_denoise'):
+            main(args, instrumentation, profiler=profiler)
 
     # Run (cleanup) denoising
     if args.cleanup_denoise:
-        cleanup(args)
+        with instrumentation.timer('run_cleanup'):
+            cleanup(args)
 
     # Run (DnCNN) denoising:
     if args.dncnn_denoise:
-        dncnn_main(args)
+        with instrumentation.timer('run_dncnn'):
+            dncnn_main(args)
+
+    # Set up the result cache used to reuse the PSNR and SSIM of previously analyzed images
+    analysis_cache = None
+    if args.cache_dir:
+        analysis_cache = ResultCache(args.cache_dir, max_bytes=int(args.cache_max_gb * 1024 ** 3))
 
     if args.cleanup_denoise:
         # Run post-processing (masking) and analysis of results
-        psnr_avg, ssim_avg = reanalyze_denoised_images(args.set_dir, args.set_names, args.cleanup_result_dir,
-                                                       save_results=args.save_result)
-        log_statistics(log_file_path=os.path.join(args.cleanup_result_dir, 'log.txt'), psnr_avg=psnr_avg, ssim_avg=ssim_avg)
+        with instrumentation.timer('run_reanalyze'):
+            psnr_avg, ssim_avg = reanalyze_denoised_images(args.set_dir, args.set_names, args.cleanup_result_dir,
+                                                           save_results=args.save_result, cache=analysis_cache)
+        log_statistics(log_file_path=os.path.join(args.cleanup_result_dir, 'log.txt'), psnr_avg=psnr_avg,
+                       ssim_avg=ssim_avg, instrumentation=instrumentation, profiler=profiler)
     else:
         # Run post-processing (masking) and analysis of results
-        psnr_avg, ssim_avg = reanalyze_denoised_images(args.set_dir, args.set_names, args.result_dir,
-                                                       save_results=args.save_result)
-        log_statistics(log_file_path=os.path.join(args.result_dir, 'log.txt'), psnr_avg=psnr_avg, ssim_avg=ssim_avg)
+        with instrumentation.timer('run_reanalyze'):
+            psnr_avg, ssim_avg = reanalyze_denoised_images(args.set_dir, args.set_names, args.result_dir,
+                                                           save_results=args.save_result, cache=analysis_cache)
+        log_statistics(log_file_path=os.path.join(args.result_dir, 'log.txt'), psnr_avg=psnr_avg,
+                       ssim_avg=ssim_avg, instrumentation=instrumentation, profiler=profiler)
@@ -0,0 +1,383 @@
+"""
+Micro-benchmarks the hot utility functions against alternative implementations, checking that they agree numerically
+"""
+
+import argparse
+import os
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'  # Suppress TensorFlow logging (1)
+import sys
+import json
+import time
+import tracemalloc
+import cv2
+import numpy as np
+from scipy.ndimage import uniform_filter
+from typing import List, Dict, Tuple
+from utilities import image_utils, data_generator, phantoms, pyramid_cache, noise_synthesis
+from utilities.denoiser import compare_to_closest_training_patch
+
+# The window size and constants of skimage's structural_similarity, as every SSIM in HydraNet uses them
+SSIM_WIN_SIZE = 7
+SSIM_K1 = 0.01
+SSIM_K2 = 0.03
+
+
+def parse_args():
+    """
+    Parses Command Line arguments
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--functions', default=None, type=str,
+                        help='comma-separated functions to benchmark. If not given, every function')
+    parser.add_argument('--image_size', default=256, type=int, help='height and width of the benchmarked slices')
+    parser.add_argument('--patch_size', default=40, type=int, help='height and width of the benchmarked patches')
+    parser.add_argument('--bank_size', default=500, type=int,
+                        help='number of training patches that compare_to_closest_training_patch searches')
+    parser.add_argument('--repeats', default=20, type=int, help='number of timed calls of each implementation')
+    parser.add_argument('--warmup', default=3, type=int, help='number of untimed calls of each implementation first')
+    parser.add_argument('--seed', default=0, type=int, help='seed of the benchmarked inputs')
+    parser.add_argument('--output', default=None, type=str, help='optional path of the JSON results')
+    return parser.parse_args()
+
+
+def ssim_map(image1: np.ndarray, image2: np.ndarray, data_range: float = 255) -> np.ndarray:
+    """
+    Gets the full SSIM map of two 2D images, as structural_similarity(image1, image2, full=True) does, with box filters
+    from OpenCV instead of scipy.ndimage
+    """
+    image1 = image1.astype('float64')
+    image2 = image2.astype('float64')
+
+    def box(image):
+        # scipy's 'reflect' mode (d c b a | a b c d) is OpenCV's BORDER_REFLECT
+        return cv2.boxFilter(image, cv2.CV_64F, (SSIM_WIN_SIZE, SSIM_WIN_SIZE), borderType=cv2.BORDER_REFLECT)
+
+    cov_norm = SSIM_WIN_SIZE ** 2 / (SSIM_WIN_SIZE ** 2 - 1)
+    ux, uy = box(image1), box(image2)
+    vx = cov_norm * (box(image1 * image1) - ux * ux)
+    vy = cov_norm * (box(image2 * image2) - uy * uy)
+    vxy = cov_norm * (box(image1 * image2) - ux * uy)
+    c1, c2 = (SSIM_K1 * data_range) ** 2, (SSIM_K2 * data_range) ** 2
+    return ((2 * ux * uy + c1) * (2 * vxy + c2)) / ((ux ** 2 + uy ** 2 + c1) * (vx + vy + c2))
+
+
+def lut_hist_match(source: np.ndarray, template: np.ndarray) -> np.ndarray:
+    """ image_utils.hist_match for uint8 images, with 256-bin histograms and a lookup table instead of np.unique """
+    if source.dtype != np.uint8 or template.dtype != np.uint8:
+        return image_utils.hist_match(source, template)
+
+    s_counts = np.bincount(source.ravel(), minlength=256)
+    t_counts = np.bincount(template.ravel(), minlength=256)
+    s_present = s_counts > 0
+    t_present = t_counts > 0
+
+    # The same quantiles of the px values that are present as hist_match computes
+    s_quantiles = np.cumsum(s_counts[s_present]).astype(np.float64)
+    s_quantiles /= s_quantiles[-1]
+    t_quantiles = np.cumsum(t_counts[t_present]).astype(np.float64)
+    t_quantiles /= t_quantiles[-1]
+
+    lookup_table = np.zeros(256, dtype=np.float64)
+    lookup_table[s_present] = np.interp(s_quantiles, t_quantiles, np.flatnonzero(t_present))
+    return lookup_table[source]
+
+
+def box_filter_get_residual(clear_image: np.ndarray, blurry_image: np.ndarray) -> np.ndarray:
+    """ image_utils.get_residual, with ssim_map """
+    return ssim_map(blurry_image.reshape(blurry_image.shape[0], blurry_image.shape[1]),
+                    clear_image.reshape(clear_image.shape[0], clear_image.shape[1]))
+
+
+def box_filter_get_residual_std(clear_patch: np.ndarray, blurry_patch: np.ndarray) -> float:
+    """ data_generator.get_residual_std, with ssim_map """
+    return np.std(box_filter_get_residual(clear_patch, blurry_patch))
+
+
+def in_place_standardize(x: np.ndarray):
+    """ image_utils.standardize (without a precomputed mean and std), reusing its float32 copy of x """
+    x = x.astype('float32')
+    original_mean = x.mean()
+    original_std = x.std()
+    x -= original_mean
+    if original_std != 0.0:
+        x /= original_std
+    return x, original_mean, original_std
+
+
+def in_place_reverse_standardize(x: np.ndarray, original_mean: float, original_std: float) -> np.ndarray:
+    """ image_utils.reverse_standardize, with a single float intermediate """
+    restored_x = x * original_std
+    restored_x += original_mean
+    np.clip(restored_x, 0., 255., out=restored_x)
+    return restored_x.astype(np.uint8)
+
+
+# The CLAHE objects of cached_CLAHE_single_image, by their settings
+_clahe_cache = {}
+
+
+def cached_CLAHE_single_image(image: np.ndarray, clip_limit: float = 2.0, tile_grid_size=(8, 8)) -> np.ndarray:
+    """ image_utils.CLAHE_single_image, creating each CLAHE object only once """
+    key = (clip_limit, tuple(tile_grid_size))
+    if key not in _clahe_cache:
+        _clahe_cache[key] = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tuple(tile_grid_size))
+    return _clahe_cache[key].apply(image)
+
+
+def windowed_generate_patch_pairs(clear_image: np.ndarray, blurry_image: np.ndarray, patch_size: int = 40,
+                                  stride: int = 10, scales: List[float] = [1, 0.9, 0.8, 0.7]):
+    """
+    data_generator.generate_patch_pairs for square images, taking every scale's patches at once as strided views
+    (np.lib.stride_tricks.sliding_window_view) instead of slicing them one at a time
+    """
+    clear_patches = []
+    blurry_patches = []
+    for scale in scales:
+        for image, patches in ((clear_image, clear_patches), (blurry_image, blurry_patches)):
+            windows = np.lib.stride_tricks.sliding_window_view(pyramid_cache.resize_image(image, scale),
+                                                               (patch_size, patch_size))[::stride, ::stride]
+            patches.append(windows.reshape(-1, patch_size, patch_size))
+    return np.concatenate(clear_patches), np.concatenate(blurry_patches)
+
+
+def batched_compare_to_closest_training_patch(patch: np.ndarray, training_patches: np.ndarray,
+                                              comparison_metric: str = 'ssim', chunk_size: int = 256) -> float:
+    """
+    compare_to_closest_training_patch with comparison_metric='ssim', computing the SSIMs of chunk_size training
+    patches at once with a uniform filter over their height and width
+    """
+    if comparison_metric != 'ssim':
+        return compare_to_closest_training_patch(patch, training_patches, comparison_metric=comparison_metric)
+
+    patch = patch.reshape(1, patch.shape[0], patch.shape[1]).astype('float64')
+    filter_size = (1, SSIM_WIN_SIZE, SSIM_WIN_SIZE)
+    cov_norm = SSIM_WIN_SIZE ** 2 / (SSIM_WIN_SIZE ** 2 - 1)
+    c1, c2 = (SSIM_K1 * 255) ** 2, (SSIM_K2 * 255) ** 2
+    pad = (SSIM_WIN_SIZE - 1) // 2
+
+    # The statistics of the patch are the same for every training patch
+    uy = uniform_filter(patch, size=filter_size)
+    vy = cov_norm * (uniform_filter(patch * patch, size=filter_size) - uy * uy)
+
+    max_score = 0
+    for start in range(0, len(training_patches), chunk_size):
+        chunk = training_patches[start:start + chunk_size]
+        x = chunk.reshape(len(chunk), chunk.shape[1], chunk.shape[2]).astype('float64')
+        ux = uniform_filter(x, size=filter_size)
+        vx = cov_norm * (uniform_filter(x * x, size=filter_size) - ux * ux)
+        vxy = cov_norm * (uniform_filter(x * patch, size=filter_size) - ux * uy)
+        ssims = ((2 * ux * uy + c1) * (2 * vxy + c2)) / ((ux ** 2 + uy ** 2 + c1) * (vx + vy + c2))
+        scores = ssims[:, pad:-pad, pad:-pad].mean(axis=(1, 2), dtype=np.float64)
+        max_score = max(max_score, float(np.max(scores)))
+    return max_score
+
+
+def make_inputs(image_size: int, patch_size: int, bank_size: int, seed: int) -> Dict:
+    """
+    Makes realistic inputs: a clear phantom slice and a noisy copy of it, and a bank of noisy phantom patches
+
+    Returns
+    -------
+    A dictionary of the inputs
+    """
+    rng = np.random.default_rng(seed)
+    volume, _ = phantoms.make_phantom_volume((8, image_size, image_size), seed=seed)
+    clear_image = volume[len(volume) // 2]
+    blurry_image = noise_synthesis.add_noise(clear_image, 25, rng=seed)
+    standardized_image, mean, std = image_utils.standardize(blurry_image)
+
+    # Take the bank's patches from random positions of the other, noisy, slices
+    noisy_volume = noise_synthesis.add_noise(volume, 30, rng=seed + 1)
+    bank = np.empty((bank_size, patch_size, patch_size, 1), dtype='uint8')
+    for n in range(bank_size):
+        k = rng.integers(len(volume))
+        i, j = rng.integers(image_size - patch_size + 1, size=2)
+        bank[n, ..., 0] = noisy_volume[k, i:i + patch_size, j:j + patch_size]
+
+    top = (image_size - patch_size) // 2
+    return {
+        'clear_image': clear_image,
+        'blurry_image': blurry_image,
+        'standardized_image': standardized_image,
+        'mean': mean,
+        'std': std,
+        'clear_patch': clear_image[top:top + patch_size, top:top + patch_size, np.newaxis],
+        'blurry_patch': blurry_image[top:top + patch_size, top:top + patch_size, np.newaxis],
+        'bank': bank
+    }
+
+
+def get_cases(inputs: Dict) -> Dict[str, Dict]:
+    """
+    Gets the benchmark case of every function: its arguments, its implementations ('current' first, which every other
+    implementation is checked against), and the absolute tolerance of their outputs
+
+    Parameters
+    ----------
+    inputs: The inputs from make_inputs
+
+    Returns
+    -------
+    A dictionary mapping each function's name to its case
+    """
+    return {
+        'hist_match': {
+            'arguments': (inputs['blurry_image'], inputs['clear_image']),
+            'implementations': {'current': image_utils.hist_match, 'lookup_table': lut_hist_match},
+            'atol': 1e-9
+        },
+        'get_residual': {
+            'arguments': (inputs['clear_image'], inputs['blurry_image']),
+            'implementations': {'current': image_utils.get_residual, 'box_filter': box_filter_get_residual},
+            'atol': 1e-6
+        },
+        'standardize': {
+            'arguments': (inputs['blurry_image'],),
+            'implementations': {'current': image_utils.standardize, 'in_place': in_place_standardize},
+            'atol': 1e-6
+        },
+        'reverse_standardize': {
+            'arguments': (inputs['standardized_image'], inputs['mean'], inputs['std']),
+            'implementations': {'current': image_utils.reverse_standardize,
+                                'in_place': in_place_reverse_standardize},
+            'atol': 0
+        },
+        'CLAHE_single_image': {
+            'arguments': (inputs['blurry_image'],),
+            'implementations': {'current': image_utils.CLAHE_single_image, 'cached': cached_CLAHE_single_image},
+            'atol': 0
+        },
+        'generate_patch_pairs': {
+            'arguments': (inputs['clear_image'], inputs['blurry_image']),
+            'implementations': {'current': data_generator.generate_patch_pairs,
+                                'windowed': windowed_generate_patch_pairs},
+            'atol': 0
+        },
+        'get_residual_std': {
+            'arguments': (inputs['clear_patch'], inputs['blurry_patch']),
+            'implementations': {'current': data_generator.get_residual_std, 'box_filter': box_filter_get_residual_std},
+            'atol': 1e-6
+        },
+        'compare_to_closest_training_patch': {
+            'arguments': (inputs['blurry_patch'], inputs['bank']),
+            'implementations': {'current': compare_to_closest_training_patch,
+                                'batched': batched_compare_to_closest_training_patch},
+            'atol': 1e-9
+        }
+    }
+
+
+def as_arrays(output) -> Tuple[np.ndarray, ...]:
+    """ Gets the output of a function (an array, a number, or a tuple of them or of lists of arrays) as float arrays """
+    outputs = output if isinstance(output, tuple) else (output,)
+    return tuple(np.asarray(value, dtype='float64') for value in outputs)
+
+
+def get_max_deviation(output, reference) -> float:
+    """ Gets the largest absolute difference between two outputs, or inf if their shapes differ """
+    output, reference = as_arrays(output), as_arrays(reference)
+    if len(output) != len(reference) or any(a.shape != b.shape for a, b in zip(output, reference)):
+        return float('inf')
+    return max((float(np.max(np.abs(a - b))) if a.size else 0.0 for a, b in zip(output, reference)), default=0.0)
+
+
+def benchmark(function, arguments: Tuple, repeats: int, warmup: int) -> Dict:
+    """
+    Times the calls of a function, then measures its allocations in one more call
+
+    Parameters
+    ----------
+    function: The function
+    arguments: Its arguments
+    repeats: The number of timed calls
+    warmup: The number of untimed calls first
+
+    Returns
+    -------
+    A dictionary with the median and 95th percentile time, the peak and retained allocations, and the output
+    """
+    for _ in range(warmup):
+        function(*arguments)
+
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(*arguments)
+        seconds.append(time.perf_counter() - start)
+
+    # Measure the allocations separately, as tracing them slows the function down. Only allocations made through
+    # Python's allocators (which include numpy's) are traced; OpenCV's own are not
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    output = function(*arguments)
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'median_ms': 1000 * float(np.median(seconds)),
+        'p95_ms': 1000 * float(np.percentile(seconds, 95)),
+        'peak_alloc_kb': (peak - before) / 1024,
+        'retained_alloc_kb': (after - before) / 1024,
+        'output': output
+    }
+
+
+def main(args) -> List[str]:
+    """
+    Benchmarks every implementation of the chosen functions, printing a table and optionally writing JSON
+
+    :param args: The command-line arguments
+
+    :return: A description of every implementation that deviates from the current one beyond its tolerance
+    """
+    cases = get_cases(make_inputs(args.image_size, args.patch_size, args.bank_size, args.seed))
+    names = list(cases) if args.functions is None else [name.strip() for name in args.functions.split(',')]
+    unknown_names = [name for name in names if name not in cases]
+    if unknown_names:
+        sys.exit(f'ERROR: unknown functions {unknown_names}, choose from {list(cases)}')
+
+    results = {'settings': vars(args), 'functions': {}}
+    failures = []
+    print('%-34s %-14s %11s %11s %13s %15s' % ('function', 'implementation', 'median (ms)', 'p95 (ms)',
+                                               'peak (KB)', 'max deviation'))
+    for name in names:
+        case = cases[name]
+        results['functions'][name] = {}
+        reference = None
+        for implementation_name, function in case['implementations'].items():
+            result = benchmark(function, case['arguments'], args.repeats, args.warmup)
+            output = result.pop('output')
+            if reference is None:
+                reference = output
+                result['max_deviation'] = 0.0
+            else:
+                result['max_deviation'] = get_max_deviation(output, reference)
+            result['ok'] = result['max_deviation'] <= case['atol']
+            results['functions'][name][implementation_name] = result
+
+            print('%-34s %-14s %11.4f %11.4f %13.1f %15.3g%s' % (name, implementation_name, result['median_ms'],
+                                                                 result['p95_ms'], result['peak_alloc_kb'],
+                                                                 result['max_deviation'],
+                                                                 '' if result['ok'] else '  FAILED'))
+            if not result['ok']:
+                failures.append(f'{name} ({implementation_name}) deviates by {result["max_deviation"]:.3g} '
+                                f'> {case["atol"]}')
+
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f'\nWrote the micro-benchmark results to {args.output}')
+    return failures
+
+
+if __name__ == '__main__':
+
+    # Get command-line arguments
+    args = parse_args()
+
+    # Run the micro-benchmarks, and exit with an error if an alternative implementation is numerically off
+    failures = main(args)
+    if failures:
+        sys.exit(f'ERROR: {len(failures)} implementations deviate beyond their tolerance: {failures}')
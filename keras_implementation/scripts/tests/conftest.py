@@ -0,0 +1,8 @@
+"""
+Makes the utilities package importable from the tests, as it is from the scripts
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,36 @@
+"""
+Tests of the atomic file writes shared by the caches, queues, and stores
+"""
+
+import os
+import pytest
+from utilities.file_utils import atomic_write
+
+
+def fail(file):
+    file.write('partial')
+    raise RuntimeError('write failed')
+
+
+def test_failed_write_leaves_the_file_and_no_temporary_file(tmp_path):
+    path = str(tmp_path / 'record.json')
+    atomic_write(path, lambda file: file.write('old'))
+
+    with pytest.raises(RuntimeError):
+        atomic_write(path, fail)
+
+    assert os.listdir(str(tmp_path)) == ['record.json']
+    with open(path) as file:
+        assert file.read() == 'old'
+
+
+def test_write_without_overwrite_only_creates_the_file_once(tmp_path):
+    path = str(tmp_path / 'lease')
+    atomic_write(path, lambda file: file.write(b'first'), binary=True, overwrite=False)
+
+    with pytest.raises(FileExistsError):
+        atomic_write(path, lambda file: file.write(b'second'), binary=True, overwrite=False)
+
+    assert os.listdir(str(tmp_path)) == ['lease']
+    with open(path, 'rb') as file:
+        assert file.read() == b'first'
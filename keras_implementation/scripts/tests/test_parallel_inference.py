@@ -0,0 +1,33 @@
+"""
+Tests of how the parallel inference executor shards its work
+"""
+
+from utilities import parallel_inference
+
+
+def test_shard_items_makes_as_many_shards_as_requested():
+    groups = {'subject1': [f'image{index}.png' for index in range(4)]}
+
+    # Every shard gets work, even when the items don't divide evenly
+    shards = parallel_inference.shard_items(groups, num_shards=3)
+    assert [len(items) for _, items in shards] == [1, 1, 2]
+    assert [item for _, items in shards for item in items] == groups['subject1']
+
+    # There are never more shards than items
+    assert len(parallel_inference.shard_items(groups, num_shards=10)) == 4
+
+
+def test_shard_items_never_crosses_a_group_boundary():
+    groups = {'subject1': list(range(10)), 'subject2': list(range(10, 13)), 'empty': []}
+
+    shards = parallel_inference.shard_items(groups, num_shards=8)
+    assert len(shards) == 8
+    assert [(name, len(items)) for name, items in shards] == [('subject1', 1), ('subject1', 2), ('subject1', 2),
+                                                               ('subject1', 1), ('subject1', 2), ('subject1', 2),
+                                                               ('subject2', 1), ('subject2', 2)]
+    for name, items in shards:
+        assert set(items) <= set(groups[name])
+    assert [item for _, items in shards for item in items] == list(range(13))
+
+    # Each non-empty group gets a shard, even if fewer shards were requested
+    assert [name for name, _ in parallel_inference.shard_items(groups, num_shards=1)] == ['subject1', 'subject2']
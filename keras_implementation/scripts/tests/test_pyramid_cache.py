@@ -0,0 +1,22 @@
+"""
+Tests of the pyramid level cache
+"""
+
+import os
+from unittest import mock
+from utilities import phantoms, pyramid_cache
+
+
+def test_each_set_of_scales_has_its_own_cache_entry(tmp_path):
+    train_dir = str(tmp_path / 'train')
+    phantoms.write_phantom_subject(train_dir, (2, 64, 64), seed=0)
+
+    # Training caches 4 levels of every slice pair, then inference's reference bank caches a single level
+    pyramid_cache.build_pyramids([train_dir], scales=[1, 0.9, 0.8, 0.7])
+    pyramid_cache.build_pyramids([train_dir], scales=[1])
+    assert len(os.listdir(os.path.join(train_dir, pyramid_cache.PYRAMID_DIR_NAME, 'pairs'))) == 4
+
+    # Both sets of levels are still cached, so neither is recomputed
+    with mock.patch.object(pyramid_cache.cv2, 'imread', side_effect=AssertionError('levels were recomputed')):
+        assert len(pyramid_cache.get_pair_levels(train_dir, 'image000.png', scales=[1, 0.9, 0.8, 0.7])) == 4
+        assert len(pyramid_cache.get_pair_levels(train_dir, 'image000.png', scales=[1])) == 1
@@ -0,0 +1,83 @@
+"""
+Tests of the shared patch store, with local processes standing in for concurrent training runs
+"""
+
+import os
+import json
+import multiprocessing
+from utilities import phantoms, shared_patch_store
+from utilities.patch_dataset import PatchDataset
+
+
+def load_dataset(shared_dir: str, train_dir: str, output_path: str) -> None:
+    """ Loads the shared dataset in a worker process, and writes a summary of it and of its store to output_path """
+    dataset = shared_patch_store.load_shared_dataset(shared_dir, [train_dir])
+    store_dir = os.path.join(shared_dir, shared_patch_store.get_store_key([train_dir]))
+    with open(output_path, 'w') as file:
+        json.dump({'num_patches': len(dataset), 'x_sum': int(dataset.x.sum()), 'y_sum': int(dataset.y.sum()),
+                   'lock_files': sorted(name for name in os.listdir(store_dir) if name.endswith('.lock')),
+                   'temp_files': sorted(name for name in os.listdir(store_dir) if name.endswith('.tmp'))}, file)
+
+
+def test_concurrent_processes_share_one_published_store(tmp_path):
+    train_dir = str(tmp_path / 'train')
+    shared_dir = str(tmp_path / 'shared')
+    phantoms.write_phantom_subject(train_dir, (4, 96, 96), seed=0)
+
+    context = multiprocessing.get_context('spawn')
+    output_paths = [str(tmp_path / f'worker{index}.json') for index in range(3)]
+    processes = [context.Process(target=load_dataset, args=(shared_dir, train_dir, output_path))
+                 for output_path in output_paths]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=300)
+        assert process.exitcode == 0
+
+    # Every process attached to the same store, which was published once, with the patches of a private build
+    dataset = PatchDataset.from_train_data([train_dir])
+    expected = {'num_patches': len(dataset), 'x_sum': int(dataset.x.sum()), 'y_sum': int(dataset.y.sum()),
+                'lock_files': ['publish.000000.lock'], 'temp_files': []}
+    for output_path in output_paths:
+        with open(output_path) as file:
+            assert json.load(file) == expected
+
+    # The last process to exit deleted the store
+    assert not os.path.exists(os.path.join(shared_dir, shared_patch_store.get_store_key([train_dir])))
+
+
+def test_publish_lock_is_taken_over_from_a_dead_publisher(tmp_path):
+    store = shared_patch_store.SharedPatchStore(str(tmp_path / 'store'))
+    store.acquire()
+
+    # A publisher takes the lock, then dies
+    context = multiprocessing.get_context('spawn')
+    process = context.Process(target=os.getpid)
+    process.start()
+    process.join()
+    with open(os.path.join(store.store_dir, 'publish.000000.lock'), 'w') as file:
+        file.write(str(process.pid))
+
+    # Only one process takes over, with the next generation of the lock, which holds its pid
+    assert store.try_lock()
+    with open(os.path.join(store.store_dir, 'publish.000001.lock')) as file:
+        assert int(file.read()) == os.getpid()
+    assert not shared_patch_store.SharedPatchStore(store.store_dir).try_lock()
+    store.release()
+
+
+def test_store_is_kept_while_another_process_holds_a_reference(tmp_path):
+    store = shared_patch_store.SharedPatchStore(str(tmp_path / 'store'))
+    store.acquire()
+
+    # The parent of this process is alive, and holds a reference too
+    with open(os.path.join(store.refs_dir, str(os.getppid())), 'w'):
+        pass
+    store.release()
+    assert os.path.exists(store.store_dir)
+
+    # Once it has released it, the last reference deletes the store
+    os.remove(os.path.join(store.refs_dir, str(os.getppid())))
+    store.acquire()
+    store.release()
+    assert not os.path.exists(store.store_dir)
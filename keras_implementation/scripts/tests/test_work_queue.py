@@ -0,0 +1,100 @@
+"""
+Tests of the shared-filesystem work queue, with local worker processes standing in for several nodes
+"""
+
+import os
+import time
+import multiprocessing
+from utilities import work_queue
+
+NUM_JOBS = 24
+
+
+def run_worker(queue_dir: str, log_path: str, lease_seconds: float, worker_index: int) -> None:
+    """ Runs queue jobs in a worker process, appending the id of each job it runs to log_path """
+    def run_job(job):
+        with open(log_path, 'a') as file:
+            file.write(f'{job["job_id"]} {worker_index}\n')
+        time.sleep(0.02)
+        return {'job_id': job['job_id']}
+
+    queue = work_queue.WorkQueue(queue_dir, lease_seconds=lease_seconds, worker_id=f'worker{worker_index}')
+    queue.run(run_job, poll_seconds=0.1)
+
+
+def run_workers(queue_dir: str, log_path: str, lease_seconds: float, num_workers: int = 3) -> None:
+    """ Runs num_workers worker processes on the queue until every job is done """
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=run_worker, args=(queue_dir, log_path, lease_seconds, index))
+                 for index in range(num_workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=120)
+        assert process.exitcode == 0
+
+
+def submit_jobs(queue_dir: str, lease_seconds: float) -> work_queue.WorkQueue:
+    queue = work_queue.WorkQueue(queue_dir, lease_seconds=lease_seconds, worker_id='submitter')
+    queue.submit({'%05d' % index: {'job_id': '%05d' % index} for index in range(NUM_JOBS)})
+    return queue
+
+
+def get_run_job_ids(log_path: str):
+    with open(log_path) as file:
+        return sorted(line.split()[0] for line in file)
+
+
+def test_every_job_runs_exactly_once(tmp_path):
+    queue_dir = str(tmp_path / 'queue')
+    log_path = str(tmp_path / 'log.txt')
+    queue = submit_jobs(queue_dir, lease_seconds=60)
+
+    run_workers(queue_dir, log_path, lease_seconds=60)
+
+    assert queue.is_finished()
+    assert get_run_job_ids(log_path) == queue.get_job_ids()
+    assert [queue.get_result(job_id)['job_id'] for job_id in queue.get_job_ids()] == queue.get_job_ids()
+
+
+def test_expired_lease_is_re_leased(tmp_path):
+    queue_dir = str(tmp_path / 'queue')
+    log_path = str(tmp_path / 'log.txt')
+    queue = submit_jobs(queue_dir, lease_seconds=1)
+
+    # A worker claims a few jobs, then dies without running or releasing them
+    dead_queue = work_queue.WorkQueue(queue_dir, lease_seconds=1, worker_id='dead')
+    dead_job_ids = [dead_queue.claim()[0] for _ in range(4)]
+
+    # Until its leases expire, no other worker can claim those jobs
+    live_queue = work_queue.WorkQueue(queue_dir, lease_seconds=1, worker_id='live')
+    claimed_job_id, _ = live_queue.claim()
+    assert claimed_job_id not in dead_job_ids
+    live_queue.release(claimed_job_id)
+
+    # Once they expire, the workers race to reclaim them, and each is run exactly once
+    time.sleep(1.2)
+    run_workers(queue_dir, log_path, lease_seconds=1)
+
+    assert queue.is_finished()
+    assert get_run_job_ids(log_path) == queue.get_job_ids()
+    for job_id in dead_job_ids:
+        assert os.path.exists(os.path.join(queue_dir, 'leases', f'{job_id}.000001.lease'))
+
+
+def test_lease_is_not_claimed_twice(tmp_path):
+    queue_dir = str(tmp_path / 'queue')
+    submit_jobs(queue_dir, lease_seconds=1)
+    first_queue = work_queue.WorkQueue(queue_dir, lease_seconds=1, worker_id='first')
+    second_queue = work_queue.WorkQueue(queue_dir, lease_seconds=1, worker_id='second')
+
+    # Both workers saw the same expired lease, but only the first to claim the next generation gets the job
+    assert first_queue._try_lease('00000', 0)
+    os.utime(os.path.join(queue_dir, 'leases', '00000.000000.lease'), (0, 0))
+    assert first_queue._try_lease('00000', 1)
+    assert not second_queue._try_lease('00000', 1)
+
+    # A worker with a stale view of the leases can't take over the fresh lease of the current generation
+    assert not second_queue._try_lease('00000', 2)
+    assert first_queue.held_leases['00000'].endswith('00000.000001.lease')
+    assert '00000' not in second_queue.held_leases
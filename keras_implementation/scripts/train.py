@@ -4,6 +4,7 @@ Main script used to train HydraNet
 
 from deprecated import deprecated
 import argparse
+import functools
 import os
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'  # Suppress TensorFlow logging (1)
@@ -15,8 +16,9 @@ from tensorflow.keras.models import load_model
 from tensorflow.keras.callbacks import CSVLogger, ModelCheckpoint, LearningRateScheduler, EarlyStopping
 from tensorflow.keras.optimizers import Adam
 import tensorflow.keras.backend as K
-from typing import List
-from utilities import data_generator, logger, model_functions, image_utils
+from typing import List, Tuple, Dict
+from utilities import data_generator, logger, model_functions, image_utils, patch_sampler, patch_dataset, \
+    shared_patch_store, distributed, throughput, memory_profiler, noise_synthesis
 from utilities.data_generator import NoiseLevel
 
 '''GPU Settings for CUDA'''
@@ -57,6 +59,51 @@ parser.add_argument('--clear_data', action='append', default=[], type=str, help=
                                                                                 'when is_cleanup == True')
 parser.add_argument('--blurry_data', action='append', default=[], type=str, help='Blurry data directories (only used '
                                                                                  'when is_cleanup == True')
+parser.add_argument('--online_sampling', default=0, type=int, help='Sample random patches (or 3d bricks) on the fly '
+                                                                   'from the training slices (or volumes) instead of '
+                                                                   'generating every patch up front, 1 for yes or 0 '
+                                                                   'for no')
+parser.add_argument('--synthetic_noise', default=0, type=int, help='Train on pairs synthesized on the fly from the '
+                                                                   'ClearImages of train_data, with noise drawn in '
+                                                                   'the PSNR window of the noise level, instead of '
+                                                                   'the blurry images on disk (e.g. to pretrain), 1 '
+                                                                   'for yes or 0 for no')
+parser.add_argument('--noise_type', default='rician', type=str, help='Noise synthesized when synthetic_noise == 1: '
+                                                                     'rician or gaussian')
+parser.add_argument('--stratified_sampling', default=0, type=int, help='Build one indexed patch dataset and sample '
+                                                                       'each batch from the PSNR window of the noise '
+                                                                       'level, 1 for yes or 0 for no')
+parser.add_argument('--class_mix', default='', type=str, help='Mix of noise level classes in each batch when '
+                                                              'stratified_sampling == 1 and noise_level == all, '
+                                                              'e.g. low:0.2,medium:0.4,high:0.4')
+parser.add_argument('--multi_expert', default=0, type=int, help='Train the low, medium, and high noise experts '
+                                                                'together in this process, from one shared indexed '
+                                                                'patch dataset (ignores noise_level), 1 for yes or 0 '
+                                                                'for no')
+parser.add_argument('--ram_budget_mb', default=0, type=float, help='RAM budget in MB of the uint8 patch store when '
+                                                                   'stratified_sampling == 1. Training stops before '
+                                                                   'loading if the estimated store is larger. If 0, '
+                                                                   'there is no budget')
+parser.add_argument('--shared_store_dir', default='', type=str, help='Directory (e.g. /dev/shm/hydranet) in which the '
+                                                                     'indexed patch dataset is published once and '
+                                                                     'memory-mapped read-only by every concurrent '
+                                                                     'training process on this machine. If empty, '
+                                                                     'each process builds its own')
+parser.add_argument('--distributed', default=0, type=int, help='Train data-parallel with tf.distribute, on the local '
+                                                               'devices, or on every worker of the cluster in '
+                                                               'TF_CONFIG (requires stratified_sampling == 1). Each '
+                                                               'replica trains on batch_size patches, and the learning '
+                                                               'rate is scaled by the number of replicas, 1 for yes or '
+                                                               '0 for no')
+parser.add_argument('--num_local_workers', default=0, type=int, help='When distributed == 1 and TF_CONFIG is not '
+                                                                     'set, launch this many local worker processes as '
+                                                                     'a multi-worker cluster, for testing (requires '
+                                                                     'tf.keras 2). If 0, train in this process')
+parser.add_argument('--memory_profile', default=0, type=int, help='Record the RSS and Python allocations (tracemalloc) '
+                                                                  'of each training stage into memory_profile.csv and '
+                                                                  'memory_profile.json next to log.csv, and estimate '
+                                                                  'the memory needed for --train_data before loading. '
+                                                                  'Slows training down, 1 for yes or 0 for no')
 args = parser.parse_args()
 
 # Set the noise level to decide which model to train
@@ -79,10 +126,15 @@ elif args.is_left_middle_right:
 else:
     save_dir = os.path.join(args.result_dir, args.model + '_' + args.noise_level + '_noise')
 
-# Create the <save_dir> folder if it doesn't exist already
-if not os.path.exists(save_dir):
+# Create the <save_dir> folder if it doesn't exist already (each expert has its own folder when training multi-expert)
+if not os.path.exists(save_dir) and not args.multi_expert:
     os.mkdir(save_dir)
 
+# Profile the memory of each training stage, if requested (a disabled profiler records nothing). Multi-expert training
+# writes its report into result_dir, which holds the folder of every expert
+profiler = memory_profiler.MemoryProfiler(enabled=bool(args.memory_profile),
+                                          report_dir=(args.result_dir or os.curdir) if args.multi_expert else save_dir)
+
 
 def lr_schedule(epoch):
     """
@@ -107,17 +159,21 @@ def lr_schedule(epoch):
     return lr
 
 
-def new_lr_schedule(epoch):
+def new_lr_schedule(epoch, *, lr_multiplier=1.0):
     """
     Learning rate scheduler for tensorflow API
 
     :param epoch: The current epoch
     :type epoch: int
+    :param lr_multiplier: Factor by which to scale the learning rate, e.g. the number of replicas when each step
+        trains on a global batch of that many times batch_size (keyword-only, so that Keras never passes the current
+        learning rate in its place)
+    :type lr_multiplier: float
     :return: The Learning Rate
     :rtype: float
     """
 
-    initial_lr = args.lr
+    initial_lr = args.lr * lr_multiplier
     if epoch <= 20:
         lr = initial_lr
     elif epoch <= 30:
@@ -166,37 +222,37 @@ def my_train_datagen_single_model(epoch_iter: int = 2000,
             print(f'Accessing training data in: {data_dir}')
 
             '''Load training data'''
-            if is_3d:
-                x, y = data_generator.pair_3d_data_generator(data_dir)
-            else:
-                if len(data_dir) == 1:
-                    x, y = data_generator.pair_data_generator(data_dir[0])
-                elif len(data_dir) > 1:
-                    x, y = data_generator.pair_data_generator_multiple_data_dirs(data_dir)
+            with profiler.stage('patch_generation'):
+                if is_3d:
+                    x, y = data_generator.pair_3d_data_generator(data_dir)
+                else:
+                    x, y = data_generator.pair_data_generator(data_dir)
 
-            # Create lists to store all of the clear patches (x) and blurry patches (y)
-            x_filtered = []
-            y_filtered = []
+            with profiler.stage('filtering'):
+                # Create lists to store all of the clear patches (x) and blurry patches (y)
+                x_filtered = []
+                y_filtered = []
 
-            # Iterate over all of the image patches
-            for x_patch, y_patch in zip(x, y):
+                # Iterate over all of the image patches
+                for x_patch, y_patch in zip(x, y):
 
-                # If the patch is black (i.e. the max px value < 10), just skip this training example
-                if np.max(x_patch) < 10:
-                    continue
+                    # If the patch is black (i.e. the max px value < 10), just skip this training example
+                    if np.max(x_patch) < 10:
+                        continue
 
-                # Add x_patch and y_patch to the list
-                x_filtered.append(x_patch)
-                y_filtered.append(y_patch)
+                    # Add x_patch and y_patch to the list
+                    x_filtered.append(x_patch)
+                    y_filtered.append(y_patch)
 
-            # Convert image patches and stds into numpy arrays
-            x_filtered = np.array(x_filtered, dtype='uint8')
-            y_filtered = np.array(y_filtered, dtype='uint8')
+                # Convert image patches and stds into numpy arrays
+                x_filtered = np.array(x_filtered, dtype='uint8')
+                y_filtered = np.array(y_filtered, dtype='uint8')
 
             # Remove elements from x_filtered and y_filtered so thatthey has the right number of patches
-            discard_n = len(x_filtered) - len(y_filtered) // batch_size * batch_size;
-            x_filtered = np.delete(x_filtered, range(discard_n), axis=0)
-            y_filtered = np.delete(y_filtered, range(discard_n), axis=0)
+            with profiler.stage('np.delete'):
+                discard_n = len(x_filtered) - len(y_filtered) // batch_size * batch_size;
+                x_filtered = np.delete(x_filtered, range(discard_n), axis=0)
+                y_filtered = np.delete(y_filtered, range(discard_n), axis=0)
 
             # Assert that the last iteration has a full batch size
             assert len(x_filtered) % args.batch_size == 0, \
@@ -211,8 +267,9 @@ def my_train_datagen_single_model(epoch_iter: int = 2000,
             # Standardize x and y to have a mean of 0 and standard deviation of 1
             # NOTE: x and y px values are centered at 0, meaning there are negative px values. Most libraries have
             # trouble visualizing px that aren't either from [0, 255] or [0, 1], so watch out for that
-            x_filtered, x_orig_mean, x_orig_std = image_utils.standardize(x_filtered)
-            y_filtered, y_orig_mean, y_orig_std = image_utils.standardize(y_filtered)
+            with profiler.stage('standardization'):
+                x_filtered, x_orig_mean, x_orig_std = image_utils.standardize(x_filtered)
+                y_filtered, y_orig_mean, y_orig_std = image_utils.standardize(y_filtered)
 
             '''Just for logging
             # Save the reversed standardization of x and y into variables
@@ -727,32 +784,35 @@ def my_train_datagen_estimated_with_psnr(num_epochs=5,
             '''
 
             # Get our train data
-            x_original, y_original = data_generator.pair_data_generator(data_dir)
+            with profiler.stage('patch_generation'):
+                x_original, y_original = data_generator.pair_data_generator(data_dir)
 
-            x_filtered = []
-            y_filtered = []
+            with profiler.stage('filtering'):
+                x_filtered = []
+                y_filtered = []
 
-            # Iterate over all of the image patches
-            for x_patch, y_patch in zip(x_original, y_original):
-                if np.max(x_patch) < 10:
-                    continue
-                x_patch = x_patch.reshape(x_patch.shape[0], x_patch.shape[1])
-                y_patch = y_patch.reshape(y_patch.shape[0], y_patch.shape[1])
-                psnr = peak_signal_noise_ratio(x_patch, y_patch)
+                # Iterate over all of the image patches
+                for x_patch, y_patch in zip(x_original, y_original):
+                    if np.max(x_patch) < 10:
+                        continue
+                    x_patch = x_patch.reshape(x_patch.shape[0], x_patch.shape[1])
+                    y_patch = y_patch.reshape(y_patch.shape[0], y_patch.shape[1])
+                    psnr = peak_signal_noise_ratio(x_patch, y_patch)
 
-                if low_psnr_threshold < psnr < high_psnr_threshold:
-                    x_filtered.append(x_patch)
-                    y_filtered.append(y_patch)
+                    if low_psnr_threshold < psnr < high_psnr_threshold:
+                        x_filtered.append(x_patch)
+                        y_filtered.append(y_patch)
 
-            # Convert image patches and stds into numpy arrays
-            x_filtered = np.array(x_filtered, dtype='uint8')
-            y_filtered = np.array(y_filtered, dtype='uint8')
+                # Convert image patches and stds into numpy arrays
+                x_filtered = np.array(x_filtered, dtype='uint8')
+                y_filtered = np.array(y_filtered, dtype='uint8')
 
             # Remove elements from x_filtered and y_filtered so that they has the right number of patches
-            discard_n = len(x_filtered) - len(x_filtered) // batch_size * batch_size
-            print(f'discard_n ={discard_n}')
-            x_filtered = np.delete(x_filtered, range(discard_n), axis=0)
-            y_filtered = np.delete(y_filtered, range(discard_n), axis=0)
+            with profiler.stage('np.delete'):
+                discard_n = len(x_filtered) - len(x_filtered) // batch_size * batch_size
+                print(f'discard_n ={discard_n}')
+                x_filtered = np.delete(x_filtered, range(discard_n), axis=0)
+                y_filtered = np.delete(y_filtered, range(discard_n), axis=0)
 
             print(f'The length of x_filtered: {len(x_filtered)}')
             print(f'The length of y_filtered: {len(y_filtered)}')
@@ -769,8 +829,9 @@ def my_train_datagen_estimated_with_psnr(num_epochs=5,
             assert len(x_filtered) == len(y_filtered), logger.log('Make sure x and y are paired up properly!')
 
             # Standardize x and y to have a mean of 0 and standard deviation of 1
-            x, x_orig_mean, x_orig_std = image_utils.standardize(x_filtered)
-            y, y_orig_mean, y_orig_std = image_utils.standardize(y_filtered)
+            with profiler.stage('standardization'):
+                x, x_orig_mean, x_orig_std = image_utils.standardize(x_filtered)
+                y, y_orig_mean, y_orig_std = image_utils.standardize(y_filtered)
 
             # Get a list of indices, from 0 to the total number of training examples
             indices = list(range(x.shape[0]))
@@ -793,6 +854,201 @@ def my_train_datagen_estimated_with_psnr(num_epochs=5,
                 yield batch_y, batch_x
 
 
+def my_train_datagen_online(batch_size: int = 128,
+                            data_dir: List[str] = args.train_data,
+                            low_psnr_threshold: float = None,
+                            high_psnr_threshold: float = None):
+    """
+    Generator function that yields random training batches, sampled on the fly from the training slices.
+    Unlike the other generators, this never materializes the full set of patches, so its memory use scales with the
+    size of the training volumes rather than the number of patches.
+
+    Parameters
+    ----------
+    batch_size: The number of training examples for each training iteration
+    data_dir: The directories in which training examples are stored
+    low_psnr_threshold: The lower PSNR threshold to keep an image patch pair. If None, there is no lower bound
+    high_psnr_threshold: The upper PSNR threshold to keep an image patch pair. If None, there is no upper bound
+
+    Returns
+    -------
+    Yields a training example x and noisy image y
+    """
+    # Make sure we don't have an empty set of data directories
+    if len(data_dir) == 0:
+        sys.exit('ERROR: You didn\'t provide any data directories to train on!')
+
+    print(f'Accessing training data in: {data_dir}')
+
+    # Without a PSNR window, standardize with the statistics of every patch, merged from per-subject statistics
+    standardization = None
+    if low_psnr_threshold is None and high_psnr_threshold is None:
+        standardization = data_generator.get_fold_standardization(data_dir)
+
+    # Load the training slices once
+    sampler = patch_sampler.RandomPatchSampler(data_dir, low_psnr_threshold=low_psnr_threshold,
+                                               high_psnr_threshold=high_psnr_threshold,
+                                               standardization=standardization)
+
+    # Loop the following indefinitely...
+    while True:
+        yield sampler.sample_batch(batch_size)
+
+
+def my_train_datagen_synthetic(batch_size: int = 128,
+                               data_dir: List[str] = args.train_data,
+                               low_psnr_threshold: float = None,
+                               high_psnr_threshold: float = None,
+                               noise_type: str = 'rician'):
+    """
+    Generator function that yields random training batches, whose noisy patches are synthesized on the fly from the
+    clear training slices. Only ClearImages is read, once, so the number of training pairs is unlimited and no longer
+    depends on the blurry images or on storage.
+
+    Parameters
+    ----------
+    batch_size: The number of training examples for each training iteration
+    data_dir: The directories in which the clear training slices are stored
+    low_psnr_threshold: The lower PSNR bound of the synthesized pairs. If None, there is no lower bound
+    high_psnr_threshold: The upper PSNR bound of the synthesized pairs. If None, there is no upper bound
+    noise_type: The noise to synthesize, 'rician' or 'gaussian'
+
+    Returns
+    -------
+    Yields a training example x and noisy image y
+    """
+    # Make sure we don't have an empty set of data directories
+    if len(data_dir) == 0:
+        sys.exit('ERROR: You didn\'t provide any data directories to train on!')
+
+    print(f'Accessing clear training data in: {data_dir}')
+
+    # Load the clear training slices once
+    try:
+        sampler = noise_synthesis.SyntheticPairSampler.from_train_data(data_dir, low_psnr_threshold=low_psnr_threshold,
+                                                                       high_psnr_threshold=high_psnr_threshold,
+                                                                       noise_type=noise_type)
+    except ValueError as error:
+        sys.exit(f'ERROR: {error}')
+
+    # Loop the following indefinitely...
+    yield from sampler.generate_batches(batch_size)
+
+
+def my_train_datagen_3d_online(batch_size: int = 128,
+                               data_dir: List[str] = args.train_data):
+    """
+    Generator function that yields random training batches of 3D bricks, sampled on the fly from the (memory-mapped)
+    training volumes. Unlike pair_3d_data_generator, this never materializes the full set of bricks.
+
+    Parameters
+    ----------
+    batch_size: The number of training examples for each training iteration
+    data_dir: The directories in which training examples are stored
+
+    Returns
+    -------
+    Yields a training example x and noisy image y
+    """
+    # Make sure we don't have an empty set of data directories
+    if len(data_dir) == 0:
+        sys.exit('ERROR: You didn\'t provide any data directories to train on!')
+
+    print(f'Accessing training data in: {data_dir}')
+
+    # Map the training volumes once
+    sampler = patch_sampler.RandomBrickSampler(data_dir)
+
+    # Loop the following indefinitely...
+    while True:
+        yield sampler.sample_batch(batch_size)
+
+
+def load_patch_dataset(data_dir: List[str], ram_budget_mb: float = None) -> patch_dataset.PatchDataset:
+    """
+    Builds the indexed patch dataset of the training data, or, if --shared_store_dir is set, attaches to the copy
+    published there by another training process (publishing it first if there is none)
+
+    Parameters
+    ----------
+    data_dir: The directories in which training examples are stored
+    ram_budget_mb: An optional RAM budget of the patch store in MB. If the estimated store is larger, we exit before
+        loading any patches
+
+    Returns
+    -------
+    A PatchDataset
+    """
+    try:
+        if args.shared_store_dir:
+            return shared_patch_store.load_shared_dataset(args.shared_store_dir, data_dir, ram_budget_mb=ram_budget_mb)
+        with profiler.stage('patch_generation'):
+            return patch_dataset.PatchDataset.from_train_data(data_dir, ram_budget_mb=ram_budget_mb)
+    except MemoryError as error:
+        sys.exit(f'ERROR: {error}. Train on fewer directories, or raise --ram_budget_mb')
+
+
+def estimate_memory() -> None:
+    """
+    Estimates the peak memory of each stage of training on args.train_data with the generator that args select, and
+    reports the estimates alongside the measured peaks of the memory profile
+
+    Returns
+    -------
+    None
+    """
+    if args.synthetic_noise or args.online_sampling or args.is_3d or args.is_cleanup or args.is_left_middle_right:
+        print('No memory estimate is available for this kind of training')
+        return
+    if args.stratified_sampling or args.multi_expert or args.distributed:
+        generator = 'stratified'
+    elif noise_level == NoiseLevel.ALL:
+        generator = 'single_model'
+    else:
+        generator = 'psnr_window'
+    profiler.set_estimates(memory_profiler.estimate_train_memory_mb(args.train_data, generator=generator))
+    print(f'Estimated memory of training on {args.train_data}:')
+    print(profiler.get_table())
+
+
+def my_train_datagen_stratified(batch_size: int = 128,
+                                data_dir: List[str] = args.train_data,
+                                psnr_range: Tuple[float, float] = None,
+                                class_mix: Dict[str, float] = None,
+                                ram_budget_mb: float = None):
+    """
+    Generator function that yields training batches from an indexed patch dataset, either from a PSNR range or with a
+    mix of noise level classes. The dataset is built once, and each batch is selected by index lookup.
+
+    Only the uint8 patch store is kept in memory; each batch is standardized on its own with the precomputed mean and
+    standard deviation of the sampled patches.
+
+    Parameters
+    ----------
+    batch_size: The number of training examples for each training iteration
+    data_dir: The directories in which training examples are stored
+    psnr_range: An optional (low, high) PSNR window of the patches to sample
+    class_mix: An optional dictionary from noise level ('low', 'medium', or 'high') to its fraction of each batch
+    ram_budget_mb: An optional RAM budget of the patch store in MB. If the estimated store is larger, we exit before
+        loading any patches
+
+    Returns
+    -------
+    Yields a training example x and noisy image y
+    """
+    # Make sure we don't have an empty set of data directories
+    if len(data_dir) == 0:
+        sys.exit('ERROR: You didn\'t provide any data directories to train on!')
+
+    # Build the indexed dataset once
+    dataset = load_patch_dataset(data_dir, ram_budget_mb=ram_budget_mb)
+    sampler = patch_dataset.StratifiedBatchSampler(dataset, batch_size=batch_size, metric_range=psnr_range,
+                                                   class_mix=class_mix)
+
+    # Loop the following indefinitely...
+    yield from sampler
+
+
 def sum_squared_error(y_true, y_pred):
     """
     Returns sum-squared error between y_true and y_pred.
@@ -809,27 +1065,50 @@ def sum_squared_error(y_true, y_pred):
     return K.sum(K.square(y_pred - y_true)) / 2
 
 
-def get_callbacks():
+def get_callbacks(model_save_dir: str = None, lr_multiplier: float = 1.0, is_chief: bool = True,
+                  timed_generator: throughput.TimedGenerator = None):
     """
     Creates a list of callbacks for the Model Training process.
     This is the new list of callbacks used for MyDenoiser
 
+    :param model_save_dir: The directory of the model's checkpoints and log.csv. If None, save_dir is used
+    :type model_save_dir: str
+    :param lr_multiplier: Factor by which to scale the learning rate schedule
+    :type lr_multiplier: float
+    :param is_chief: False for the workers of a distributed run other than the chief, which neither save checkpoints
+        nor log
+    :type is_chief: bool
+    :param timed_generator: The TimedGenerator the model is trained on, if any. Its data-wait time, the compute time,
+        samples per second, and peak RSS are then logged to throughput.csv and throughput_steps.csv next to log.csv
+    :type timed_generator: throughput.TimedGenerator
+
     :return: List of callbacks
     :rtype: list
     """
+    if model_save_dir is None:
+        model_save_dir = save_dir
 
     # noinspection PyListCreation
     callbacks = []
 
-    # Add checkpoints every <save_every> # of iterations
-    callbacks.append(ModelCheckpoint(os.path.join(save_dir, 'model_{epoch:03d}.hdf5'),
-                                     verbose=1, save_weights_only=False, period=args.save_every))
+    if is_chief:
+        # Add checkpoints every <save_every> # of iterations
+        callbacks.append(ModelCheckpoint(os.path.join(model_save_dir, 'model_{epoch:03d}.hdf5'),
+                                         verbose=1, save_weights_only=False, period=args.save_every))
 
-    # Add the ability to log training information to <save_dir>/log.csv
-    callbacks.append(CSVLogger(os.path.join(save_dir, 'log.csv'), append=True, separator=','))
+        # Add the ability to log training information to <save_dir>/log.csv
+        callbacks.append(CSVLogger(os.path.join(model_save_dir, 'log.csv'), append=True, separator=','))
 
     # Add a Learning Rate Scheduler to dynamically change the learning rate over time
-    callbacks.append(LearningRateScheduler(new_lr_schedule))
+    callbacks.append(LearningRateScheduler(functools.partial(new_lr_schedule, lr_multiplier=lr_multiplier)))
+
+    # Add throughput logging, to tell whether the input pipeline or the model bounds each epoch
+    if timed_generator is not None and is_chief:
+        callbacks.append(throughput.ThroughputCallback(timed_generator, model_save_dir))
+
+    # Record the memory of the training loop, if we are profiling memory
+    if profiler.enabled and is_chief:
+        callbacks.append(memory_profiler.MemoryProfileCallback(profiler))
 
     # Add Early Stopping so that we stop training once val_loss stops decreasing after <patience> # of epochs
     # callbacks.append(EarlyStopping(monitor='val_loss', mode='min', verbose=1, patience=3))
@@ -837,15 +1116,19 @@ def get_callbacks():
     return callbacks
 
 
-def train():
+def load_or_create_model(model_save_dir: str):
     """
-    Creates and trains the MyDenoiser Keras model.
-    If no checkpoints exist, we will start from scratch.
-    Otherwise, training will resume from previous checkpoints.
+    Creates the Keras model selected by args.model, or loads its last checkpoint from model_save_dir if one exists,
+    and compiles it
+
+    Parameters
+    ----------
+    model_save_dir: The directory of the model's checkpoints
 
     Returns
     -------
-    None
+    A tuple containing: 1. The compiled model
+                        2. The epoch to resume training from
     """
 
     # Select the type of model to use
@@ -860,52 +1143,194 @@ def train():
     model.summary()
 
     # Load the last model
-    initial_epoch = model_functions.findLastCheckpoint(save_dir=save_dir)
+    initial_epoch = model_functions.findLastCheckpoint(save_dir=model_save_dir)
     if initial_epoch > 0:
         print('resuming by loading epoch %03d' % initial_epoch)
-        model = load_model(os.path.join(save_dir, 'model_%03d.hdf5' % initial_epoch), compile=False)
+        model = load_model(os.path.join(model_save_dir, 'model_%03d.hdf5' % initial_epoch), compile=False)
 
     # Compile the model
     model.compile(optimizer=Adam(0.001), loss=sum_squared_error)
 
+    return model, initial_epoch
+
+
+def train():
+    """
+    Creates and trains the MyDenoiser Keras model.
+    If no checkpoints exist, we will start from scratch.
+    Otherwise, training will resume from previous checkpoints.
+
+    Returns
+    -------
+    None
+    """
+
+    # Create the model, or load its last checkpoint
+    model, initial_epoch = load_or_create_model(save_dir)
+
+    # Get the PSNR window of the noise level
     if noise_level == NoiseLevel.ALL:
+        low_psnr_threshold, high_psnr_threshold = (None, None)
+    else:
+        low_psnr_threshold, high_psnr_threshold = patch_dataset.NOISE_LEVEL_PSNR_WINDOWS[args.noise_level]
+
+    if args.synthetic_noise:
+        # Train the model on pairs synthesized from the clear slices
+        train_datagen = my_train_datagen_synthetic(batch_size=args.batch_size,
+                                                   data_dir=args.train_data,
+                                                   low_psnr_threshold=low_psnr_threshold,
+                                                   high_psnr_threshold=high_psnr_threshold,
+                                                   noise_type=args.noise_type)
+    elif args.online_sampling:
+        # Train the model on patches sampled on the fly
+        train_datagen = my_train_datagen_online(batch_size=args.batch_size,
+                                                data_dir=args.train_data,
+                                                low_psnr_threshold=low_psnr_threshold,
+                                                high_psnr_threshold=high_psnr_threshold)
+    elif args.stratified_sampling:
+        # Get the mix of noise level classes in each batch, e.g. 'low:0.2,medium:0.4,high:0.4'
+        class_mix = None
+        if noise_level == NoiseLevel.ALL and args.class_mix:
+            class_mix = {name: float(fraction) for name, fraction in
+                         (item.split(':') for item in args.class_mix.split(','))}
+
+        # Train the model on batches sampled from the indexed dataset
+        train_datagen = my_train_datagen_stratified(batch_size=args.batch_size,
+                                                    data_dir=args.train_data,
+                                                    psnr_range=(low_psnr_threshold, high_psnr_threshold),
+                                                    class_mix=class_mix,
+                                                    ram_budget_mb=args.ram_budget_mb or None)
+    elif noise_level == NoiseLevel.ALL:
         # Train the model on all noise levels
-        history = model.fit(my_train_datagen_single_model(batch_size=args.batch_size,
-                                                          data_dir=args.train_data),
-                            steps_per_epoch=2000,
-                            epochs=args.epoch,
-                            initial_epoch=initial_epoch,
-                            callbacks=get_callbacks())
-    elif noise_level == NoiseLevel.LOW:
-        # Train the model on the individual noise level
-        history = model.fit(my_train_datagen_estimated_with_psnr(batch_size=args.batch_size,
-                                                                 data_dir=args.train_data,
-                                                                 low_psnr_threshold=30.0,
-                                                                 high_psnr_threshold=100.0),
-                            steps_per_epoch=2000,
-                            epochs=args.epoch,
-                            initial_epoch=initial_epoch,
-                            callbacks=get_callbacks())
-    elif noise_level == NoiseLevel.MEDIUM:
-        # Train the model on the individual noise level
-        history = model.fit(my_train_datagen_estimated_with_psnr(batch_size=args.batch_size,
-                                                                 data_dir=args.train_data,
-                                                                 low_psnr_threshold=15.0,
-                                                                 high_psnr_threshold=40.0),
-                            steps_per_epoch=2000,
-                            epochs=args.epoch,
-                            initial_epoch=initial_epoch,
-                            callbacks=get_callbacks())
-    elif noise_level == NoiseLevel.HIGH:
+        train_datagen = my_train_datagen_single_model(batch_size=args.batch_size, data_dir=args.train_data)
+    else:
         # Train the model on the individual noise level
-        history = model.fit(my_train_datagen_estimated_with_psnr(batch_size=args.batch_size,
-                                                                 data_dir=args.train_data,
-                                                                 low_psnr_threshold=0.0,
-                                                                 high_psnr_threshold=30.0),
-                            steps_per_epoch=2000,
-                            epochs=args.epoch,
-                            initial_epoch=initial_epoch,
-                            callbacks=get_callbacks())
+        train_datagen = my_train_datagen_estimated_with_psnr(batch_size=args.batch_size,
+                                                             data_dir=args.train_data,
+                                                             low_psnr_threshold=low_psnr_threshold,
+                                                             high_psnr_threshold=high_psnr_threshold)
+
+    # Time the generator, to tell whether the input pipeline or the model bounds each epoch
+    train_datagen = throughput.TimedGenerator(train_datagen)
+    history = model.fit(iter(train_datagen),
+                        steps_per_epoch=2000,
+                        epochs=args.epoch,
+                        initial_epoch=initial_epoch,
+                        callbacks=get_callbacks(timed_generator=train_datagen))
+
+
+def train_experts():
+    """
+    Creates and trains the low, medium, and high noise MyDenoiser experts together, in this process.
+    The indexed patch dataset is built once and shared by the experts, each of which samples its batches from the
+    patches in its own PSNR window. Each expert keeps its own checkpoints and log.csv in
+    <result_dir>/<model>_<noise level>_noise, and resumes from its own last checkpoint.
+
+    Returns
+    -------
+    None
+    """
+    # Make sure we don't have an empty set of data directories
+    if len(args.train_data) == 0:
+        sys.exit('ERROR: You didn\'t provide any data directories to train on!')
+
+    # Build the indexed dataset once, for every expert
+    dataset = load_patch_dataset(args.train_data, ram_budget_mb=args.ram_budget_mb or None)
+
+    # Create (or load) each expert, with its own batch sampler and callbacks
+    experts = {}
+    for expert_noise_level, psnr_window in patch_dataset.NOISE_LEVEL_PSNR_WINDOWS.items():
+        expert_save_dir = os.path.join(args.result_dir, args.model + '_' + expert_noise_level + '_noise')
+        if not os.path.exists(expert_save_dir):
+            os.mkdir(expert_save_dir)
+        model, initial_epoch = load_or_create_model(expert_save_dir)
+        sampler = patch_dataset.StratifiedBatchSampler(dataset, batch_size=args.batch_size, metric_range=psnr_window)
+        timed_sampler = throughput.TimedGenerator(sampler)
+        experts[expert_noise_level] = {'model': model, 'initial_epoch': initial_epoch, 'batches': iter(timed_sampler),
+                                       'callbacks': get_callbacks(expert_save_dir, timed_generator=timed_sampler)}
+
+    # Train the experts in turns, one epoch at a time, so that they progress together and a crash loses at most one
+    # epoch of each
+    first_epoch = min(expert['initial_epoch'] for expert in experts.values())
+    for epoch in range(first_epoch, args.epoch):
+        for expert_noise_level, expert in experts.items():
+            if epoch < expert['initial_epoch']:
+                continue
+            print(f'Training the {expert_noise_level} noise expert')
+            expert['model'].fit(expert['batches'],
+                                steps_per_epoch=2000,
+                                epochs=epoch + 1,
+                                initial_epoch=epoch,
+                                callbacks=expert['callbacks'])
+
+
+def train_distributed():
+    """
+    Creates and trains the MyDenoiser Keras model data-parallel, with a MirroredStrategy over the local devices, or a
+    MultiWorkerMirroredStrategy over the workers in TF_CONFIG.
+
+    Each worker builds (or attaches to, with --shared_store_dir) the indexed patch dataset, and each of its input
+    pipelines samples batch_size patches per replica from its own shard. Every step then trains on a global batch of
+    batch_size * <number of replicas> patches, so an epoch takes proportionally fewer steps, and the learning rate is
+    scaled by the number of replicas. Only the chief saves checkpoints and log.csv, and every worker resumes from them.
+
+    Returns
+    -------
+    None
+    """
+    # Make sure we don't have an empty set of data directories
+    if len(args.train_data) == 0:
+        sys.exit('ERROR: You didn\'t provide any data directories to train on!')
+    if not args.stratified_sampling:
+        sys.exit('ERROR: Distributed training samples each worker\'s shard of the indexed patch dataset. '
+                 'Set --stratified_sampling=1')
+
+    try:
+        distributed.check_multi_worker_support(distributed.get_num_workers())
+    except RuntimeError as error:
+        sys.exit(f'ERROR: {error}')
+
+    strategy = distributed.get_strategy()
+    num_replicas = strategy.num_replicas_in_sync
+    is_chief = distributed.is_chief(strategy)
+    print(f'Training on {num_replicas} replicas, with a global batch of {args.batch_size * num_replicas} patches')
+
+    # Create the model, or load its last checkpoint, with its variables mirrored on every replica
+    with strategy.scope():
+        model, initial_epoch = load_or_create_model(save_dir)
+
+    # Get the PSNR window of the noise level, or the mix of noise level classes in each batch
+    class_mix = None
+    if noise_level == NoiseLevel.ALL:
+        psnr_range = None
+        if args.class_mix:
+            class_mix = {name: float(fraction) for name, fraction in
+                         (item.split(':') for item in args.class_mix.split(','))}
+    else:
+        psnr_range = patch_dataset.NOISE_LEVEL_PSNR_WINDOWS[args.noise_level]
+
+    # Build the indexed dataset once per worker
+    dataset = load_patch_dataset(args.train_data, ram_budget_mb=args.ram_budget_mb or None)
+
+    def get_input_pipeline(input_context: tf.distribute.InputContext) -> tf.data.Dataset:
+        # Sample this input pipeline's shard of the dataset, one replica's batch at a time
+        sampler = patch_dataset.StratifiedBatchSampler(dataset,
+                                                       batch_size=input_context.get_per_replica_batch_size(
+                                                           args.batch_size * num_replicas),
+                                                       metric_range=psnr_range, class_mix=class_mix,
+                                                       shard_index=input_context.input_pipeline_id,
+                                                       num_shards=input_context.num_input_pipelines)
+        patch_shape = (None,) + dataset.x.shape[1:]
+        return tf.data.Dataset.from_generator(lambda: iter(sampler), output_types=(tf.float32, tf.float32),
+                                              output_shapes=(patch_shape, patch_shape)) \
+            .prefetch(tf.data.experimental.AUTOTUNE)
+
+    # Train the model, on as many patches per epoch as a single-device run
+    history = model.fit(distributed.distribute_datasets_from_function(strategy, get_input_pipeline),
+                        steps_per_epoch=max(1, 2000 // num_replicas),
+                        epochs=args.epoch,
+                        initial_epoch=initial_epoch,
+                        callbacks=get_callbacks(lr_multiplier=num_replicas, is_chief=is_chief))
 
 
 def train_left_middle_right():
@@ -997,12 +1422,17 @@ def train_3d():
     model.compile(optimizer=Adam(0.001), loss=sum_squared_error)
 
     '''Train model'''
-    history = model.fit(my_train_datagen_single_model(batch_size=args.batch_size,
-                                                      data_dir=args.train_data, is_3d=True),
+    if args.online_sampling:
+        # Sample random bricks on the fly, at constant memory
+        train_datagen = my_train_datagen_3d_online(batch_size=args.batch_size, data_dir=args.train_data)
+    else:
+        train_datagen = my_train_datagen_single_model(batch_size=args.batch_size, data_dir=args.train_data, is_3d=True)
+    train_datagen = throughput.TimedGenerator(train_datagen)
+    history = model.fit(iter(train_datagen),
                         steps_per_epoch=2000,
                         epochs=args.epoch,
                         initial_epoch=initial_epoch,
-                        callbacks=get_callbacks())
+                        callbacks=get_callbacks(timed_generator=train_datagen))
 
 
 def train_cleanup_model():
@@ -1027,15 +1457,21 @@ def train_cleanup_model():
     model.compile(optimizer=Adam(0.001), loss=sum_squared_error)
 
     '''Train model'''
-    history = model.fit(my_cleanup_train_datagen(batch_size=args.batch_size,
-                                                 clear_data=args.clear_data, blurry_data=args.blurry_data),
+    train_datagen = throughput.TimedGenerator(my_cleanup_train_datagen(batch_size=args.batch_size,
+                                                                       clear_data=args.clear_data,
+                                                                       blurry_data=args.blurry_data))
+    history = model.fit(iter(train_datagen),
                         steps_per_epoch=2000,
                         epochs=args.epoch,
                         initial_epoch=initial_epoch,
-                        callbacks=get_callbacks())
+                        callbacks=get_callbacks(timed_generator=train_datagen))
 
 
 if __name__ == '__main__':
+    # Estimate the memory needed to train on --train_data, before loading anything, if we are profiling memory
+    if profiler.enabled and args.train_data:
+        estimate_memory()
+
     # Run the main function
     if args.is_3d:
         train_3d()
@@ -1043,5 +1479,14 @@ if __name__ == '__main__':
         train_left_middle_right()
     elif args.is_cleanup:
         train_cleanup_model()
+    elif args.multi_expert:
+        train_experts()
+    elif args.distributed and args.num_local_workers > 0 and 'TF_CONFIG' not in os.environ:
+        try:
+            sys.exit(distributed.launch_local_workers(args.num_local_workers))
+        except RuntimeError as error:
+            sys.exit(f'ERROR: {error}')
+    elif args.distributed:
+        train_distributed()
     else:
         train()
@@ -3,9 +3,11 @@ import cv2
 import numpy as np
 from enum import Enum
 import os
+import json
+import hashlib
 from os.path import join
-from typing import List, Tuple, Dict
-from utilities import image_utils
+from typing import List, Tuple, Dict, Union
+from utilities import image_utils, streaming_stats, pyramid_cache
 from skimage.metrics import peak_signal_noise_ratio, structural_similarity
 from scipy.ndimage import zoom
 import re
@@ -122,6 +124,75 @@ def data_aug(image, mode=0):
         return np.flipud(np.rot90(image, k=3))
 
 
+def _data_aug_group(patches: np.ndarray, mode: int, inverse: bool = False) -> np.ndarray:
+    """
+    Applies one of data_aug's augmentations (or its inverse) to a whole batch of patches at once
+
+    Parameters
+    ----------
+    patches: A batch of patches -> (N, p, p) or (N, p, p, channels)
+    mode: The augmentation to perform, as in data_aug. Mode m rotates by (m // 2) * 90 degrees, then flips
+        upside-down if m is odd
+    inverse: True if we wish to undo the augmentation instead
+
+    Returns
+    -------
+    The augmented batch of patches
+    """
+    k = mode // 2
+    if not inverse:
+        patches = np.rot90(patches, k=k, axes=(1, 2))
+        return np.flip(patches, axis=1) if mode % 2 else patches
+    patches = np.flip(patches, axis=1) if mode % 2 else patches
+    return np.rot90(patches, k=-k, axes=(1, 2))
+
+
+def data_aug_batch(patches: np.ndarray, modes: np.ndarray, inverse: bool = False) -> np.ndarray:
+    """
+    Vectorized version of data_aug, augmenting every patch of a batch with its own mode. Patches are grouped by mode,
+    so each of the (at most) 8 augmentations is a single rot90/flip over the whole group, rather than a Python call
+    per patch.
+
+    Parameters
+    ----------
+    patches: A batch of square patches -> (N, p, p) or (N, p, p, channels)
+    modes: The augmentation to perform on each patch, as in data_aug -> (N,)
+    inverse: True if we wish to undo the augmentations instead (e.g. to map predictions on augmented patches back)
+
+    Returns
+    -------
+    A new array of augmented patches, with the same shape and dtype as patches
+    """
+    patches = np.asarray(patches)
+    modes = np.asarray(modes)
+    augmented_patches = np.empty_like(patches)
+    for mode in np.unique(modes):
+        group = modes == mode
+        augmented_patches[group] = _data_aug_group(patches[group], int(mode), inverse=inverse)
+    return augmented_patches
+
+
+def tf_data_aug(*patches):
+    """
+    tf.data version of data_aug, to be used as a Dataset map over unbatched elements, e.g.
+    dataset.map(tf_data_aug, num_parallel_calls=tf.data.AUTOTUNE). A single random mode is drawn per element and
+    applied to every patch of the element, so (blurry, clear) pairs stay aligned.
+
+    :param patches: One or more patches of the same element -> (p, p, channels)
+
+    :return: The augmented patch, or a tuple of augmented patches
+    """
+    import tensorflow as tf
+
+    mode = tf.random.uniform([], minval=0, maxval=8, dtype=tf.int32)
+    augmented_patches = []
+    for patch in patches:
+        patch = tf.image.rot90(patch, k=mode // 2)
+        patch = tf.cond(mode % 2 == 1, lambda: tf.image.flip_up_down(patch), lambda: patch)
+        augmented_patches.append(patch)
+    return augmented_patches[0] if len(augmented_patches) == 1 else tuple(augmented_patches)
+
+
 def generate_patches_from_file_name(file_name: str, patch_size: int = 40, stride: int = 10,
                                     scales: List[float] = [1, 0.9, 0.8, 0.7]):
     """
@@ -183,7 +254,8 @@ def generate_patches_from_file_name(file_name: str, patch_size: int = 40, stride
 
 
 def generate_3d_patch_pairs(clear_volume: np.ndarray, blurry_volume: np.ndarray, patch_size: Tuple[int, int, int] = 40,
-                            stride: int = 10, scales: List[float] = [1., 0.9, 0.8, 0.7]) -> Tuple[List, List]:
+                            stride: int = 10, scales: List[float] = [1., 0.9, 0.8, 0.7],
+                            levels: List[Tuple[np.ndarray, np.ndarray]] = None) -> Tuple[List, List]:
     """
     Generates lists of image patch volume pairs from a set of 3d image volumes
     (Not a generator)
@@ -197,6 +269,8 @@ def generate_3d_patch_pairs(clear_volume: np.ndarray, blurry_volume: np.ndarray,
         TODO: Make sure we're sticking with that!
     stride: The stride with which to sample the patch volume window
     scales: A list of scales at which we want to create image patch volumes.
+    levels: Optional precomputed (clear, blurry) volumes at each scale, from pyramid_cache.get_volume_levels. If given,
+        the volumes are not rescaled again
 
     Returns
     -------
@@ -214,13 +288,16 @@ def generate_3d_patch_pairs(clear_volume: np.ndarray, blurry_volume: np.ndarray,
     blurry_patches = []
 
     # For each scale
-    for scale in scales:
+    for n, scale in enumerate(scales):
         # Get the scaled depth, height and width TODO: Make sure we're sticking with (depth, height, width)
         depth_scaled, height_scaled, width_scaled = int(depth * scale), int(height * scale), int(width * scale)
 
-        # Rescale the images TODO: Make sure we're sticking with (depth, height, width)
-        clear_volume_scaled = zoom(clear_volume, (scale, scale, scale))
-        blurry_volume_scaled = zoom(blurry_volume, (scale, scale, scale))
+        # Rescale the images (unless the levels are precomputed) TODO: Make sure we're sticking with (depth, height, width)
+        if levels is not None:
+            clear_volume_scaled, blurry_volume_scaled = levels[n]
+        else:
+            clear_volume_scaled = zoom(clear_volume, (scale, scale, scale))
+            blurry_volume_scaled = zoom(blurry_volume, (scale, scale, scale))
 
         # Extract patches TODO: Make sure we're sticking with (depth, height, width)
         for i in range(0, depth_scaled - patch_size[0] + 1, stride):
@@ -238,7 +315,7 @@ def generate_3d_patch_pairs(clear_volume: np.ndarray, blurry_volume: np.ndarray,
 
 
 def generate_patch_pairs(clear_image: np.ndarray, blurry_image: np.ndarray, patch_size: int = 40, stride: int = 10,
-                         scales: List[float] = [1, 0.9, 0.8, 0.7]):
+                         scales: List[float] = [1, 0.9, 0.8, 0.7], levels: List[Tuple[np.ndarray, np.ndarray]] = None):
     """
     Generates and returns a list of image patches from an input image
 
@@ -253,6 +330,9 @@ def generate_patch_pairs(clear_image: np.ndarray, blurry_image: np.ndarray, patc
     :param scales: A list of scales at which we want to create image patches.
         If None, this function simply performs no rescaling of the image to create patches
     :type scales: List
+    :param levels: Optional precomputed (clear, blurry) images at each scale, from pyramid_cache.get_pair_levels.
+        If given, the images are not rescaled again
+    :type levels: List
 
     :return: (clear_patches, blurry_patches): A tuple of a list of ImagePatches.
                 Each ImagePatch in the list of ImagePatches contains an image patch and the standard deviation
@@ -260,11 +340,16 @@ def generate_patch_pairs(clear_image: np.ndarray, blurry_image: np.ndarray, patc
     :rtype: tuple
     """
 
-    # Make sure clear_image and blurry_image share the same shape
-    assert (clear_image.shape == blurry_image.shape)
+    if levels is None:
+        # Make sure clear_image and blurry_image share the same shape
+        assert (clear_image.shape == blurry_image.shape)
 
-    # Get the height and width of the image
-    height, width = clear_image.shape
+        # Get the height and width of the image
+        height, width = clear_image.shape
+    elif scales is None:
+        # Get the unscaled images and their height and width from the only level
+        clear_image, blurry_image = levels[0]
+        height, width = clear_image.shape
 
     # Store the patches in a list
     clear_patches = []
@@ -286,14 +371,17 @@ def generate_patch_pairs(clear_image: np.ndarray, blurry_image: np.ndarray, patc
 
     else:
         # For each scale
-        for scale in scales:
-
-            # Get the scaled height and width
-            height_scaled, width_scaled = int(height * scale), int(width * scale)
-
-            # Rescale the images
-            clear_image_scaled = cv2.resize(clear_image, (height_scaled, width_scaled), interpolation=cv2.INTER_CUBIC)
-            blurry_image_scaled = cv2.resize(blurry_image, (height_scaled, width_scaled), interpolation=cv2.INTER_CUBIC)
+        for n, scale in enumerate(scales):
+
+            # Rescale the images (unless the levels are precomputed), and get the scaled height and width
+            if levels is not None:
+                clear_image_scaled, blurry_image_scaled = levels[n]
+                # cv2.resize takes (width, height), so each level has the shape (width_scaled, height_scaled)
+                width_scaled, height_scaled = clear_image_scaled.shape
+            else:
+                height_scaled, width_scaled = int(height * scale), int(width * scale)
+                clear_image_scaled = pyramid_cache.resize_image(clear_image, scale)
+                blurry_image_scaled = pyramid_cache.resize_image(blurry_image, scale)
 
             # Extract patches
             for i in range(0, height_scaled - patch_size + 1, stride):
@@ -310,7 +398,7 @@ def generate_patch_pairs(clear_image: np.ndarray, blurry_image: np.ndarray, patc
 
 
 def generate_augmented_patches(image: np.ndarray, patch_size: int = 40, stride: int = 10,
-                               scales: List[float] = [1, 0.9, 0.8, 0.7]):
+                               scales: List[float] = [1, 0.9, 0.8, 0.7], levels: List[np.ndarray] = None):
     """
     Generates and returns a list of image patches from an input file_name,
     adding a random augmentation to each patch (flip, rotate, etc.)
@@ -323,6 +411,9 @@ def generate_augmented_patches(image: np.ndarray, patch_size: int = 40, stride:
     :param scales: A list of scales at which we want to create image patches.
         If None, this function simply performs no rescaling of the image to create patches
     :type scales: List
+    :param levels: Optional precomputed images at each scale, from pyramid_cache.get_image_levels.
+        If given, the image is not rescaled again
+    :type levels: List
 
     :return: patches: A list of image patches
     """
@@ -334,25 +425,26 @@ def generate_augmented_patches(image: np.ndarray, patch_size: int = 40, stride:
     patches = []
 
     # For each scale
-    for scale in scales:
+    for n, scale in enumerate(scales):
 
         # Get the scaled height and width
         height_scaled, width_scaled = int(height * scale), int(width * scale)
 
-        # Rescale the image
-        image_scaled = cv2.resize(image, (height_scaled, width_scaled), interpolation=cv2.INTER_CUBIC)
+        # Rescale the image (unless the levels are precomputed)
+        image_scaled = levels[n] if levels is not None else pyramid_cache.resize_image(image, scale)
 
-        # Extract patches
+        # Extract patches, repeating each one aug_times
         for i in range(0, height_scaled - patch_size + 1, stride):
             for j in range(0, width_scaled - patch_size + 1, stride):
                 patch = image_scaled[i:i + patch_size, j:j + patch_size]
-
-                # Augment the patch x before adding it to the list of patches
                 for k in range(0, aug_times):
-                    patch_aug = data_aug(patch, mode=np.random.randint(0, 8))
-                    patches.append(patch_aug)
+                    patches.append(patch)
 
-    return patches
+    # Augment all of the patches at once
+    if not patches:
+        return patches
+    patches = np.array(patches)
+    return list(data_aug_batch(patches, np.random.randint(0, 8, size=len(patches))))
 
 
 def get_residual_std(clear_patch, blurry_patch):
@@ -370,6 +462,29 @@ def get_residual_std(clear_patch, blurry_patch):
     return np.std(residual)
 
 
+def get_patch_psnrs(clear_patches: np.ndarray, blurry_patches: np.ndarray, chunk_size: int = 256) -> np.ndarray:
+    """
+    Gets the PSNR of each patch pair, as skimage's peak_signal_noise_ratio does for uint8 images
+
+    Parameters
+    ----------
+    clear_patches: The clear patches, as a uint8 array of shape (num_patches, ...)
+    blurry_patches: The blurry patches, as a uint8 array of the same shape
+    chunk_size: The number of patches to process at a time
+
+    Returns
+    -------
+    A float64 array of PSNRs, which are inf for identical patch pairs
+    """
+    mse = np.empty(len(clear_patches), dtype='float64')
+    for start in range(0, len(clear_patches), chunk_size):
+        residuals = clear_patches[start:start + chunk_size].astype('float64') - \
+                    blurry_patches[start:start + chunk_size].astype('float64')
+        mse[start:start + chunk_size] = np.mean(np.square(residuals).reshape(len(residuals), -1), axis=1)
+    with np.errstate(divide='ignore'):
+        return 10 * np.log10((255 ** 2) / mse)
+
+
 def generate_augmented_patches_from_file_name(file_name):
     """
     Generates and returns a list of image patches from an input file_name,
@@ -384,8 +499,8 @@ def generate_augmented_patches_from_file_name(file_name):
     # Read the image as grayscale
     image = cv2.imread(file_name, 0)
 
-    # Generate a return a list of augmented patches from the image
-    return generate_augmented_patches(image)
+    # Generate a return a list of augmented patches from the image, using its cached pyramid levels
+    return generate_augmented_patches(image, levels=pyramid_cache.get_image_levels(file_name))
 
 
 def separate_images_and_stds(patches_and_stds):
@@ -410,20 +525,21 @@ def gen_patches(file_name, scales=[1, 0.9, 0.8, 0.7], patch_size=40, stride=10):
     img = cv2.imread(file_name, 0)  # gray scale
     h, w = img.shape
     patches = []
-    for s in scales:
+    # get the rescaled images from the pyramid cache
+    for s, img_scaled in zip(scales, pyramid_cache.get_image_levels(file_name, scales=scales)):
         h_scaled, w_scaled = int(h * s), int(w * s)
-        img_scaled = cv2.resize(img, (h_scaled, w_scaled), interpolation=cv2.INTER_CUBIC)
         # extract patches
         for i in range(0, h_scaled - patch_size + 1, stride):
             for j in range(0, w_scaled - patch_size + 1, stride):
                 x = img_scaled[i:i + patch_size, j:j + patch_size]
-                # patches.append(x)
-                # data aug
                 for k in range(0, aug_times):
-                    x_aug = data_aug(x, mode=np.random.randint(0, 8))
-                    patches.append(x_aug)
+                    patches.append(x)
 
-    return patches
+    # data aug, all patches at once
+    if not patches:
+        return patches
+    patches = np.array(patches)
+    return list(data_aug_batch(patches, np.random.randint(0, 8, size=len(patches))))
 
 
 def datagenerator(data_dir=join('data', 'Volume1', 'train'), image_type=ImageType.CLEARIMAGE):
@@ -467,12 +583,125 @@ def datagenerator(data_dir=join('data', 'Volume1', 'train'), image_type=ImageTyp
     return data
 
 
-def get_lower_and_upper_percentile_stds(data_dir: str, lower_percentile: float, upper_percentile: float,
-                                        patch_size: int = 40, stride: int = 20, scales: List[float] = None):
+def get_subject_statistics(root_dir: str, patch_size: int = 40, stride: int = 20, scales: List[float] = None,
+                           use_saved: bool = True) -> Dict:
+    """
+    Gets streaming statistics of the slices and patches of a single subject (training data directory). The statistics
+    are saved to <root_dir>/statistics.json, and reused as long as the images in root_dir haven't changed, so that
+    statistics of a fold can be merged from per-subject summaries instead of being recomputed.
+
+    Parameters
+    ----------
+    root_dir: The directory housing the ClearImages and CoregisteredBlurryImages of the subject
+    patch_size: The patch size (in pixels) of each image patch taken
+    stride: The stride with which to slide the patch-taking window
+    scales: A list of scales at which we want to create image patches.
+        If None, this function simply performs no rescaling of the image to create patches
+    use_saved: True if we may reuse (and save) the statistics in <root_dir>/statistics.json
+
+    Returns
+    -------
+    A dictionary of the following:
+                1. clear_pixels: RunningStats of the px values of the clear slices
+                2. clear_pixel_histogram: FixedHistogram of the px values of the clear slices
+                3. blurry_pixels: RunningStats of the px values of the (histogram matched) blurry slices
+                4. blurry_pixel_histogram: FixedHistogram of the px values of the blurry slices
+                5. clear_patch_pixels: RunningStats of the px values of the non-black clear patches
+                6. blurry_patch_pixels: RunningStats of the px values of the blurry patches paired with them
+                7. patch_psnrs: QuantileSketch of the PSNRs of the non-black patch pairs
+                8. blurry_patch_stds: QuantileSketch of the px standard deviations of the non-black blurry patches
+    """
+    clear_image_dir = join(root_dir, 'ClearImages')
+    blurry_image_dir = join(root_dir, 'CoregisteredBlurryImages')
+    file_names = sorted(file_name for file_name in os.listdir(clear_image_dir)
+                        if file_name.endswith('.jpg') or file_name.endswith('.png'))
+
+    # Key the statistics by their settings, and fingerprint the images by their names, sizes and modification times
+    key = json.dumps({'patch_size': patch_size, 'stride': stride, 'scales': scales}, sort_keys=True)
+    hasher = hashlib.sha256()
+    for file_name in file_names:
+        for image_dir in (clear_image_dir, blurry_image_dir):
+            stat = os.stat(join(image_dir, file_name))
+            hasher.update(f'{image_dir}/{file_name}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+    fingerprint = hasher.hexdigest()
+    statistics_path = join(root_dir, 'statistics.json')
+
+    if use_saved:
+        statistics = streaming_stats.load_statistics(statistics_path, key, fingerprint)
+        if statistics is not None:
+            return statistics
+
+    statistics = {
+        'clear_pixels': streaming_stats.RunningStats(),
+        'clear_pixel_histogram': streaming_stats.FixedHistogram(),
+        'blurry_pixels': streaming_stats.RunningStats(),
+        'blurry_pixel_histogram': streaming_stats.FixedHistogram(),
+        'clear_patch_pixels': streaming_stats.RunningStats(),
+        'blurry_patch_pixels': streaming_stats.RunningStats(),
+        'patch_psnrs': streaming_stats.QuantileSketch(),
+        'blurry_patch_stds': streaming_stats.QuantileSketch()
+    }
+
+    for file_name in file_names:
+
+        # Read the Clear and Blurry Images, and histogram match the blurry image to the clear image
+        clear_image = cv2.imread(join(clear_image_dir, file_name), 0)
+        blurry_image = cv2.imread(join(blurry_image_dir, file_name), 0)
+        blurry_image = image_utils.hist_match(blurry_image, clear_image).astype('uint8')
+
+        statistics['clear_pixels'].update(clear_image)
+        statistics['clear_pixel_histogram'].update(clear_image)
+        statistics['blurry_pixels'].update(blurry_image)
+        statistics['blurry_pixel_histogram'].update(blurry_image)
+
+        # Generate clear and blurry patches from the clear and blurry images, using their cached pyramid levels
+        levels = pyramid_cache.get_pair_levels(root_dir, file_name, scales=scales) if scales is not None else None
+        clear_patches, blurry_patches = generate_patch_pairs(clear_image=clear_image, blurry_image=blurry_image,
+                                                             patch_size=patch_size, stride=stride, scales=scales,
+                                                             levels=levels)
+        if len(clear_patches) == 0:
+            continue
+        clear_patches = np.array(clear_patches, dtype='uint8').reshape(len(clear_patches), -1)
+        blurry_patches = np.array(blurry_patches, dtype='uint8').reshape(len(blurry_patches), -1)
+
+        # Skip black patches (i.e. the max px value < 10)
+        not_black = clear_patches.max(axis=1) >= 10
+        statistics['clear_patch_pixels'].update(clear_patches[not_black])
+        statistics['blurry_patch_pixels'].update(blurry_patches[not_black])
+        statistics['patch_psnrs'].update(get_patch_psnrs(clear_patches[not_black], blurry_patches[not_black]))
+        statistics['blurry_patch_stds'].update(blurry_patches[blurry_patches.max(axis=1) >= 10].std(axis=1))
+
+    if use_saved:
+        streaming_stats.save_statistics(statistics_path, key, fingerprint, statistics)
+
+    return statistics
+
+
+def get_fold_statistics(root_dirs: List[str], patch_size: int = 40, stride: int = 20, scales: List[float] = None,
+                        use_saved: bool = True) -> Dict:
+    """
+    Gets the statistics of several subjects (e.g. the training data of a fold), merged from the statistics of each
+    subject. See get_subject_statistics.
+
+    Returns
+    -------
+    A dictionary of the merged statistics
+    """
+    return streaming_stats.merge_statistics([get_subject_statistics(root_dir, patch_size=patch_size, stride=stride,
+                                                                    scales=scales, use_saved=use_saved)
+                                             for root_dir in root_dirs])
+
+
+def get_lower_and_upper_percentile_stds(data_dir: Union[str, List[str]], lower_percentile: float,
+                                        upper_percentile: float, patch_size: int = 40, stride: int = 20,
+                                        scales: List[float] = None):
     """
     Gets the lower and upper percentile values of std of the images in a given data directory
 
-    :param data_dir: The directory housing input images
+    NOTE: The percentiles come from the per-subject quantile sketches of get_subject_statistics, so they are within
+    1% of the exact percentiles, and are only computed once per subject.
+
+    :param data_dir: The directory (or list of directories) housing input images
     :param lower_percentile: The percentile at which to find the corresponding lower percentile PSNR value
     :param upper_percentile: The percentile at which to find the corresponding hight percentile PSNR value
     :param patch_size: The patch size (in pixels) of each image patch taken
@@ -482,21 +711,28 @@ def get_lower_and_upper_percentile_stds(data_dir: str, lower_percentile: float,
 
     :return: (lower_percentile_value, upper_percentile_value)
     """
-    # Get training examples from data_dir using data_generator
-    _, y_original = pair_data_generator(data_dir, patch_size=patch_size, stride=stride, scales=scales)
+    data_dirs = [data_dir] if isinstance(data_dir, str) else data_dir
 
-    # Iterate over y_original and get stds
-    stds = []
-    for y_patch in y_original:
-        if np.max(y_patch) < 10:
-            continue
-        y_patch = y_patch.reshape(y_patch.shape[0], y_patch.shape[1])
-        std = np.std(y_patch)
-        stds.append(std)
+    # Get the quantile sketch of the stds of the blurry patches, merged over the data directories
+    stds = get_fold_statistics(data_dirs, patch_size=patch_size, stride=stride, scales=scales)['blurry_patch_stds']
 
-    stds = np.array(stds, dtype='float64')
+    return stds.quantile(lower_percentile / 100), stds.quantile(upper_percentile / 100)
 
-    return np.percentile(stds, lower_percentile), np.percentile(stds, upper_percentile)
+
+def get_fold_standardization(root_dirs: List[str], patch_size: int = 40, stride: int = 10,
+                             scales: List[float] = [1, 0.9, 0.8, 0.7]) -> Tuple[float, float, float, float]:
+    """
+    Gets the mean and standard deviation of the px values of the non-black clear patches, and of the blurry patches
+    paired with them, over several subjects. These are the values that image_utils.standardize would compute over the
+    full array of training patches, merged from per-subject statistics instead.
+
+    Returns
+    -------
+    (x_mean, x_std, y_mean, y_std)
+    """
+    statistics = get_fold_statistics(root_dirs, patch_size=patch_size, stride=stride, scales=scales)
+    return (statistics['clear_patch_pixels'].mean, statistics['clear_patch_pixels'].std,
+            statistics['blurry_patch_pixels'].mean, statistics['blurry_patch_pixels'].std)
 
 
 def pair_3d_data_generator(root_dirs: str = join('data', 'Volume1', 'train'),
@@ -528,11 +764,10 @@ def pair_3d_data_generator(root_dirs: str = join('data', 'Volume1', 'train'),
         blurry_image_volume = image_utils.hist_match(source=blurry_image_volume, template=clear_image_volume).astype(
             'uint8')
 
-        # Generate clear and blurry patches from the clear and blurry images, respectively...
-        clear_volume_patches, blurry_volume_patches = generate_3d_patch_pairs(clear_volume=clear_image_volume,
-                                                                              blurry_volume=blurry_image_volume,
-                                                                              patch_size=patch_size, stride=stride,
-                                                                              scales=scales)
+        # Generate clear and blurry patches from the clear and blurry images, respectively, using their cached levels
+        clear_volume_patches, blurry_volume_patches = generate_3d_patch_pairs(
+            clear_volume=clear_image_volume, blurry_volume=blurry_image_volume, patch_size=patch_size, stride=stride,
+            scales=scales, levels=pyramid_cache.get_volume_levels(root_dir, scales=scales))
 
         # Append the patches to clear_data and blurry_data
         all_clear_volume_patches.extend(clear_volume_patches)
@@ -662,19 +897,16 @@ def pair_data_generator(root_dirs: str = join('data', 'Volume1', 'train'), image
                     if not low_image_id < file_id < high_image_id:
                         continue
 
-                # Read the Clear and Blurry Images as numpy arrays
-                clear_image = cv2.imread(os.path.join(clear_image_dir, file_name), 0)
-                blurry_image = cv2.imread(os.path.join(blurry_image_dir, file_name), 0)
-
-                # Histogram equalize the blurry image px distribution to match the clear image px distribution
-                blurry_image = image_utils.hist_match(blurry_image, clear_image).astype('uint8')
+                # Get the Clear and (histogram matched) Blurry Images at every scale from the pyramid cache
+                levels = pyramid_cache.get_pair_levels(root_dir, file_name, scales=scales)
 
                 # Generate clear and blurry patches from the clear and blurry images, respectively...
-                clear_patches, blurry_patches = generate_patch_pairs(clear_image=clear_image,
-                                                                     blurry_image=blurry_image,
+                clear_patches, blurry_patches = generate_patch_pairs(clear_image=None,
+                                                                     blurry_image=None,
                                                                      patch_size=patch_size,
                                                                      stride=stride,
-                                                                     scales=scales)
+                                                                     scales=scales,
+                                                                     levels=levels)
 
                 # Add the images to the full lists of data
                 clear_data.extend(clear_patches)
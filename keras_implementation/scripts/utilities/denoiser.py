@@ -0,0 +1,705 @@
+"""
+In-process HydraNet denoising API, for embedding HydraNet in other pipelines without writing inputs to disk
+"""
+
+import os
+import itertools
+import numpy as np
+from tensorflow.keras.models import load_model
+from skimage.metrics import peak_signal_noise_ratio, structural_similarity
+from typing import List, Dict, Tuple
+from utilities import image_utils, data_generator, model_functions, result_cache
+from utilities.instrumentation import Instrumentation
+
+# The names of the noise-level experts, in the order used to break SSIM ties (high wins, then medium, then low)
+NOISE_CATEGORIES = ['high', 'medium', 'low']
+
+# The number of float32 feature maps per voxel that a Conv3D/BatchNorm/ReLU stack keeps alive at its peak
+# (a layer's input and output, plus the next layer's output while the input is being freed)
+ACTIVATION_COPIES_3D = 3
+
+
+def compare_to_closest_training_patch(patch: np.ndarray, training_patches: np.ndarray,
+                                      comparison_metric: str = 'ssim') -> float:
+    """
+    Takes an image patch and compares it with all patches in a given set of training patches to find
+    the one with max similarity. Returns the similarity between the given image patch and that chosen
+    training patch.
+
+    Parameters
+    ----------
+    patch: The patch to find a closest match to
+    training_patches: The set of training patches to compare the input patch with
+    comparison_metric: If 'ssim', we find max SSIM, otherwise, if 'psnr', we find max PSNR
+
+    Returns
+    -------
+    The PSNR or SSIM between the input patch and the closest match in training_patches
+    """
+    max_score = 0
+    for training_patch in training_patches:
+        # First, reshape training_patch and patch to get the ssim
+        training_patch = training_patch.reshape(training_patch.shape[0], training_patch.shape[1])
+        patch = patch.reshape(patch.shape[0], patch.shape[1])
+        if comparison_metric == 'psnr':
+            # Get the PSNR between y_patch and y_low_noise_patch
+            score = peak_signal_noise_ratio(patch, training_patch)
+        elif comparison_metric == 'ssim':
+            # Get the SSIM between y_patch and y_low_noise_patch
+            score = structural_similarity(training_patch, patch)
+        # Then, reshape the input patch back
+        patch = patch.reshape(patch.shape[0], patch.shape[1], 1)
+        # If it's greater than the max, update the max
+        if score > max_score:
+            max_score = score
+    return max_score
+
+
+class SimilarityRouter:
+    """
+    Decides which noise-level expert should denoise a patch by finding the most similar patch in a
+    reference bank of training patches that have already been split into low, medium, and high noise
+    """
+
+    def __init__(self, training_patches: Dict, comparison_metric: str = 'ssim'):
+        """
+        Constructor for SimilarityRouter
+
+        Parameters
+        ----------
+        training_patches: A nested dictionary of training patches, as returned by data_generator.retrieve_train_data
+        comparison_metric: The similarity metric used to find the closest training patch, 'ssim' or 'psnr'
+        """
+        self.training_patches = training_patches
+        self.comparison_metric = comparison_metric
+        self._fingerprint = None
+
+    @classmethod
+    def from_train_data(cls, train_data_dirs: List[str], low_noise_threshold: float = 20.0,
+                        high_noise_threshold: float = 40.0, skip_every: int = 3, patch_size: int = 40,
+                        stride: int = 20, scales: List = [1], comparison_metric: str = 'ssim'):
+        """
+        Builds the reference bank of training patches from training data directories and returns a router using it
+
+        Parameters
+        ----------
+        train_data_dirs: The training data directories used to build the reference bank
+        low_noise_threshold: The lower PSNR threshold used to split training patches into noise levels
+        high_noise_threshold: The upper PSNR threshold used to split training patches into noise levels
+        skip_every: Only keep every 'skip_every'th training patch in the reference bank
+        patch_size: The size of each reference patch in pixels -> (patch_size, patch_size)
+        stride: The stride with which to slide the patch-taking window
+        scales: A list of scales at which we want to create reference patches
+        comparison_metric: The similarity metric used to find the closest training patch, 'ssim' or 'psnr'
+
+        Returns
+        -------
+        A SimilarityRouter
+        """
+        training_patches = data_generator.retrieve_train_data(train_data_dirs,
+                                                              low_noise_threshold=low_noise_threshold,
+                                                              high_noise_threshold=high_noise_threshold,
+                                                              skip_every=skip_every, patch_size=patch_size,
+                                                              stride=stride, scales=scales)
+        return cls(training_patches, comparison_metric=comparison_metric)
+
+    def fingerprint(self) -> Dict:
+        """
+        Gets a description of everything that affects this router's decisions, for use in cache keys
+
+        Returns
+        -------
+        A dictionary containing the comparison metric and a hash of each category's reference patches
+        """
+        if self._fingerprint is None:
+            self._fingerprint = {'comparison_metric': self.comparison_metric}
+            for category in NOISE_CATEGORIES:
+                self._fingerprint[category] = result_cache.hash_array(self.training_patches[category + '_noise']['y'])
+        return self._fingerprint
+
+    def route(self, patch: np.ndarray) -> str:
+        """
+        Gets the noise category ('low', 'medium', or 'high') of the expert that should denoise a patch
+
+        Parameters
+        ----------
+        patch: The (un-standardized, uint8) blurry patch to route
+
+        Returns
+        -------
+        The noise category of the closest training patch
+        """
+        # Get the Max SSIM value between the patch and the most similar patch in every category
+        max_scores = {}
+        for category in NOISE_CATEGORIES:
+            max_scores[category] = compare_to_closest_training_patch(patch,
+                                                                     self.training_patches[category + '_noise']['y'],
+                                                                     comparison_metric=self.comparison_metric)
+
+        # Get the overall max from those categorical maxes, preferring higher-noise categories on ties
+        max_score = max(max_scores.values())
+        for category in NOISE_CATEGORIES:
+            if max_scores[category] == max_score:
+                return category
+
+
+class HydraNetDenoiser:
+    """
+    Denoises in-memory MRI slices and volumes with HydraNet.
+
+    The denoising models (and the routing reference bank, if any) are loaded once, when the denoiser is
+    constructed, and are then reused by every call to denoise_slice, denoise_batch, and denoise_volume.
+    """
+
+    def __init__(self, model_dirs: Dict[str, str], router: SimilarityRouter = None, backend: str = 'keras',
+                 epochs: Dict[str, int] = None, patch_size: int = 40, stride: int = 30, batch_size: int = 128,
+                 skip_background: bool = False, background_threshold: int = 10, tta_modes: List[int] = None,
+                 instrumentation: Instrumentation = None):
+        """
+        Constructor for HydraNetDenoiser
+
+        Parameters
+        ----------
+        model_dirs: A dictionary mapping a noise category to the directory of its model_*.hdf5 checkpoints.
+            Use {'all': <dir>} for a single denoiser, or {'low': <dir>, 'medium': <dir>, 'high': <dir>} together
+            with a router for HydraNet's routed noise-level experts
+        router: The router used to pick an expert for each patch. If None, every patch is sent to the 'all' model
+        backend: The backend used to run the models: 'keras' (Model.predict), or 'tf_function' (an XLA-compiled
+            model_functions.CompiledPredictor, warmed up for the patch size when the denoiser is constructed)
+        epochs: An optional dictionary mapping a noise category to the checkpoint epoch to load. Categories
+            that are missing from this dictionary load their latest checkpoint
+        patch_size: The size of each denoised patch in pixels -> (patch_size, patch_size)
+        stride: The stride with which to slide the patch-taking window
+        batch_size: The maximum number of patches sent through a model at once
+        skip_background: True if we wish to crop each slice to its foreground bounding box before tiling it, and
+            skip (neither route nor denoise) patches that contain no foreground
+        background_threshold: When no mask is given, px values below this threshold are treated as background,
+            matching the 'np.max(patch) < 10' black-patch rule used during training
+        tta_modes: An optional list of data_generator.data_aug modes (0 through 7) to use for test-time augmentation.
+            Each patch is denoised once per mode, with every transformed copy in the same forward pass, and the
+            inverse-transformed predictions are averaged. If None, each patch is denoised once, as it is
+        instrumentation: The Instrumentation that times the standardize, route, predict, and reassemble stages, and
+            counts the patches sent to each model ('patches_<category>') and skipped as background
+            ('skipped_background_patches'). If None, the denoiser keeps its own
+        """
+        if router is None and 'all' not in model_dirs:
+            raise ValueError("A single-denoiser HydraNetDenoiser needs an 'all' entry in model_dirs")
+        if router is not None and not all(category in model_dirs for category in NOISE_CATEGORIES):
+            raise ValueError(f'A routed HydraNetDenoiser needs model_dirs for each of {NOISE_CATEGORIES}')
+        if backend not in ('keras', 'tf_function'):
+            raise ValueError(f"Unknown backend '{backend}'")
+        if tta_modes is not None and (len(tta_modes) == 0 or not all(0 <= mode < 8 for mode in tta_modes)):
+            raise ValueError(f'tta_modes must be a non-empty list of modes from 0 through 7, not {tta_modes}')
+
+        self.router = router
+        self.backend = backend
+        self.patch_size = patch_size
+        self.stride = stride
+        self.batch_size = batch_size
+        self.skip_background = skip_background
+        self.background_threshold = background_threshold
+        self.tta_modes = None if tta_modes is None else [int(mode) for mode in tta_modes]
+
+        # Keep track of the time spent in each stage, the total # of patches sent to each model, and the # of patches
+        # skipped as background
+        self.instrumentation = instrumentation if instrumentation is not None else Instrumentation()
+
+        # Load every model exactly once
+        self.model_paths = {}
+        self.models = {}
+        for category, model_dir in model_dirs.items():
+            if epochs is not None and category in epochs:
+                epoch = epochs[category]
+            else:
+                epoch = model_functions.findLastCheckpoint(save_dir=model_dir)
+            self.model_paths[category] = os.path.join(model_dir, 'model_%03d.hdf5' % epoch)
+            self.models[category] = load_model(self.model_paths[category], compile=False)
+
+        # Compile (and warm up) the forward pass of each model for batches of patches
+        self.predictors = {}
+        if backend == 'tf_function':
+            for category, model in self.models.items():
+                self.predictors[category] = model_functions.CompiledPredictor(model, max_batch_size=batch_size)
+                self.predictors[category].warmup([(patch_size, patch_size, 1)])
+
+    @property
+    def patches_per_category(self) -> Dict[str, int]:
+        """ The total # of patches sent to each model so far """
+        return {category: self.instrumentation.get_count(f'patches_{category}') for category in self.models}
+
+    @property
+    def skipped_background_patches(self) -> int:
+        """ The total # of windows of the slices' patch grids skipped as background so far """
+        return self.instrumentation.get_count('skipped_background_patches')
+
+    def fingerprint(self) -> Dict:
+        """
+        Gets a description of everything that affects this denoiser's output, for use in cache keys
+
+        Returns
+        -------
+        A dictionary containing the hash of each model's weights, the routing configuration, and the patch settings
+        """
+        return {
+            'models': {category: result_cache.hash_file(path) for category, path in self.model_paths.items()},
+            'router': None if self.router is None else self.router.fingerprint(),
+            'backend': self.backend,
+            'patch_size': self.patch_size,
+            'stride': self.stride,
+            'skip_background': self.skip_background,
+            'background_threshold': self.background_threshold,
+            'tta_modes': self.tta_modes
+        }
+
+    def _predict(self, category: str, batch: np.ndarray) -> np.ndarray:
+        """
+        Runs a batch of standardized (N, H, W, 1) inputs through the model of a noise category
+
+        Parameters
+        ----------
+        category: The noise category of the model to use
+        batch: The standardized inputs
+
+        Returns
+        -------
+        The denoised batch, with the same shape as the input batch
+        """
+        if self.tta_modes is None:
+            return self._run_model(category, batch)
+
+        # Stack a transformed copy of the batch per mode, and denoise all of the copies in one forward pass
+        num_patches = len(batch)
+        stacked_batch = np.concatenate([data_generator.data_aug_batch(batch, np.full(num_patches, mode))
+                                        for mode in self.tta_modes])
+        stacked_pred = self._run_model(category, stacked_batch)
+
+        # Undo each copy's transform, and average the copies (in double precision, so that averaging identical
+        # predictions gives back exactly the same prediction)
+        stacked_modes = np.repeat(self.tta_modes, num_patches)
+        stacked_pred = data_generator.data_aug_batch(stacked_pred, stacked_modes, inverse=True)
+        return stacked_pred.reshape((len(self.tta_modes),) + batch.shape).mean(axis=0, dtype='float64') \
+            .astype(stacked_pred.dtype)
+
+    def _run_model(self, category: str, batch: np.ndarray) -> np.ndarray:
+        """ Runs a batch through the model of a noise category, with the denoiser's backend """
+        if self.backend == 'tf_function':
+            return self.predictors[category].predict(batch)
+        return self.models[category].predict(batch, batch_size=self.batch_size)
+
+    def _get_patch_indices(self, top: int, left: int, bottom: int, right: int) -> List:
+        """
+        Gets the top-left (i, j) corner of every patch-taking window that fits within a region of an image
+
+        Parameters
+        ----------
+        top: The first row of the region
+        left: The first column of the region
+        bottom: One past the last row of the region
+        right: One past the last column of the region
+
+        Returns
+        -------
+        A list of (i, j) tuples, in raster order
+        """
+        return [(i, j)
+                for i in range(top, bottom - self.patch_size + 1, self.stride)
+                for j in range(left, right - self.patch_size + 1, self.stride)]
+
+    def _get_foreground_patch_indices(self, image: np.ndarray, mask: np.ndarray = None) -> Tuple[List, int]:
+        """
+        Gets the top-left (i, j) corner of every patch-taking window that contains foreground, tiling only the
+        foreground bounding box of the image, and counts the background windows that are skipped.
+
+        Since the bounding box is tiled on its own grid (with extra windows flush with its edges), the skipped windows
+        are counted on the grid of the whole image instead: they are the windows of _get_patch_indices that hold no
+        foreground px
+
+        Parameters
+        ----------
+        image: The (uint8) image to tile
+        mask: An optional mask of the image, where non-zero px are foreground. If None, the foreground is every px
+            at or above background_threshold
+
+        Returns
+        -------
+        A tuple containing: 1. A list of (i, j) tuples of the foreground windows, in raster order
+                            2. The number of windows of the whole image's grid that hold no foreground px
+        """
+        height, width = image.shape
+        p = self.patch_size
+        foreground = mask > 0 if mask is not None else image >= self.background_threshold
+
+        # Use a summed-area table to count the foreground px in any window in constant time
+        summed_area = np.zeros((height + 1, width + 1), dtype='int64')
+        summed_area[1:, 1:] = foreground.cumsum(axis=0).cumsum(axis=1)
+
+        def has_foreground(i, j):
+            return summed_area[i + p, j + p] - summed_area[i, j + p] - summed_area[i + p, j] + summed_area[i, j] > 0
+
+        num_background_windows = sum(not has_foreground(i, j) for i, j in self._get_patch_indices(0, 0, height, width))
+
+        # If there is no foreground at all (or no patch fits in the image), there is nothing to denoise
+        rows = np.flatnonzero(foreground.any(axis=1))
+        columns = np.flatnonzero(foreground.any(axis=0))
+        if len(rows) == 0 or height < p or width < p:
+            return [], num_background_windows
+
+        # Crop to the foreground bounding box, growing it (within the image) so that at least one patch fits
+        top, bottom = rows[0], rows[-1] + 1
+        left, right = columns[0], columns[-1] + 1
+        top = max(0, min(top, bottom - self.patch_size))
+        left = max(0, min(left, right - self.patch_size))
+        bottom = min(height, max(bottom, top + self.patch_size))
+        right = min(width, max(right, left + self.patch_size))
+
+        # Tile the bounding box, adding a last row/column of windows flush with its bottom/right edge so that the
+        # edges of the foreground are always denoised
+        row_starts = list(range(top, bottom - p + 1, self.stride))
+        column_starts = list(range(left, right - p + 1, self.stride))
+        if row_starts[-1] + p < bottom:
+            row_starts.append(bottom - p)
+        if column_starts[-1] + p < right:
+            column_starts.append(right - p)
+
+        return [(i, j) for i in row_starts for j in column_starts if has_foreground(i, j)], num_background_windows
+
+    def denoise_batch(self, images: List[np.ndarray], reference_means: List[float] = None,
+                      reference_stds: List[float] = None, masks: List[np.ndarray] = None) -> List[np.ndarray]:
+        """
+        Denoises a batch of 2D slices patch by patch. Patches from every slice that are routed to the same
+        model are denoised together, so each model is called once per batch_size patches, rather than once per patch.
+
+        Parameters
+        ----------
+        images: The (uint8, grayscale) blurry slices to denoise
+        reference_means: The mean px value used to reverse the standardization of each denoised slice.
+            If None, each slice's own mean is used
+        reference_stds: The standard deviation px value used to reverse the standardization of each denoised
+            slice. If None, each slice's own standard deviation is used
+        masks: Optional foreground masks of each slice (non-zero px are foreground), only used when
+            skip_background is True. If None, or if a mask is None, the foreground is found by thresholding the slice
+
+        Returns
+        -------
+        A list of denoised (uint8) slices. Skipped background px are left as they were in the input slice
+        """
+        instrumentation = self.instrumentation
+
+        # Standardize each slice, and create each denoised slice to INITIALLY be a copy of the standardized slice
+        with instrumentation.timer('standardize'):
+            standardized_images = []
+            image_means = []
+            image_stds = []
+            for image in images:
+                standardized_image, image_mean, image_std = image_utils.standardize(image)
+                standardized_images.append(standardized_image)
+                image_means.append(image_mean)
+                image_stds.append(image_std)
+            x_preds = [np.array(standardized_image) for standardized_image in standardized_images]
+
+        # Assign every patch of every slice to a model. Each window is (image index, i, j, category)
+        with instrumentation.timer('route'):
+            windows = []
+            for image_index, image in enumerate(images):
+                if self.skip_background:
+                    patch_indices, num_background_windows = self._get_foreground_patch_indices(
+                        image, mask=None if masks is None else masks[image_index])
+                    instrumentation.count('skipped_background_patches', num_background_windows)
+                else:
+                    patch_indices = self._get_patch_indices(0, 0, image.shape[0], image.shape[1])
+                for i, j in patch_indices:
+                    if self.router is None:
+                        category = 'all'
+                    else:
+                        category = self.router.route(image[i:i + self.patch_size, j:j + self.patch_size])
+                    windows.append((image_index, i, j, category))
+
+        # Denoise all of the patches assigned to each model together
+        predictions = [None] * len(windows)
+        for category in self.models:
+            window_indices = [index for index, window in enumerate(windows) if window[3] == category]
+            if not window_indices:
+                continue
+            instrumentation.count(f'patches_{category}', len(window_indices))
+            with instrumentation.timer('predict'):
+                patches = []
+                for index in window_indices:
+                    image_index, i, j, _ = windows[index]
+                    patches.append(standardized_images[image_index][i:i + self.patch_size, j:j + self.patch_size])
+                batch = np.array(patches, dtype='float32')[..., np.newaxis]
+                batch_pred = self._predict(category, batch)
+                for index, patch_pred in zip(window_indices, batch_pred):
+                    predictions[index] = patch_pred[..., 0]
+
+        with instrumentation.timer('reassemble'):
+            # Replace the patches in each slice with the denoised patches, in raster order so that later patches
+            # overwrite the overlapping parts of earlier patches
+            for (image_index, i, j, _), patch_pred in zip(windows, predictions):
+                x_preds[image_index][i:i + self.patch_size, j:j + self.patch_size] = patch_pred
+
+            # Reverse the standardization of each denoised slice
+            denoised_images = []
+            for image_index, x_pred in enumerate(x_preds):
+                mean = image_means[image_index] if reference_means is None else reference_means[image_index]
+                std = image_stds[image_index] if reference_stds is None else reference_stds[image_index]
+                denoised_images.append(image_utils.reverse_standardize(x_pred, original_mean=mean, original_std=std))
+
+        return denoised_images
+
+    def denoise_slice(self, image: np.ndarray, reference_mean: float = None, reference_std: float = None,
+                      mask: np.ndarray = None) -> np.ndarray:
+        """
+        Denoises a single 2D slice patch by patch
+
+        Parameters
+        ----------
+        image: The (uint8, grayscale) blurry slice to denoise
+        reference_mean: The mean px value used to reverse the standardization of the denoised slice.
+            If None, the slice's own mean is used
+        reference_std: The standard deviation px value used to reverse the standardization of the denoised slice.
+            If None, the slice's own standard deviation is used
+        mask: An optional foreground mask of the slice, only used when skip_background is True
+
+        Returns
+        -------
+        The denoised (uint8) slice
+        """
+        return self.denoise_batch([image],
+                                  reference_means=None if reference_mean is None else [reference_mean],
+                                  reference_stds=None if reference_std is None else [reference_std],
+                                  masks=None if mask is None else [mask])[0]
+
+    def denoise_volume(self, volume: np.ndarray, mask_volume: np.ndarray = None) -> np.ndarray:
+        """
+        Denoises a 3D image volume slice by slice
+
+        Parameters
+        ----------
+        volume: The (uint8) blurry volume to denoise -> (depth, height, width)
+        mask_volume: An optional foreground mask volume, only used when skip_background is True
+
+        Returns
+        -------
+        The denoised (uint8) volume -> (depth, height, width)
+        """
+        return np.array(self.denoise_batch(list(volume), masks=None if mask_volume is None else list(mask_volume)),
+                        dtype='uint8')
+
+
+def get_brick_shape(volume_shape: Tuple[int, int, int], memory_budget_mb: float, num_filters: int = 64,
+                    overlap: int = 8) -> Tuple[int, int, int]:
+    """
+    Gets the largest brick that a 3D denoiser can denoise within a memory budget. The brick is as close to a cube as
+    possible, but never larger than the volume along any axis, so the budget left over by a thin axis (e.g. a volume
+    with few slices) is spent on the other axes.
+
+    Parameters
+    ----------
+    volume_shape: The shape of the volume to tile -> (depth, height, width)
+    memory_budget_mb: The memory, in MB, that the activations of a single brick may use
+    num_filters: The number of convolutional kernels in each hidden layer of the 3D denoiser
+    overlap: The number of voxels by which neighbouring bricks overlap
+
+    Returns
+    -------
+    The brick shape -> (depth, height, width)
+    """
+    # Get the number of voxels that fit in the budget
+    bytes_per_voxel = 4 * num_filters * ACTIVATION_COPIES_3D
+    num_voxels = memory_budget_mb * 1024 ** 2 / bytes_per_voxel
+
+    # Give every axis an equal share of the budget, clamping the axes that are smaller than their share to the volume
+    # and redistributing what they leave over
+    brick_shape = [None, None, None]
+    free_axes = [0, 1, 2]
+    while free_axes:
+        edge = (num_voxels / np.prod([brick_shape[axis] for axis in range(3) if axis not in free_axes])) \
+            ** (1 / len(free_axes))
+        clamped_axes = [axis for axis in free_axes if volume_shape[axis] <= edge]
+        if not clamped_axes:
+            for axis in free_axes:
+                brick_shape[axis] = int(edge)
+            break
+        for axis in clamped_axes:
+            brick_shape[axis] = volume_shape[axis]
+            free_axes.remove(axis)
+
+    # A brick that doesn't cover an axis must be larger than the overlap, or tiling would never advance
+    for axis in range(3):
+        if brick_shape[axis] < volume_shape[axis] and brick_shape[axis] <= overlap:
+            raise MemoryError(f'A memory budget of {memory_budget_mb} MB only fits bricks of shape '
+                              f'{tuple(brick_shape)}, which is too small for an overlap of {overlap} voxels')
+    return tuple(brick_shape)
+
+
+def get_brick_starts(size: int, brick_size: int, overlap: int) -> List[int]:
+    """
+    Gets the first index of every brick along one axis of a volume, such that neighbouring bricks overlap by at least
+    'overlap' voxels and the last brick is flush with the end of the axis
+
+    Parameters
+    ----------
+    size: The size of the volume along the axis
+    brick_size: The size of each brick along the axis
+    overlap: The number of voxels by which neighbouring bricks overlap
+
+    Returns
+    -------
+    A list of start indices, in increasing order
+    """
+    if brick_size >= size:
+        return [0]
+    starts = list(range(0, size - brick_size + 1, brick_size - overlap))
+    if starts[-1] + brick_size < size:
+        starts.append(size - brick_size)
+    return starts
+
+
+def get_blend_window(brick_shape: Tuple[int, int, int], overlap: int) -> np.ndarray:
+    """
+    Gets the 3D window used to blend overlapping bricks. Along each axis the window is 1 in the middle of the brick and
+    falls off with a raised cosine over the 'overlap' voxels at each end, where predictions suffer the most from the
+    zero padding of the convolutions. The window never reaches 0, so every voxel gets a non-zero total weight.
+
+    Parameters
+    ----------
+    brick_shape: The shape of each brick -> (depth, height, width)
+    overlap: The number of voxels by which neighbouring bricks overlap
+
+    Returns
+    -------
+    A float32 array of shape brick_shape
+    """
+    axis_windows = []
+    for brick_size in brick_shape:
+        axis_window = np.ones(brick_size, dtype='float32')
+        ramp_size = min(overlap, brick_size // 2)
+        if ramp_size > 0:
+            ramp = 0.5 - 0.5 * np.cos(np.pi * np.arange(1, ramp_size + 1) / (ramp_size + 1))
+            axis_window[:ramp_size] = ramp
+            axis_window[-ramp_size:] = ramp[::-1]
+        axis_windows.append(axis_window)
+    return np.einsum('i,j,k->ijk', *axis_windows)
+
+
+class HydraNet3dDenoiser:
+    """
+    Denoises whole in-memory MRI volumes with a 3D denoiser (My3dDenoiser).
+
+    A forward pass over an entire volume does not fit in memory, so each volume is split into overlapping bricks,
+    sized to a memory budget. The bricks are denoised in batches, and blended back together with a 3D window.
+    """
+
+    def __init__(self, model_dir: str, epoch: int = None, memory_budget_mb: float = 1024, overlap: int = 8,
+                 brick_shape: Tuple[int, int, int] = None, batch_size: int = None):
+        """
+        Constructor for HydraNet3dDenoiser
+
+        Parameters
+        ----------
+        model_dir: The directory of the 3D denoiser's model_*.hdf5 checkpoints
+        epoch: The checkpoint epoch to load. If None, the latest checkpoint is loaded
+        memory_budget_mb: The memory, in MB, that the activations of each batch of bricks may use
+        overlap: The number of voxels by which neighbouring bricks overlap
+        brick_shape: An optional fixed brick shape -> (depth, height, width). If None, each volume's bricks are sized
+            to the memory budget
+        batch_size: The number of bricks denoised at once. If None, as many bricks as fit in the memory budget
+        """
+        self.memory_budget_mb = memory_budget_mb
+        self.overlap = overlap
+        self.brick_shape = brick_shape
+        self.batch_size = batch_size
+
+        # Load the model exactly once
+        if epoch is None:
+            epoch = model_functions.findLastCheckpoint(save_dir=model_dir)
+        self.model_path = os.path.join(model_dir, 'model_%03d.hdf5' % epoch)
+        self.model = load_model(self.model_path, compile=False)
+
+        # Get the widest hidden layer, which sets the memory used per voxel
+        self.num_filters = max([layer.filters for layer in self.model.layers if hasattr(layer, 'filters')])
+
+    def fingerprint(self) -> Dict:
+        """
+        Gets a description of everything that affects this denoiser's output, for use in cache keys
+
+        Returns
+        -------
+        A dictionary containing the hash of the model's weights and the tiling settings
+        """
+        return {
+            'model': result_cache.hash_file(self.model_path),
+            'memory_budget_mb': self.memory_budget_mb,
+            'overlap': self.overlap,
+            'brick_shape': self.brick_shape
+        }
+
+    def get_tiling(self, volume_shape: Tuple[int, int, int]) -> Tuple[Tuple[int, int, int], int, List]:
+        """
+        Gets the bricks that a volume is split into
+
+        Parameters
+        ----------
+        volume_shape: The shape of the volume -> (depth, height, width)
+
+        Returns
+        -------
+        A tuple containing: 1. The brick shape
+                            2. The number of bricks denoised at once
+                            3. A list of the (d, i, j) corner of every brick
+        """
+        if self.brick_shape is not None:
+            brick_shape = tuple(min(brick_size, size) for brick_size, size in zip(self.brick_shape, volume_shape))
+        else:
+            brick_shape = get_brick_shape(volume_shape, self.memory_budget_mb, num_filters=self.num_filters,
+                                          overlap=self.overlap)
+
+        # Fit as many bricks in a batch as the budget allows
+        batch_size = self.batch_size
+        if batch_size is None:
+            brick_bytes = 4 * self.num_filters * ACTIVATION_COPIES_3D * int(np.prod(brick_shape))
+            batch_size = max(1, int(self.memory_budget_mb * 1024 ** 2 // brick_bytes))
+
+        corners = list(itertools.product(*[get_brick_starts(size, brick_size, self.overlap)
+                                           for size, brick_size in zip(volume_shape, brick_shape)]))
+        return brick_shape, batch_size, corners
+
+    def denoise_volume(self, volume: np.ndarray, reference_mean: float = None,
+                       reference_std: float = None) -> np.ndarray:
+        """
+        Denoises a 3D image volume brick by brick
+
+        Parameters
+        ----------
+        volume: The (uint8) blurry volume to denoise -> (depth, height, width), e.g. from
+            image_utils.get_3d_image_volume
+        reference_mean: The mean px value used to reverse the standardization of the denoised volume.
+            If None, the volume's own mean is used
+        reference_std: The standard deviation px value used to reverse the standardization of the denoised volume.
+            If None, the volume's own standard deviation is used
+
+        Returns
+        -------
+        The denoised (uint8) volume -> (depth, height, width)
+        """
+        standardized_volume, volume_mean, volume_std = image_utils.standardize(volume)
+        brick_shape, batch_size, corners = self.get_tiling(volume.shape)
+        window = get_blend_window(brick_shape, self.overlap)
+        depth, height, width = brick_shape
+
+        # Accumulate the window-weighted predictions of every brick, and the total weight of each voxel
+        weighted_sum = np.zeros(volume.shape, dtype='float32')
+        weight_sum = np.zeros(volume.shape, dtype='float32')
+        for batch_start in range(0, len(corners), batch_size):
+            batch_corners = corners[batch_start:batch_start + batch_size]
+            batch = np.array([standardized_volume[d:d + depth, i:i + height, j:j + width]
+                              for d, i, j in batch_corners], dtype='float32')[..., np.newaxis]
+            batch_pred = self.model.predict_on_batch(batch)
+            for (d, i, j), brick_pred in zip(batch_corners, np.asarray(batch_pred)):
+                weighted_sum[d:d + depth, i:i + height, j:j + width] += brick_pred[..., 0] * window
+                weight_sum[d:d + depth, i:i + height, j:j + width] += window
+
+        # Reverse the standardization of the blended volume
+        mean = volume_mean if reference_mean is None else reference_mean
+        std = volume_std if reference_std is None else reference_std
+        return image_utils.reverse_standardize(weighted_sum / weight_sum, original_mean=mean, original_std=std)
@@ -0,0 +1,118 @@
+"""
+Helpers for data-parallel training with tf.distribute, across the CPU cores or devices of one machine or several
+"""
+
+import os
+import sys
+import json
+import socket
+import subprocess
+import tensorflow as tf
+from typing import Callable, List
+
+
+def get_num_workers() -> int:
+    """ Gets the number of worker processes (chief and workers) of the cluster in TF_CONFIG, or 1 if it isn't set """
+    if 'TF_CONFIG' not in os.environ:
+        return 1
+    cluster = json.loads(os.environ['TF_CONFIG']).get('cluster', {})
+    return max(1, len(cluster.get('chief', [])) + len(cluster.get('worker', [])))
+
+
+def check_multi_worker_support(num_workers: int) -> None:
+    """
+    Checks that the installed Keras can train across num_workers worker processes. tf.keras 2 (e.g. the TensorFlow 2.3
+    of dependencies/environment.yml) can. Keras 3's Model.fit can't, as it reduces the first (x, y) batch across the
+    workers of a MultiWorkerMirroredStrategy, which only reduces single tensors
+
+    Parameters
+    ----------
+    num_workers: The number of worker processes
+
+    Returns
+    -------
+    None. Raises a RuntimeError if multi-worker training isn't supported
+    """
+    keras_version = getattr(tf.keras, '__version__', '2')
+    if num_workers > 1 and int(keras_version.split('.')[0]) >= 3:
+        raise RuntimeError(f'Training across {num_workers} workers needs tf.keras 2 (e.g. TensorFlow 2.3, as in '
+                           f'dependencies/environment.yml), but Keras {keras_version} is installed. Train with '
+                           f'--distributed=1 on the devices of a single machine instead')
+
+
+def get_strategy() -> tf.distribute.Strategy:
+    """
+    Gets the distribution strategy of this process: a MultiWorkerMirroredStrategy if the TF_CONFIG environment
+    variable describes a cluster of workers (one process per node), or else a MirroredStrategy over the local devices
+
+    Returns
+    -------
+    A tf.distribute.Strategy
+    """
+    if 'TF_CONFIG' in os.environ:
+        # The strategy left tf.distribute.experimental in TensorFlow 2.4
+        if hasattr(tf.distribute, 'MultiWorkerMirroredStrategy'):
+            return tf.distribute.MultiWorkerMirroredStrategy()
+        return tf.distribute.experimental.MultiWorkerMirroredStrategy()
+    return tf.distribute.MirroredStrategy()
+
+
+def distribute_datasets_from_function(strategy: tf.distribute.Strategy,
+                                      dataset_fn: Callable[[tf.distribute.InputContext], tf.data.Dataset]):
+    """
+    Builds one input pipeline per worker with dataset_fn, as strategy.distribute_datasets_from_function does (it was
+    experimental_distribute_datasets_from_function before TensorFlow 2.4)
+    """
+    if hasattr(strategy, 'distribute_datasets_from_function'):
+        return strategy.distribute_datasets_from_function(dataset_fn)
+    return strategy.experimental_distribute_datasets_from_function(dataset_fn)
+
+
+def is_chief(strategy: tf.distribute.Strategy) -> bool:
+    """
+    True if this process is the chief worker, which alone writes checkpoints and logs. This is the 'chief' task if the
+    cluster has one, or else worker 0. A single-process strategy is always its own chief.
+    """
+    cluster_resolver = getattr(strategy, 'cluster_resolver', None)
+    if cluster_resolver is None or cluster_resolver.task_type is None:
+        return True
+    if cluster_resolver.task_type == 'chief':
+        return True
+    return cluster_resolver.task_type == 'worker' and cluster_resolver.task_id == 0 and \
+        'chief' not in cluster_resolver.cluster_spec().as_dict()
+
+
+def _get_free_port() -> int:
+    """ Gets a TCP port on localhost that is free right now """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def launch_local_workers(num_workers: int, arguments: List[str] = None) -> int:
+    """
+    Runs this script as a cluster of num_workers processes on this machine, each with a TF_CONFIG for a
+    MultiWorkerMirroredStrategy, and waits for all of them. Meant for testing multi-worker training without a cluster.
+
+    Parameters
+    ----------
+    num_workers: The number of worker processes
+    arguments: The command-line arguments of every worker. If None, those of this process
+
+    Returns
+    -------
+    The largest exit code of the workers, i.e. 0 if every worker succeeded. Raises a RuntimeError, before starting
+    any worker, if the installed Keras can't train across several workers
+    """
+    check_multi_worker_support(num_workers)
+    arguments = arguments if arguments is not None else sys.argv[1:]
+    workers = [f'localhost:{_get_free_port()}' for _ in range(num_workers)]
+
+    processes = []
+    for task_id in range(num_workers):
+        tf_config = {'cluster': {'worker': workers}, 'task': {'type': 'worker', 'index': task_id}}
+        environment = dict(os.environ, TF_CONFIG=json.dumps(tf_config))
+        print(f'Starting worker {task_id} of {num_workers} at {workers[task_id]}')
+        processes.append(subprocess.Popen([sys.executable, sys.argv[0]] + arguments, env=environment))
+
+    return max(process.wait() for process in processes)
@@ -0,0 +1,41 @@
+"""
+Helpers for writing files that other processes may read (or create) concurrently
+"""
+
+import os
+import tempfile
+from typing import IO, Callable
+
+
+def atomic_write(path: str, write_fn: Callable[[IO], None], binary: bool = False, overwrite: bool = True) -> None:
+    """
+    Writes a file through a temporary file in the same directory, which is moved into place only once it is complete,
+    so that readers never see (and a crash never leaves behind) a partially written file. The temporary file is
+    removed if writing it fails
+
+    Parameters
+    ----------
+    path: The path of the file to write
+    write_fn: A function that writes the contents of the file to an open file object
+    binary: True if the file should be opened in binary mode, e.g. for np.save
+    overwrite: If True, the file replaces any existing file at path. If False, it is linked into place instead, which
+        raises FileExistsError if path already exists, so that only one of several processes creating it succeeds
+
+    Returns
+    -------
+    None
+    """
+    file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                                  prefix=f'.{os.path.basename(path)}.', suffix='.tmp')
+    moved = False
+    try:
+        with os.fdopen(file_descriptor, 'wb' if binary else 'w') as file:
+            write_fn(file)
+        if overwrite:
+            os.replace(temp_path, path)
+            moved = True
+        else:
+            os.link(temp_path, path)
+    finally:
+        if not moved:
+            os.remove(temp_path)
@@ -109,13 +109,18 @@ def CLAHE_single_image(image, clip_limit=2.0, tile_grid_size=(8, 8)):
     return clahe.apply(image)
 
 
-def standardize(x):
+def standardize(x, mean=None, std=None):
     """
     Standardizes an input image as a numpy array to have a mean of 0 and standard
     deviation of 1.
 
     :param x: The input image
     :type x: numpy array
+    :param mean: An optional precomputed mean to standardize with (e.g. from streaming dataset statistics).
+                 If None, the mean of x is used
+    :type mean: float
+    :param std: An optional precomputed standard deviation to standardize with. If None, the std of x is used
+    :type std: float
 
     :return: A tuple containing: 1. The standardized image
                                  2. The mean pixel value of the original input
@@ -126,8 +131,9 @@ def standardize(x):
     # Convert x to an array of single-precision floats
     x = x.astype('float32')
 
-    # Get the global mean and standard deviation from x
-    original_mean, original_std = (x.mean(), x.std())
+    # Get the global mean and standard deviation from x, unless they are given
+    original_mean = x.mean() if mean is None else np.float32(mean)
+    original_std = x.std() if std is None else np.float32(std)
 
     # Globally standardize the pixels
     if original_std != 0.0:
@@ -449,7 +455,7 @@ def get_residual(clear_image, blurry_image):
     return residual
 
 
-def get_3d_image_volume(image_dir: str) -> np.ndarray:
+def get_3d_image_volume_file_names(image_dir: str) -> List[str]:
     """
 
     Parameters
@@ -458,23 +464,36 @@ def get_3d_image_volume(image_dir: str) -> np.ndarray:
 
     Returns
     -------
-    All images in image_dir concatenated together into a 3d image volume
+    The file names of the image slices in image_dir, in the order in which get_3d_image_volume stacks them
     """
-    images_and_numbers = []
+    names_and_numbers = []
     # Iterate over the entire list of images
-    for i, file_name in enumerate(os.listdir(image_dir)):
+    for file_name in os.listdir(image_dir):
         if file_name.endswith('.jpg') or file_name.endswith('.png'):
-            # Open the image
-            image = cv2.imread(os.path.join(image_dir, file_name), 0)
             # Get the number of the image
             image_number = list(map(int, re.findall(r'\d+', file_name)))[0]
-            # Add a tuple containing the image and its number to the list of images
-            images_and_numbers.append((image, image_number))
+            # Add a tuple containing the file name and its number to the list of file names
+            names_and_numbers.append((file_name, image_number))
+
+    # Sort the list of file names and numbers by number
+    names_and_numbers = sorted(names_and_numbers, key=lambda x: x[1])
+    return [file_name for file_name, number in names_and_numbers]
+
+
+def get_3d_image_volume(image_dir: str) -> np.ndarray:
+    """
 
-    # Sort the list of images and numbers by number
-    images_and_numbers = sorted(images_and_numbers, key=lambda x: x[1])
-    # Only get the images from the images and numbers list
-    images = np.array([image for image, number in images_and_numbers])
+    Parameters
+    ----------
+    image_dir: Directory containing image slices
+
+    Returns
+    -------
+    All images in image_dir concatenated together into a 3d image volume
+    """
+    # Open every image, in order of its number
+    images = np.array([cv2.imread(os.path.join(image_dir, file_name), 0)
+                       for file_name in get_3d_image_volume_file_names(image_dir)])
     return images
 
 
@@ -0,0 +1,125 @@
+"""
+Nested stage timers and counters, for finding out where the time of an inference run goes
+"""
+
+import os
+import csv
+import json
+import time
+import threading
+import contextlib
+from typing import Dict
+
+
+class Instrumentation:
+    """
+    Thread-safe nested timers and counters.
+
+    A timer started inside another timer (in the same thread) is recorded under the path of both, e.g. 'denoise/route',
+    so each stage's time can be broken down further. Every process keeps its own Instrumentation: a worker process
+    returns a snapshot (a JSON-serializable dictionary) of what it recorded, which the parent merges into its own.
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def timer(self, name: str):
+        """
+        Times the block of a with statement, as a stage nested in the timers that are running in this thread
+
+        Parameters
+        ----------
+        name: The name of the stage, e.g. 'decode'
+        """
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(name)
+        path = '/'.join(stack)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            with self._lock:
+                timing = self.timings.setdefault(path, {'count': 0, 'seconds': 0.0})
+                timing['count'] += 1
+                timing['seconds'] += seconds
+
+    def count(self, name: str, amount: int = 1) -> None:
+        """ Adds amount to a counter, e.g. count('patches_low', 128) """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def get_count(self, name: str) -> int:
+        with self._lock:
+            return self.counters.get(name, 0)
+
+    def snapshot(self) -> Dict:
+        """ Gets a copy of the timings and counters recorded so far """
+        with self._lock:
+            return {'timings': {path: dict(timing) for path, timing in self.timings.items()},
+                    'counters': dict(self.counters)}
+
+    @staticmethod
+    def difference(after: Dict, before: Dict) -> Dict:
+        """ Gets what was recorded between two snapshots """
+        timings = {}
+        for path, timing in after['timings'].items():
+            timing_before = before['timings'].get(path, {'count': 0, 'seconds': 0.0})
+            if timing['count'] > timing_before['count']:
+                timings[path] = {'count': timing['count'] - timing_before['count'],
+                                 'seconds': timing['seconds'] - timing_before['seconds']}
+        counters = {name: value - before['counters'].get(name, 0) for name, value in after['counters'].items()
+                    if value != before['counters'].get(name, 0)}
+        return {'timings': timings, 'counters': counters}
+
+    def merge(self, snapshot: Dict, prefix: str = None) -> None:
+        """
+        Adds the timings and counters of a snapshot (e.g. from a worker process) to this Instrumentation
+
+        Parameters
+        ----------
+        snapshot: A snapshot from Instrumentation.snapshot or Instrumentation.difference
+        prefix: An optional prefix of the merged timer paths and counter names, e.g. a subject's name
+        """
+        with self._lock:
+            for path, timing in snapshot['timings'].items():
+                path = path if prefix is None else f'{prefix}/{path}'
+                merged_timing = self.timings.setdefault(path, {'count': 0, 'seconds': 0.0})
+                merged_timing['count'] += timing['count']
+                merged_timing['seconds'] += timing['seconds']
+            for name, value in snapshot['counters'].items():
+                name = name if prefix is None else f'{prefix}/{name}'
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def write_report(self, report_dir: str, name: str = 'instrumentation') -> None:
+        """
+        Writes the timings and counters to <report_dir>/<name>.json, and to <report_dir>/<name>.csv with one row per
+        timer or counter
+
+        Parameters
+        ----------
+        report_dir: The directory of the report, e.g. the directory of the run's log.txt
+        name: The file name of the report, without its extension
+
+        Returns
+        -------
+        None
+        """
+        snapshot = self.snapshot()
+        with open(os.path.join(report_dir, name + '.json'), 'w') as file:
+            json.dump(snapshot, file, indent=2, sort_keys=True)
+        with open(os.path.join(report_dir, name + '.csv'), 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['kind', 'name', 'count', 'seconds', 'mean_ms'])
+            for path, timing in sorted(snapshot['timings'].items()):
+                writer.writerow(['timer', path, timing['count'], f'{timing["seconds"]:.6f}',
+                                 f'{1000 * timing["seconds"] / timing["count"]:.3f}'])
+            for counter_name, value in sorted(snapshot['counters'].items()):
+                writer.writerow(['counter', counter_name, value, '', ''])
@@ -0,0 +1,243 @@
+"""
+A DAG of jobs (commands or Python functions) that runs independent jobs in parallel within CPU and memory budgets,
+skips jobs whose inputs and configuration haven't changed since they last succeeded, and resumes after crashes
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Dict, List
+from utilities.file_utils import atomic_write
+
+
+def fingerprint_path(path: str) -> str:
+    """
+    Gets a fingerprint of a file, or of every file in a directory, from their names, sizes and modification times
+
+    Parameters
+    ----------
+    path: The path of a file or directory
+
+    Returns
+    -------
+    A hex digest, which is the same for a path that doesn't exist
+    """
+    hasher = hashlib.sha256()
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        hasher.update(f'{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    elif os.path.isdir(path):
+        for root, directory_names, file_names in os.walk(path):
+            directory_names.sort()
+            for file_name in sorted(file_names):
+                stat = os.stat(os.path.join(root, file_name))
+                relative_path = os.path.relpath(os.path.join(root, file_name), path)
+                hasher.update(f'{relative_path}:{stat.st_size}:{stat.st_mtime_ns}\n'.encode())
+    return hasher.hexdigest()
+
+
+class Job:
+    """
+    A single job of a JobDAG: either a command, run as a subprocess, or a Python function, run in a thread
+    """
+
+    def __init__(self, name: str, command: List[str] = None, function: Callable[[], None] = None,
+                 dependencies: List[str] = (), inputs: List[str] = (), outputs: List[str] = (), config: Dict = None,
+                 cpus: int = 1, memory_mb: float = 1024):
+        """
+        Constructor for Job
+
+        Parameters
+        ----------
+        name: The unique name of the job, which is also used as a file name
+        command: The command line of the job, e.g. [sys.executable, 'scripts/train.py', ...]
+        function: A Python function to call instead of running a command
+        dependencies: The names of the jobs that must succeed before this job can run
+        inputs: Files or directories that the job reads (apart from the outputs of its dependencies). The job is re-run
+            if any of them changes
+        outputs: Files or directories that the job writes. The job is re-run if any of them is missing
+        config: Any other settings that affect the job's output (for a function, its arguments). The job is re-run if
+            they change
+        cpus: The number of CPU cores the job uses, which is also the thread count given to its TensorFlow
+        memory_mb: The peak memory the job uses, in MB
+        """
+        if (command is None) == (function is None):
+            raise ValueError(f"Job '{name}' needs exactly one of a command or a function")
+        self.name = name
+        self.command = command
+        self.function = function
+        self.dependencies = list(dependencies)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.config = config if config is not None else {}
+        self.cpus = cpus
+        self.memory_mb = memory_mb
+
+
+class JobDAG:
+    """
+    Runs a DAG of Jobs. Each job is keyed by a hash of its command (or function name), config, the fingerprints of its
+    inputs, and the keys of its dependencies, so a change anywhere upstream re-runs everything downstream of it. The
+    key of every job that succeeds is recorded in <state_dir>/done, so a later run (e.g. after a crash) skips it.
+    """
+
+    def __init__(self, state_dir: str, max_cpus: int = None, max_memory_mb: float = None):
+        """
+        Constructor for JobDAG
+
+        Parameters
+        ----------
+        state_dir: The directory in which the completion records and logs of the jobs are kept
+        max_cpus: The total number of CPU cores that running jobs may use. If None, every core
+        max_memory_mb: The total memory, in MB, that running jobs may use. If None, there is no memory budget
+        """
+        self.state_dir = state_dir
+        self.max_cpus = max_cpus if max_cpus is not None else (os.cpu_count() or 1)
+        self.max_memory_mb = max_memory_mb
+        self.jobs = {}
+        self._keys = {}
+        os.makedirs(os.path.join(state_dir, 'done'), exist_ok=True)
+        os.makedirs(os.path.join(state_dir, 'logs'), exist_ok=True)
+
+    def add(self, job: Job) -> Job:
+        """ Adds a job, whose dependencies must already have been added """
+        if job.name in self.jobs:
+            raise ValueError(f"A job named '{job.name}' already exists")
+        for dependency in job.dependencies:
+            if dependency not in self.jobs:
+                raise ValueError(f"Job '{job.name}' depends on '{dependency}', which hasn't been added")
+        self.jobs[job.name] = job
+        return job
+
+    def get_key(self, name: str) -> str:
+        """ Gets the key of a job, from everything that affects its output """
+        if name not in self._keys:
+            job = self.jobs[name]
+            description = {
+                'command': job.command,
+                'function': None if job.function is None else f'{job.function.__module__}.{job.function.__qualname__}',
+                'config': job.config,
+                'inputs': {path: fingerprint_path(path) for path in job.inputs},
+                'dependencies': {dependency: self.get_key(dependency) for dependency in job.dependencies}
+            }
+            self._keys[name] = hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+        return self._keys[name]
+
+    def _done_path(self, name: str) -> str:
+        return os.path.join(self.state_dir, 'done', name + '.json')
+
+    def is_up_to_date(self, name: str) -> bool:
+        """ True if the job last succeeded with its current key, and all of its outputs still exist """
+        try:
+            with open(self._done_path(name)) as file:
+                record = json.load(file)
+        except (OSError, ValueError):
+            return False
+        return record['key'] == self.get_key(name) and all(os.path.exists(path) for path in self.jobs[name].outputs)
+
+    def _run_job(self, job: Job) -> None:
+        """ Runs a single job, logging a command's output to <state_dir>/logs/<name>.log """
+        if job.function is not None:
+            job.function()
+            return
+        # Give the job's TensorFlow (and OpenMP) as many threads as the job has cores
+        environment = dict(os.environ, OMP_NUM_THREADS=str(job.cpus), TF_NUM_INTRAOP_THREADS=str(job.cpus),
+                           TF_NUM_INTEROP_THREADS='1')
+        with open(os.path.join(self.state_dir, 'logs', job.name + '.log'), 'w') as log_file:
+            subprocess.run(job.command, stdout=log_file, stderr=subprocess.STDOUT, env=environment, check=True)
+
+    def _record_done(self, job: Job, seconds: float) -> None:
+        """ Records that a job succeeded. The record is written atomically, so a crash never truncates it """
+        record = {'key': self.get_key(job.name), 'seconds': seconds, 'finished_at': time.time()}
+        atomic_write(self._done_path(job.name), lambda file: json.dump(record, file))
+
+    def _fits(self, job: Job, used_cpus: int, used_memory_mb: float) -> bool:
+        """ True if a job fits in what is left of the budgets. A job larger than a budget may still run alone """
+        if used_cpus == 0 and used_memory_mb == 0:
+            return True
+        if used_cpus + job.cpus > self.max_cpus:
+            return False
+        return self.max_memory_mb is None or used_memory_mb + job.memory_mb <= self.max_memory_mb
+
+    def run(self, dry_run: bool = False) -> Dict[str, str]:
+        """
+        Runs every job that isn't up to date, as soon as its dependencies have succeeded and it fits in the budgets.
+        A failed job doesn't stop independent jobs, but the jobs that depend on it are not run.
+
+        Parameters
+        ----------
+        dry_run: True if we only wish to print which jobs would run
+
+        Returns
+        -------
+        A dictionary from job name to its status: 'skipped' (up to date), 'done', 'failed', 'blocked' (a dependency
+        failed), or 'pending' (in a dry run)
+        """
+        statuses = {}
+        for name in self.jobs:
+            if self.is_up_to_date(name) and all(statuses[dependency] == 'skipped'
+                                                for dependency in self.jobs[name].dependencies):
+                statuses[name] = 'skipped'
+        print(f'{len(statuses)} of {len(self.jobs)} jobs are up to date')
+        if dry_run:
+            for name in self.jobs:
+                if name not in statuses:
+                    statuses[name] = 'pending'
+                    print(f'Would run {name}')
+            return statuses
+
+        running = {}
+        start_times = {}
+        used_cpus = 0
+        used_memory_mb = 0
+        with ThreadPoolExecutor(max_workers=max(1, len(self.jobs))) as executor:
+            while True:
+                # Block the jobs whose dependencies failed
+                for name, job in self.jobs.items():
+                    if name not in statuses and any(statuses.get(dependency) in ('failed', 'blocked')
+                                                    for dependency in job.dependencies):
+                        statuses[name] = 'blocked'
+                        print(f'Blocked {name}')
+
+                # Start every ready job that fits in the budgets, in the order in which the jobs were added
+                for name, job in self.jobs.items():
+                    if name in statuses or name in running.values():
+                        continue
+                    if not all(statuses.get(dependency) in ('skipped', 'done') for dependency in job.dependencies):
+                        continue
+                    if not self._fits(job, used_cpus, used_memory_mb):
+                        continue
+                    for output in job.outputs:
+                        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+                    print(f'Starting {name} ({job.cpus} CPUs, {job.memory_mb} MB)')
+                    running[executor.submit(self._run_job, job)] = name
+                    start_times[name] = time.time()
+                    used_cpus += job.cpus
+                    used_memory_mb += job.memory_mb
+
+                if not running:
+                    break
+
+                # Wait for a job to finish
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    job = self.jobs[name]
+                    used_cpus -= job.cpus
+                    used_memory_mb -= job.memory_mb
+                    seconds = time.time() - start_times[name]
+                    try:
+                        future.result()
+                    except Exception as error:
+                        statuses[name] = 'failed'
+                        print(f'FAILED {name} after {seconds:.0f} s: {error}', file=sys.stderr)
+                        continue
+                    self._record_done(job, seconds)
+                    statuses[name] = 'done'
+                    print(f'Finished {name} in {seconds:.0f} s')
+
+        return statuses
@@ -0,0 +1,317 @@
+"""
+Opt-in peak-memory profiling of the stages of training and inference, to find out which step allocates what
+"""
+
+import os
+import csv
+import json
+import time
+import threading
+import contextlib
+import tracemalloc
+from typing import List, Dict
+from tensorflow.keras.callbacks import Callback
+from utilities import patch_dataset
+from utilities.throughput import get_peak_rss_mb
+
+MB = 1024 ** 2
+
+# The approximate size of a numpy view of a patch, plus its pointer in a Python list
+LIST_ITEM_BYTES = 120
+
+# For each train.py generator, the bytes alive at the peak of each stage, as (bytes per px, bytes per patch) of the
+# N * patch_size ** 2 px of N patch windows (counting the clear and blurry patches as 1 px each)
+TRAIN_STAGE_BYTES = {
+    'single_model': {
+        # The lists of clear and blurry patch views, then their uint8 arrays (2 px)
+        'patch_generation': (2, 2 * LIST_ITEM_BYTES),
+        # Those arrays (2), the lists of non-black patches, and their uint8 arrays (2)
+        'filtering': (4, 2 * LIST_ITEM_BYTES),
+        # The arrays of all (2) and non-black (2) patches, and their copies without the discarded patches (2)
+        'np.delete': (6, 0),
+        # The arrays of all patches (2), the uint8 blurry patches (1), the float32 clear patches (4), and while the
+        # blurry patches are standardized: their float32 copy, that copy minus the mean, and the result (12)
+        'standardization': (19, 0),
+        # The arrays of all patches (2), and the float32 clear and blurry patches (8)
+        'fit': (10, 0)
+    },
+    'psnr_window': {
+        'patch_generation': (2, 2 * LIST_ITEM_BYTES),
+        'filtering': (4, 2 * LIST_ITEM_BYTES),
+        'np.delete': (6, 0),
+        # As for 'single_model', but the uint8 clear patches are also kept (1)
+        'standardization': (20, 0),
+        'fit': (12, 0)
+    }
+}
+
+
+def get_rss_mb() -> float:
+    """ Gets the resident memory of this process right now, in MB (or its peak so far, where that isn't available) """
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / MB
+    except (OSError, ValueError, IndexError):
+        return get_peak_rss_mb()
+
+
+def estimate_train_memory_mb(train_data_dirs: List[str], generator: str = 'single_model', patch_size: int = 40,
+                             stride: int = 10, scales: List[float] = [1, 0.9, 0.8, 0.7]) -> Dict[str, float]:
+    """
+    Estimates the memory that the patches of each training stage need at its peak, from the sizes of the training
+    images alone, so that a run that won't fit can be stopped before loading anything. The estimates are upper bounds,
+    as every patch window is assumed to pass the filters, and they leave out TensorFlow and the model.
+
+    Parameters
+    ----------
+    train_data_dirs: The training data directories, as given by --train_data
+    generator: The train.py generator whose stages to estimate: 'single_model' (my_train_datagen_single_model),
+        'psnr_window' (my_train_datagen_estimated_with_psnr), or 'stratified' (my_train_datagen_stratified)
+    patch_size: The size of each patch in pixels -> (patch_size, patch_size)
+    stride: The stride with which to slide the patch-taking window
+    scales: A list of scales at which image patches are created
+
+    Returns
+    -------
+    A dictionary mapping each stage to its estimated peak in MB
+    """
+    num_windows = patch_dataset.count_patch_windows(train_data_dirs, patch_size=patch_size, stride=stride,
+                                                    scales=scales)
+    if generator == 'stratified':
+        # Only the indexed patch store is kept, and each batch is standardized on its own
+        store_mb = patch_dataset.estimate_patch_store_bytes(num_windows, patch_size=patch_size) / MB
+        return {'patch_generation': store_mb, 'fit': store_mb}
+    if generator not in TRAIN_STAGE_BYTES:
+        raise ValueError(f"Unknown generator '{generator}', choose from {['stratified'] + list(TRAIN_STAGE_BYTES)}")
+
+    num_pixels = num_windows * patch_size * patch_size
+    return {stage: (bytes_per_pixel * num_pixels + bytes_per_patch * num_windows) / MB
+            for stage, (bytes_per_pixel, bytes_per_patch) in TRAIN_STAGE_BYTES[generator].items()}
+
+
+class MemoryProfiler:
+    """
+    Records the resident memory (RSS) and the Python allocations (traced with tracemalloc, which includes numpy's) of
+    each stage of a run: at its start and end, its peak, and the source lines that hold the most traced memory when it
+    ends. Each peak is also reported above the baseline RSS at the start of the first stage, which is what
+    estimate_train_memory_mb estimates.
+
+    The RSS is sampled by a background thread while any stage runs, and a stage that raises the high-water mark of the
+    process gets that exact peak. Stages may overlap (e.g. a stage of a generator that runs inside 'fit'). A stage that
+    runs more than once keeps its largest peak. A disabled profiler records nothing, so its stages cost nothing.
+
+    Tracing allocations slows Python code down, so only enable profiling when looking for where memory goes.
+    """
+
+    def __init__(self, enabled: bool = True, report_dir: str = None, sample_seconds: float = 0.05,
+                 num_top_allocations: int = 10):
+        """
+        Constructor for MemoryProfiler
+
+        Parameters
+        ----------
+        enabled: False to record nothing
+        report_dir: If given, the report is rewritten into this directory whenever a stage ends, so that it survives
+            the run being killed for running out of memory
+        sample_seconds: The interval at which the RSS is sampled while a stage runs
+        num_top_allocations: The number of source lines with the most traced memory to record per stage
+        """
+        self.enabled = enabled
+        self.report_dir = report_dir
+        self.sample_seconds = sample_seconds
+        self.num_top_allocations = num_top_allocations
+        self.stages = {}
+        self.estimates_mb = {}
+        self.baseline_rss_mb = None
+        self._running = {}
+        self._next_token = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def _start_sampling(self) -> None:
+        """ Starts tracing allocations and sampling the RSS, once """
+        if self._sampler is not None:
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self._sampler = threading.Thread(target=self._sample, name='memory_profiler', daemon=True)
+        self._sampler.start()
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.sample_seconds):
+            rss_mb = get_rss_mb()
+            with self._lock:
+                for record in self._running.values():
+                    record['rss_peak_mb'] = max(record['rss_peak_mb'], rss_mb)
+
+    def _update_traced_peaks(self) -> None:
+        """ Adds the traced peak since the last update to every running stage. Call with the lock held """
+        _, traced_peak = tracemalloc.get_traced_memory()
+        for record in self._running.values():
+            record['traced_peak_mb'] = max(record['traced_peak_mb'], traced_peak / MB)
+        tracemalloc.reset_peak()
+
+    def start_stage(self, name: str) -> int:
+        """
+        Starts recording a stage. Prefer the stage context manager, unless the stage starts and ends in different
+        functions (e.g. in the callbacks of a Keras Callback)
+
+        Returns
+        -------
+        The token to pass to end_stage, or None if the profiler is disabled
+        """
+        if not self.enabled:
+            return None
+        self._start_sampling()
+        rss_mb = get_rss_mb()
+        with self._lock:
+            if self.baseline_rss_mb is None:
+                self.baseline_rss_mb = rss_mb
+            self._update_traced_peaks()
+            traced_mb = tracemalloc.get_traced_memory()[0] / MB
+            token = self._next_token
+            self._next_token += 1
+            self._running[token] = {'name': name, 'start': time.perf_counter(), 'rss_start_mb': rss_mb,
+                                    'rss_peak_mb': rss_mb, 'high_water_mark_mb': get_peak_rss_mb(),
+                                    'traced_start_mb': traced_mb, 'traced_peak_mb': traced_mb}
+        return token
+
+    def end_stage(self, token: int) -> None:
+        """ Ends recording the stage of a token from start_stage """
+        if token is None:
+            return
+        rss_mb = get_rss_mb()
+        high_water_mark_mb = get_peak_rss_mb()
+        top_allocations = [{'location': f'{statistic.traceback[0].filename}:{statistic.traceback[0].lineno}',
+                            'size_mb': round(statistic.size / MB, 3), 'count': statistic.count}
+                           for statistic in tracemalloc.take_snapshot().statistics('lineno')[:self.num_top_allocations]]
+
+        with self._lock:
+            self._update_traced_peaks()
+            record = self._running.pop(token)
+            rss_peak_mb = max(record['rss_peak_mb'], rss_mb)
+
+            # If the stage raised the high-water mark of the process, the new mark is the stage's exact peak
+            if high_water_mark_mb > record['high_water_mark_mb']:
+                rss_peak_mb = max(rss_peak_mb, high_water_mark_mb)
+
+            stage = self.stages.setdefault(record['name'], {'count': 0, 'seconds': 0.0,
+                                                            'rss_start_mb': record['rss_start_mb'],
+                                                            'rss_peak_mb': 0.0, 'rss_increase_mb': 0.0,
+                                                            'python_peak_mb': 0.0})
+            stage['count'] += 1
+            stage['seconds'] += time.perf_counter() - record['start']
+            stage['rss_end_mb'] = rss_mb
+            stage['rss_above_baseline_mb'] = max(stage.get('rss_above_baseline_mb', 0.0),
+                                                 rss_peak_mb - self.baseline_rss_mb)
+            stage['rss_increase_mb'] = max(stage['rss_increase_mb'], rss_peak_mb - record['rss_start_mb'])
+            stage['python_peak_mb'] = max(stage['python_peak_mb'], record['traced_peak_mb'] - record['traced_start_mb'])
+            if rss_peak_mb >= stage['rss_peak_mb']:
+                stage['rss_peak_mb'] = rss_peak_mb
+                stage['top_allocations'] = top_allocations
+
+        print(f'Memory of {record["name"]}: peak RSS {rss_peak_mb:.1f} MB '
+              f'(+{rss_peak_mb - record["rss_start_mb"]:.1f} MB), peak Python allocations '
+              f'{record["traced_peak_mb"] - record["traced_start_mb"]:.1f} MB')
+        if self.report_dir is not None:
+            self.write_report(self.report_dir)
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """
+        Records the memory of the block of a with statement as a stage
+
+        Parameters
+        ----------
+        name: The name of the stage, e.g. 'patch_generation'
+        """
+        token = self.start_stage(name)
+        try:
+            yield
+        finally:
+            self.end_stage(token)
+
+    def set_estimates(self, estimates_mb: Dict[str, float]) -> None:
+        """ Sets the estimated peak in MB of each stage (e.g. from estimate_train_memory_mb), to report alongside """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.estimates_mb = dict(estimates_mb)
+        if self.report_dir is not None:
+            self.write_report(self.report_dir)
+
+    def stop(self) -> None:
+        """ Stops sampling the RSS and tracing allocations """
+        if self._sampler is None:
+            return
+        self._stop.set()
+        self._sampler.join()
+        self._sampler = None
+        tracemalloc.stop()
+
+    def get_table(self) -> str:
+        """ Gets the per-stage memory table as text """
+        with self._lock:
+            names = list(self.stages) + [name for name in self.estimates_mb if name not in self.stages]
+            lines = ['%-20s %14s %14s %15s %14s %16s' % ('stage', 'estimate (MB)', 'peak RSS (MB)',
+                                                          'above base (MB)', 'increase (MB)', 'Python peak (MB)')]
+            for name in names:
+                stage = self.stages.get(name, {})
+                estimate_mb = self.estimates_mb.get(name)
+                lines.append('%-20s %14s %14s %15s %14s %16s' % (
+                    name, '' if estimate_mb is None else f'{estimate_mb:.1f}',
+                    *('' if key not in stage else f'{stage[key]:.1f}'
+                      for key in ('rss_peak_mb', 'rss_above_baseline_mb', 'rss_increase_mb', 'python_peak_mb'))))
+        return '\n'.join(lines)
+
+    def write_report(self, report_dir: str, name: str = 'memory_profile') -> None:
+        """
+        Writes the memory of every stage to <report_dir>/<name>.csv (the per-stage peak table) and to
+        <report_dir>/<name>.json (which also holds the top allocations of each stage)
+
+        Parameters
+        ----------
+        report_dir: The directory of the report, e.g. the directory of the run's log
+        name: The file name of the report, without its extension
+
+        Returns
+        -------
+        None
+        """
+        with self._lock:
+            stages = {stage_name: dict(stage) for stage_name, stage in self.stages.items()}
+            estimates_mb = dict(self.estimates_mb)
+
+        os.makedirs(report_dir, exist_ok=True)
+        with open(os.path.join(report_dir, name + '.json'), 'w') as file:
+            json.dump({'baseline_rss_mb': self.baseline_rss_mb, 'stages': stages, 'estimates_mb': estimates_mb}, file,
+                      indent=2)
+
+        columns = ['rss_start_mb', 'rss_end_mb', 'rss_peak_mb', 'rss_above_baseline_mb', 'rss_increase_mb',
+                   'python_peak_mb']
+        with open(os.path.join(report_dir, name + '.csv'), 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['stage', 'count', 'seconds', 'estimated_mb'] + columns)
+            for stage_name in list(stages) + [stage_name for stage_name in estimates_mb if stage_name not in stages]:
+                stage = stages.get(stage_name, {})
+                estimate_mb = estimates_mb.get(stage_name)
+                writer.writerow([stage_name, stage.get('count', 0), f'{stage.get("seconds", 0.0):.3f}',
+                                 '' if estimate_mb is None else f'{estimate_mb:.1f}'] +
+                                ['' if column not in stage else f'{stage[column]:.1f}' for column in columns])
+
+
+class MemoryProfileCallback(Callback):
+    """ Records the training loop (from the start of Model.fit's first epoch to its end) as the 'fit' stage """
+
+    def __init__(self, profiler: MemoryProfiler):
+        super().__init__()
+        self.profiler = profiler
+        self.token = None
+
+    def on_train_begin(self, logs=None):
+        self.token = self.profiler.start_stage('fit')
+
+    def on_train_end(self, logs=None):
+        self.profiler.end_stage(self.token)
+        print(self.profiler.get_table())
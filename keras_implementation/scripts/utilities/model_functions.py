@@ -3,12 +3,16 @@
 from tensorflow.keras.layers import Input, Conv2D, Conv3D, BatchNormalization, Activation, Subtract
 
 from tensorflow.keras.models import Model, load_model
+import tensorflow as tf
+import numpy as np
 from tensor2tensor.utils import expert_utils
 from tensor2tensor.utils import hparam
 
 import glob
 import os
 import re
+import math
+from typing import List, Tuple
 
 
 def findLastCheckpoint(save_dir: str):
@@ -30,6 +34,139 @@ def findLastCheckpoint(save_dir: str):
     return initial_epoch
 
 
+class CompiledPredictor:
+    """
+    Runs a Keras model's forward pass through a cached tf.function (optionally XLA-compiled with jit_compile), as a
+    drop-in replacement for Model.predict without its per-call overhead (callbacks, data adapters, and retracing).
+
+    Batches are zero-padded up to one of a few batch-size buckets (powers of two), and optionally their spatial
+    dimensions are padded up to a multiple of spatial_multiple, so that only a small, fixed set of input shapes is
+    ever compiled. Every sample is predicted independently (BatchNorm uses its moving statistics at inference), so
+    padding the batch never changes the predictions of the real samples.
+    """
+
+    def __init__(self, model: Model, max_batch_size: int = 128, min_batch_size: int = 8, spatial_multiple: int = None,
+                 jit_compile: bool = True):
+        """
+        Constructor for CompiledPredictor
+
+        Parameters
+        ----------
+        model: The Keras model to run
+        max_batch_size: The largest batch run at once. Larger inputs are split into batches of this size
+        min_batch_size: The smallest batch-size bucket. Smaller batches are padded up to it
+        spatial_multiple: If not None, the spatial dimensions of each input are padded (by reflection) up to a
+            multiple of this, e.g. so that slices of slightly different sizes share a compiled shape. The prediction
+            is cropped back to the input size, but px near the padded edges may differ slightly from Model.predict
+        jit_compile: True if the forward pass should be compiled with XLA
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.spatial_multiple = spatial_multiple
+
+        # Get the batch-size buckets: powers of two from min_batch_size up to (and including) max_batch_size
+        bucket = min(min_batch_size, max_batch_size)
+        self.batch_buckets = []
+        while bucket < max_batch_size:
+            self.batch_buckets.append(bucket)
+            bucket *= 2
+        self.batch_buckets.append(max_batch_size)
+
+        # Trace the forward pass once, for inputs of any batch size and spatial size
+        input_shape = model.input_shape
+        input_signature = [tf.TensorSpec(shape=(None,) * (len(input_shape) - 1) + (input_shape[-1],),
+                                         dtype=tf.float32)]
+        try:
+            self._forward = tf.function(self._call_model, jit_compile=jit_compile, input_signature=input_signature)
+        except TypeError:
+            # jit_compile was experimental_compile before TensorFlow 2.5
+            self._forward = tf.function(self._call_model, experimental_compile=jit_compile,
+                                        input_signature=input_signature)
+
+    def _call_model(self, batch):
+        return self.model(batch, training=False)
+
+    def get_batch_bucket(self, batch_size: int) -> int:
+        """
+        Gets the batch size that a batch of batch_size samples is padded up to
+
+        Parameters
+        ----------
+        batch_size: The number of samples in the batch, at most max_batch_size
+
+        Returns
+        -------
+        The smallest batch-size bucket that fits the batch
+        """
+        for bucket in self.batch_buckets:
+            if bucket >= batch_size:
+                return bucket
+        return self.max_batch_size
+
+    def warmup(self, input_shapes: List[Tuple]) -> None:
+        """
+        Compiles the forward pass for every batch-size bucket of some input shapes ahead of time, so that the first
+        real batches don't pay for it
+
+        Parameters
+        ----------
+        input_shapes: The shapes of a single input, without the batch dimension, e.g. [(40, 40, 1)]
+
+        Returns
+        -------
+        None
+        """
+        for input_shape in input_shapes:
+            padded_shape = self._get_padded_spatial_shape(input_shape[:-1]) + tuple(input_shape[-1:])
+            for bucket in self.batch_buckets:
+                self._forward(tf.zeros((bucket,) + padded_shape, dtype=tf.float32))
+
+    def _get_padded_spatial_shape(self, spatial_shape: Tuple) -> Tuple:
+        if self.spatial_multiple is None:
+            return tuple(spatial_shape)
+        return tuple(int(math.ceil(size / self.spatial_multiple)) * self.spatial_multiple for size in spatial_shape)
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        """
+        Runs a batch through the model, like Model.predict
+
+        Parameters
+        ----------
+        batch: The model inputs -> (N, ..., channels)
+
+        Returns
+        -------
+        The float32 model outputs, with the same batch and spatial size as the inputs
+        """
+        batch = np.asarray(batch, dtype='float32')
+        num_samples = len(batch)
+        spatial_shape = batch.shape[1:-1]
+
+        # Pad the spatial dimensions up to their bucket
+        padded_spatial_shape = self._get_padded_spatial_shape(spatial_shape)
+        if padded_spatial_shape != tuple(spatial_shape):
+            padding = [(0, 0)] + [(0, padded - size) for size, padded in zip(spatial_shape, padded_spatial_shape)] + \
+                      [(0, 0)]
+            batch = np.pad(batch, padding, mode='symmetric')
+
+        outputs = []
+        for start in range(0, num_samples, self.max_batch_size):
+            chunk = batch[start:start + self.max_batch_size]
+
+            # Pad the batch dimension up to its bucket
+            bucket = self.get_batch_bucket(len(chunk))
+            if len(chunk) < bucket:
+                chunk = np.concatenate([chunk, np.zeros((bucket - len(chunk),) + chunk.shape[1:], dtype='float32')])
+            outputs.append(self._forward(tf.constant(chunk)).numpy()[:min(self.max_batch_size, num_samples - start)])
+
+        # Crop the outputs back to the spatial size of the inputs
+        outputs = np.concatenate(outputs) if outputs else np.zeros((0,) + batch.shape[1:], dtype='float32')
+        return outputs[(slice(None),) + tuple(slice(0, size) for size in spatial_shape)]
+
+    def __call__(self, batch: np.ndarray) -> np.ndarray:
+        return self.predict(batch)
+
+
 def My3dDenoiser(depth, num_filters=64, use_batchnorm=True):
     """
     Complete implementation of My3dDenoiser, a 3D residual CNN using TensorFlow.
@@ -0,0 +1,342 @@
+"""
+Synthesizes noisy training patches from clear slices on the fly, without reading any blurry images from disk
+"""
+
+import os
+import numpy as np
+from typing import Iterator, List, Tuple, Union
+from utilities import image_utils, pyramid_cache
+from utilities.data_generator import get_patch_psnrs
+
+# The noise models that can be synthesized: Rician (the magnitude of complex Gaussian noise, as in MRI magnitude
+# images) and additive Gaussian
+NOISE_TYPES = ('rician', 'gaussian')
+
+# The PSNRs in dB that we synthesize noise for. The PSNR windows of the noise levels are open-ended (e.g. up to 100 dB
+# for low noise), so each window is clipped to these bounds before drawing target PSNRs from it
+SYNTHESIS_PSNR_BOUNDS = (10.0, 50.0)
+
+
+def get_noise_sigma(psnr: Union[float, np.ndarray]) -> Union[float, np.ndarray]:
+    """
+    Gets the standard deviation of the noise that gives roughly a target PSNR on uint8 images
+
+    Parameters
+    ----------
+    psnr: The target PSNR in dB, or an array of them
+
+    Returns
+    -------
+    The noise standard deviation in px values: 255 / 10 ** (psnr / 20)
+    """
+    return 255 / 10 ** (np.asarray(psnr, dtype='float64') / 20)
+
+
+def get_synthesis_window(low_psnr: float = None, high_psnr: float = None) -> Tuple[float, float]:
+    """
+    Clips a PSNR window (e.g. one of patch_dataset.NOISE_LEVEL_PSNR_WINDOWS) to SYNTHESIS_PSNR_BOUNDS
+
+    Parameters
+    ----------
+    low_psnr: The lower PSNR bound of the window. If None, there is no lower bound
+    high_psnr: The upper PSNR bound of the window. If None, there is no upper bound
+
+    Returns
+    -------
+    (low_psnr, high_psnr): The window from which target PSNRs are drawn
+    """
+    low_psnr = SYNTHESIS_PSNR_BOUNDS[0] if low_psnr is None else max(low_psnr, SYNTHESIS_PSNR_BOUNDS[0])
+    high_psnr = SYNTHESIS_PSNR_BOUNDS[1] if high_psnr is None else min(high_psnr, SYNTHESIS_PSNR_BOUNDS[1])
+    if low_psnr >= high_psnr:
+        raise ValueError(f'The PSNR window ({low_psnr}, {high_psnr}) is empty after clipping it to '
+                         f'{SYNTHESIS_PSNR_BOUNDS}')
+    return low_psnr, high_psnr
+
+
+def add_noise(images: np.ndarray, psnrs: Union[float, np.ndarray], noise_type: str = 'rician',
+              rng: Union[int, np.random.Generator] = None) -> np.ndarray:
+    """
+    Adds Rician or Gaussian noise to clear images, with the standard deviation that gives roughly each target PSNR
+
+    Parameters
+    ----------
+    images: The clear uint8 images, patches, or volume
+    psnrs: The target PSNR in dB of every image, or an array with the target PSNR of each image along the first axis
+    noise_type: 'rician' or 'gaussian'
+    rng: A seed, or the numpy random Generator to draw the noise from
+
+    Returns
+    -------
+    The noisy uint8 images
+    """
+    if noise_type not in NOISE_TYPES:
+        raise ValueError(f'noise_type must be one of {NOISE_TYPES}, not {noise_type}')
+    rng = np.random.default_rng(rng)
+
+    # Broadcast one standard deviation per image over the remaining axes
+    sigma = get_noise_sigma(psnrs)
+    sigma = sigma.reshape(sigma.shape + (1,) * (images.ndim - sigma.ndim))
+
+    noisy_images = images.astype('float32') + rng.normal(0, sigma, images.shape).astype('float32')
+    if noise_type == 'rician':
+        imaginary = rng.normal(0, sigma, images.shape).astype('float32')
+        noisy_images = np.sqrt(noisy_images ** 2 + imaginary ** 2)
+    return np.clip(np.round(noisy_images), 0, 255).astype('uint8')
+
+
+def tf_synthesize_pair(clear_patch, low_psnr: float = None, high_psnr: float = None, noise_type: str = 'rician'):
+    """
+    tf.data version of add_noise, to be used as a Dataset map over unbatched clear patches, e.g.
+    dataset.map(functools.partial(tf_synthesize_pair, low_psnr=30, high_psnr=100)). A target PSNR is drawn uniformly
+    from the clipped window for each patch. Unlike SyntheticPairSampler, the PSNR of the noisy patch is not checked.
+
+    :param clear_patch: A clear patch in px values -> (p, p, channels)
+    :param low_psnr: The lower PSNR bound of the window. If None, there is no lower bound
+    :param high_psnr: The upper PSNR bound of the window. If None, there is no upper bound
+    :param noise_type: 'rician' or 'gaussian'
+
+    :return: The (noisy, clear) float32 patches, in px values
+    """
+    import tensorflow as tf
+
+    if noise_type not in NOISE_TYPES:
+        raise ValueError(f'noise_type must be one of {NOISE_TYPES}, not {noise_type}')
+    low_psnr, high_psnr = get_synthesis_window(low_psnr, high_psnr)
+
+    clear_patch = tf.cast(clear_patch, tf.float32)
+    psnr = tf.random.uniform([], minval=low_psnr, maxval=high_psnr)
+    sigma = 255. / 10. ** (psnr / 20.)
+    noisy_patch = clear_patch + tf.random.normal(tf.shape(clear_patch), stddev=sigma)
+    if noise_type == 'rician':
+        noisy_patch = tf.sqrt(noisy_patch ** 2 + tf.random.normal(tf.shape(clear_patch), stddev=sigma) ** 2)
+    return tf.clip_by_value(tf.round(noisy_patch), 0., 255.), clear_patch
+
+
+class SyntheticPairSampler:
+    """
+    Keeps only clear slices in memory (e.g. the rescaled ClearImages of the training data, or phantom slices), and
+    makes each training batch from random (slice, i, j) windows of them, with synthesized noise.
+
+    Each patch gets its own target PSNR, drawn uniformly from the PSNR window of the noise level, clipped to
+    SYNTHESIS_PSNR_BOUNDS. Patches are accepted with the same rules as the training generators in train.py: black
+    patches are rejected, and only patches whose measured PSNR lies strictly inside the window are kept, so that the
+    synthesized pairs fall in the same low, medium, or high noise bin as the real pairs of that expert. Nothing is read
+    from disk once the slices are loaded, so the number of pairs is unlimited.
+    """
+
+    def __init__(self, clear_images: List[np.ndarray], patch_size: int = 40, stride: int = 10,
+                 low_psnr_threshold: float = None, high_psnr_threshold: float = None, noise_type: str = 'rician',
+                 black_threshold: int = 10, num_standardization_patches: int = 20000,
+                 standardization: Tuple[float, float, float, float] = None, seed: int = None):
+        """
+        Constructor for SyntheticPairSampler
+
+        Parameters
+        ----------
+        clear_images: The clear uint8 slices to draw patches from
+        patch_size: The size of each patch in pixels -> (patch_size, patch_size)
+        stride: The stride of the grid of patch windows
+        low_psnr_threshold: Only accept patches with a PSNR above this value. If None, there is no lower bound
+        high_psnr_threshold: Only accept patches with a PSNR below this value. If None, there is no upper bound
+        noise_type: 'rician' or 'gaussian'
+        black_threshold: Reject patches whose clear patch has a max px value below this value
+        num_standardization_patches: The number of accepted patches used to estimate the mean and standard deviation
+            with which the batches are standardized
+        standardization: An optional, precomputed (x_mean, x_std, y_mean, y_std) with which to standardize the
+            batches instead
+        seed: An optional seed for the random number generator
+        """
+        if noise_type not in NOISE_TYPES:
+            raise ValueError(f'noise_type must be one of {NOISE_TYPES}, not {noise_type}')
+
+        self.patch_size = patch_size
+        self.stride = stride
+        self.low_psnr_threshold = low_psnr_threshold
+        self.high_psnr_threshold = high_psnr_threshold
+        self.psnr_window = get_synthesis_window(low_psnr_threshold, high_psnr_threshold)
+        self.noise_type = noise_type
+        self.black_threshold = black_threshold
+        self.rng = np.random.default_rng(seed)
+
+        # Keep the slices that can hold a single patch, and count the patch windows in each of them
+        self.clear_images = [image for image in clear_images if min(image.shape) >= patch_size]
+        if len(self.clear_images) == 0:
+            raise ValueError(f'No images of at least {patch_size}x{patch_size} px were given')
+        self.num_rows = np.array([(image.shape[0] - patch_size) // stride + 1 for image in self.clear_images])
+        self.num_cols = np.array([(image.shape[1] - patch_size) // stride + 1 for image in self.clear_images])
+
+        # The cumulative number of windows, used to map a global window index to its image
+        self.window_offsets = np.cumsum(self.num_rows * self.num_cols)
+        self.num_windows = int(self.window_offsets[-1])
+
+        print(f'Synthesizing {noise_type} noise at {self.psnr_window[0]:.1f} to {self.psnr_window[1]:.1f} dB on '
+              f'{self.num_windows} patch windows in {len(self.clear_images)} clear slices')
+
+        # Estimate the mean and standard deviation of the accepted patches from a pilot sample, unless they are given
+        if standardization is not None:
+            self.x_mean, self.x_std, self.y_mean, self.y_std = standardization
+        else:
+            x, y = self.sample_patches(num_standardization_patches)
+            self.x_mean, self.x_std = float(x.mean()), float(x.std())
+            self.y_mean, self.y_std = float(y.mean()), float(y.std())
+
+    @classmethod
+    def from_train_data(cls, root_dirs: List[str], scales: List[float] = [1, 0.9, 0.8, 0.7],
+                        **kwargs) -> 'SyntheticPairSampler':
+        """
+        Makes a SyntheticPairSampler from the ClearImages of training data directories, at every scale. Only the clear
+        slices are read (from the pyramid cache, if it holds them); CoregisteredBlurryImages is never used.
+
+        Parameters
+        ----------
+        root_dirs: The paths of the training data directories, each containing ClearImages
+        scales: A list of scales at which we want to create image patches
+        kwargs: The other arguments of the constructor
+
+        Returns
+        -------
+        A SyntheticPairSampler
+        """
+        clear_images = []
+        for root_dir in root_dirs:
+            clear_image_dir = os.path.join(root_dir, 'ClearImages')
+            for file_name in sorted(os.listdir(clear_image_dir)):
+                if file_name.endswith('.jpg') or file_name.endswith('.png'):
+                    clear_images.extend(pyramid_cache.get_image_levels(os.path.join(clear_image_dir, file_name),
+                                                                       scales=scales))
+        return cls(clear_images, **kwargs)
+
+    def _draw_windows(self, num_windows: int) -> np.ndarray:
+        """
+        Draws patch windows uniformly at random, and gathers their clear patches
+
+        Parameters
+        ----------
+        num_windows: The number of windows to draw
+
+        Returns
+        -------
+        A uint8 array of clear patches of shape (num_windows, patch_size, patch_size)
+        """
+        # Draw global window indices, then map each one to its image and its (i, j) position in that image
+        window_indices = self.rng.integers(0, self.num_windows, size=num_windows)
+        image_indices = np.searchsorted(self.window_offsets, window_indices, side='right')
+        local_indices = window_indices - np.concatenate(([0], self.window_offsets))[image_indices]
+        rows = local_indices // self.num_cols[image_indices] * self.stride
+        cols = local_indices % self.num_cols[image_indices] * self.stride
+
+        clear_patches = np.empty((num_windows, self.patch_size, self.patch_size), dtype='uint8')
+        for n, (image_index, i, j) in enumerate(zip(image_indices, rows, cols)):
+            clear_patches[n] = self.clear_images[image_index][i:i + self.patch_size, j:j + self.patch_size]
+
+        return clear_patches
+
+    def _accept(self, clear_patches: np.ndarray, blurry_patches: np.ndarray) -> np.ndarray:
+        """
+        Gets a boolean mask of the patch pairs that pass the black patch and PSNR acceptance rules
+        """
+        # If the patch is black (i.e. the max px value < 10), reject it
+        accepted = clear_patches.reshape(len(clear_patches), -1).max(axis=1) >= self.black_threshold
+
+        # Noise at a target PSNR does not give exactly that PSNR (e.g. Rician noise is biased in dark regions), so
+        # keep only the pairs whose measured PSNR lies in the window
+        psnrs = get_patch_psnrs(clear_patches, blurry_patches)
+        if self.low_psnr_threshold is not None:
+            accepted &= psnrs > self.low_psnr_threshold
+        if self.high_psnr_threshold is not None:
+            accepted &= psnrs < self.high_psnr_threshold
+
+        return accepted
+
+    def sample_patches(self, num_patches: int, max_draws: int = 1000) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Samples accepted clear patches, and synthesizes their noisy patches
+
+        Parameters
+        ----------
+        num_patches: The number of patch pairs to sample
+        max_draws: The maximum number of rounds of drawing windows before giving up
+
+        Returns
+        -------
+        (clear_patches, blurry_patches): uint8 arrays of shape (num_patches, patch_size, patch_size, 1)
+        """
+        clear_patches = []
+        blurry_patches = []
+        num_accepted = 0
+
+        for _ in range(max_draws):
+            # Draw a few more windows than we still need, since some of them will be rejected, and give each its own
+            # noise level
+            clear_candidates = self._draw_windows(max(2 * (num_patches - num_accepted), 64))
+            psnrs = self.rng.uniform(*self.psnr_window, size=len(clear_candidates))
+            blurry_candidates = add_noise(clear_candidates, psnrs, noise_type=self.noise_type, rng=self.rng)
+
+            accepted = self._accept(clear_candidates, blurry_candidates)
+            clear_patches.append(clear_candidates[accepted])
+            blurry_patches.append(blurry_candidates[accepted])
+            num_accepted += int(accepted.sum())
+
+            if num_accepted >= num_patches:
+                clear_patches = np.concatenate(clear_patches)[:num_patches]
+                blurry_patches = np.concatenate(blurry_patches)[:num_patches]
+                return clear_patches[..., np.newaxis], blurry_patches[..., np.newaxis]
+
+        raise ValueError(f'Only {num_accepted} of {num_patches} patches were accepted after {max_draws} draws. Check '
+                         f'the PSNR thresholds ({self.low_psnr_threshold}, {self.high_psnr_threshold})')
+
+    def sample_batch(self, batch_size: int = 128) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Samples a standardized training batch
+
+        Parameters
+        ----------
+        batch_size: The number of training examples in the batch
+
+        Returns
+        -------
+        (batch_y, batch_x): The standardized noisy and clear patches, as float32 arrays of shape
+            (batch_size, patch_size, patch_size, 1)
+        """
+        batch_x, batch_y = self.sample_patches(batch_size)
+
+        # Standardize x and y with the mean and standard deviation of the accepted patches
+        batch_x, _, _ = image_utils.standardize(batch_x, mean=self.x_mean, std=self.x_std)
+        batch_y, _, _ = image_utils.standardize(batch_y, mean=self.y_mean, std=self.y_std)
+
+        return batch_y, batch_x
+
+    def generate_batches(self, batch_size: int = 128) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Generator that yields standardized training batches indefinitely
+
+        Parameters
+        ----------
+        batch_size: The number of training examples in each batch
+
+        Returns
+        -------
+        Yields a noisy batch y and its clear batch x
+        """
+        while True:
+            yield self.sample_batch(batch_size)
+
+    def get_dataset(self, batch_size: int = 128):
+        """
+        Gets a tf.data pipeline of standardized training batches, synthesized in the background while the model trains
+
+        Parameters
+        ----------
+        batch_size: The number of training examples in each batch
+
+        Returns
+        -------
+        A tf.data.Dataset of (batch_y, batch_x) pairs
+        """
+        import tensorflow as tf
+
+        batch_shape = (batch_size, self.patch_size, self.patch_size, 1)
+        return tf.data.Dataset.from_generator(lambda: self.generate_batches(batch_size),
+                                              output_types=(tf.float32, tf.float32),
+                                              output_shapes=(batch_shape, batch_shape)) \
+            .prefetch(tf.data.experimental.AUTOTUNE)
@@ -0,0 +1,146 @@
+"""
+Multi-process executor that shards inference across workers, each pinned to its own share of the CPU cores
+"""
+
+import os
+import multiprocessing
+from typing import Callable, Dict, List, Tuple
+
+# The state built by the initializer of this worker process (e.g. its loaded models), passed to every task it runs
+_worker_state = None
+
+
+def get_available_cpus() -> List[int]:
+    """
+    Gets the CPU cores that this process may run on
+
+    Returns
+    -------
+    A sorted list of core ids
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def split_cpus(num_workers: int, cpus: List[int] = None) -> List[List[int]]:
+    """
+    Splits the CPU cores into one contiguous, (nearly) equally sized set per worker, so that workers don't compete
+    for the same cores. If there are fewer cores than workers, cores are shared round-robin.
+
+    Parameters
+    ----------
+    num_workers: The number of workers
+    cpus: The core ids to split. If None, every core this process may run on
+
+    Returns
+    -------
+    A list of num_workers lists of core ids
+    """
+    if cpus is None:
+        cpus = get_available_cpus()
+    if len(cpus) < num_workers:
+        return [[cpus[worker % len(cpus)]] for worker in range(num_workers)]
+    cpu_sets = []
+    start = 0
+    for worker in range(num_workers):
+        end = start + len(cpus) // num_workers + (1 if worker < len(cpus) % num_workers else 0)
+        cpu_sets.append(cpus[start:end])
+        start = end
+    return cpu_sets
+
+
+def shard_items(groups: Dict[str, List], num_shards: int) -> List[Tuple[str, List]]:
+    """
+    Splits groups of items (e.g. the slices of each subject) into min(num_shards, number of items) contiguous ranges
+    of (nearly) equal size, which never cross a group boundary. Every non-empty group gets at least one shard, so there
+    are more shards than requested only if there are more non-empty groups than that
+
+    Parameters
+    ----------
+    groups: A dictionary from a group name to its items, in order
+    num_shards: The desired number of shards. More shards than workers balances the load better
+
+    Returns
+    -------
+    A list of (group name, items) tuples, in the order of the groups and then of their items
+    """
+    # Give each non-empty group one shard, then give each remaining shard to the group with the most items per shard
+    group_num_shards = {name: 1 for name, items in groups.items() if items}
+    num_items = sum(len(items) for items in groups.values())
+    for _ in range(min(num_shards, num_items) - len(group_num_shards)):
+        name = max((name for name in group_num_shards if group_num_shards[name] < len(groups[name])),
+                   key=lambda name: len(groups[name]) / group_num_shards[name])
+        group_num_shards[name] += 1
+
+    # Split each group into its shards, whose sizes differ by at most one item
+    shards = []
+    for name, group_shards in group_num_shards.items():
+        items = groups[name]
+        for index in range(group_shards):
+            shards.append((name, items[index * len(items) // group_shards:(index + 1) * len(items) // group_shards]))
+    return shards
+
+
+def _initialize_worker(cpu_queue, initializer: Callable, initargs: Tuple) -> None:
+    """
+    Pins a new worker process to its cores, sizes TensorFlow's thread pools to match, and builds its state
+
+    Parameters
+    ----------
+    cpu_queue: A queue of core id lists, from which each worker takes its own
+    initializer: A function that builds the worker's state, e.g. by loading its models once
+    initargs: The arguments of initializer
+
+    Returns
+    -------
+    None
+    """
+    global _worker_state
+    cpus = cpu_queue.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+
+    # Use one intra-op thread per core of this worker, and run ops one after another, since small batches have
+    # little inter-op parallelism. This must happen before TensorFlow runs its first op in this process
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(len(cpus))
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    _worker_state = initializer(*initargs)
+
+
+def _run_task(task: Tuple[Callable, object]):
+    """ Runs a function on this worker's state and one shard """
+    function, shard = task
+    return function(_worker_state, shard)
+
+
+def map_shards(initializer: Callable, initargs: Tuple, function: Callable, shards: List,
+               num_workers: int) -> List:
+    """
+    Runs function(state, shard) on every shard, in a pool of worker processes. Each worker builds its state once,
+    with initializer(*initargs), and is pinned to its own share of the CPU cores.
+
+    Workers are started with 'spawn', as TensorFlow is not safe to fork. initializer and function must therefore be
+    module-level functions, and initargs, shards, and the results must be picklable.
+
+    Parameters
+    ----------
+    initializer: A function that builds a worker's state, e.g. by loading its models
+    initargs: The arguments of initializer
+    function: The function run on each shard, as function(state, shard)
+    shards: The shards of work, e.g. from shard_items
+    num_workers: The number of worker processes
+
+    Returns
+    -------
+    The results of function for each shard, in the order of shards
+    """
+    context = multiprocessing.get_context('spawn')
+    cpu_queue = context.Queue()
+    for cpus in split_cpus(num_workers):
+        cpu_queue.put(cpus)
+    with context.Pool(num_workers, initializer=_initialize_worker,
+                      initargs=(cpu_queue, initializer, initargs)) as pool:
+        return pool.map(_run_task, [(function, shard) for shard in shards], chunksize=1)
@@ -0,0 +1,388 @@
+"""
+An indexed dataset of training patch pairs, with per-patch noise metrics for stratified batch sampling
+"""
+
+import os
+import numpy as np
+from PIL import Image
+from typing import Dict, List, Tuple
+from utilities import data_generator, pyramid_cache
+from utilities.data_generator import get_patch_psnrs
+
+# The PSNR window of the training patches of each noise level expert
+NOISE_LEVEL_PSNR_WINDOWS = {
+    'low': (30.0, 100.0),
+    'medium': (15.0, 40.0),
+    'high': (0.0, 30.0)
+}
+
+
+def get_patch_moments(patches: np.ndarray, chunk_size: int = 256) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Gets the mean and the mean squared px value of each patch, in chunks, so that no float copy of the full array of
+    patches is ever made
+
+    Parameters
+    ----------
+    patches: A uint8 array of shape (num_patches, ...)
+    chunk_size: The number of patches to process at a time
+
+    Returns
+    -------
+    (means, squared_means): float64 arrays with one value per patch
+    """
+    means = np.empty(len(patches), dtype='float64')
+    squared_means = np.empty(len(patches), dtype='float64')
+    for start in range(0, len(patches), chunk_size):
+        chunk = patches[start:start + chunk_size].reshape(min(chunk_size, len(patches) - start), -1)
+        chunk = chunk.astype('float64')
+        means[start:start + chunk_size] = chunk.mean(axis=1)
+        squared_means[start:start + chunk_size] = np.square(chunk).mean(axis=1)
+    return means, squared_means
+
+
+def _get_image_names(root_dir: str) -> List[str]:
+    """ Gets the names of the training images in a training data directory """
+    return [file_name for file_name in os.listdir(os.path.join(root_dir, 'ClearImages'))
+            if file_name.endswith('.jpg') or file_name.endswith('.png')]
+
+
+def count_patch_windows(train_data_dirs: List[str], patch_size: int = 40, stride: int = 10,
+                        scales: List[float] = [1, 0.9, 0.8, 0.7]) -> int:
+    """
+    Counts the patch windows (including black ones) that data_generator.generate_patch_pairs would produce for the
+    training data. Only the header of each clear image is read for its size, so no image is decoded
+
+    Parameters
+    ----------
+    train_data_dirs: The training data directories
+    patch_size: The size of each patch in pixels -> (patch_size, patch_size)
+    stride: The stride with which to slide the patch-taking window
+    scales: A list of scales at which we want to create image patches
+
+    Returns
+    -------
+    The number of patch windows
+    """
+    num_windows = 0
+    for root_dir in train_data_dirs:
+        for file_name in _get_image_names(root_dir):
+            with Image.open(os.path.join(root_dir, 'ClearImages', file_name)) as image:
+                width, height = image.size
+            for scale in (scales if scales is not None else [1]):
+                height_scaled, width_scaled = int(height * scale), int(width * scale)
+                if height_scaled >= patch_size and width_scaled >= patch_size:
+                    num_windows += ((height_scaled - patch_size) // stride + 1) * \
+                                   ((width_scaled - patch_size) // stride + 1)
+    return num_windows
+
+
+def estimate_patch_store_bytes(num_patches: int, patch_size: int = 40, num_metrics: int = 1) -> int:
+    """
+    Estimates the resident memory of a PatchDataset
+
+    Parameters
+    ----------
+    num_patches: The number of patch pairs
+    patch_size: The size of each patch in pixels -> (patch_size, patch_size)
+    num_metrics: The number of per-patch metric columns
+
+    Returns
+    -------
+    The estimated number of bytes
+    """
+    # The uint8 clear and blurry patches
+    patch_bytes = 2 * patch_size * patch_size
+
+    # The 4 per-patch px moments, and for each metric: its values, sort order, sorted values, and 4 prefix sums
+    index_bytes = 4 * 8 + num_metrics * (8 + 8 + 8 + 4 * 8)
+
+    return num_patches * (patch_bytes + index_bytes)
+
+
+class PatchDataset:
+    """
+    Holds every non-black training patch pair once, as uint8, alongside per-patch noise metrics ('psnr', and
+    optionally the residual 'std'). For each metric, an argsort and prefix sums of the px values are kept, so that
+    the patches within any metric range, and their mean and standard deviation, can be found without rebuilding or
+    filtering the dataset.
+    """
+
+    def __init__(self, clear_patches: np.ndarray, blurry_patches: np.ndarray, metrics: Dict[str, np.ndarray]):
+        """
+        Constructor for PatchDataset. Use from_train_data to build one from training data directories.
+
+        Parameters
+        ----------
+        clear_patches: The clear patches, as a uint8 array of shape (num_patches, patch_size, patch_size, 1)
+        blurry_patches: The blurry patches, as a uint8 array of the same shape
+        metrics: A dictionary from metric name to an array with one value per patch pair
+        """
+        assert len(clear_patches) == len(blurry_patches), 'Make sure x and y are paired up properly!'
+        self.x = clear_patches
+        self.y = blurry_patches
+        self.metrics = metrics
+
+        # Get the mean px value (and squared px value) of each patch, for computing the statistics of any subset
+        patch_sums = {}
+        patch_sums['x'], patch_sums['x_squared'] = get_patch_moments(self.x)
+        patch_sums['y'], patch_sums['y_squared'] = get_patch_moments(self.y)
+
+        # For each metric, store the patch indices sorted by that metric, and prefix sums in that order
+        self.order = {}
+        self.sorted_metrics = {}
+        self.prefix_sums = {}
+        for name, values in metrics.items():
+            order = np.argsort(values, kind='stable')
+            self.order[name] = order
+            self.sorted_metrics[name] = values[order]
+            self.prefix_sums[name] = {key: np.concatenate(([0.0], np.cumsum(sums[order])))
+                                      for key, sums in patch_sums.items()}
+
+    @classmethod
+    def from_index(cls, clear_patches: np.ndarray, blurry_patches: np.ndarray, metrics: Dict[str, np.ndarray],
+                   order: Dict[str, np.ndarray], sorted_metrics: Dict[str, np.ndarray],
+                   prefix_sums: Dict[str, Dict[str, np.ndarray]]):
+        """
+        Builds a PatchDataset from patches and an index that were already computed (e.g. by another process, see
+        shared_patch_store), without reading or copying the patches
+
+        Returns
+        -------
+        A PatchDataset
+        """
+        assert len(clear_patches) == len(blurry_patches), 'Make sure x and y are paired up properly!'
+        dataset = cls.__new__(cls)
+        dataset.x = clear_patches
+        dataset.y = blurry_patches
+        dataset.metrics = metrics
+        dataset.order = order
+        dataset.sorted_metrics = sorted_metrics
+        dataset.prefix_sums = prefix_sums
+        return dataset
+
+    @classmethod
+    def from_train_data(cls, train_data_dirs: List[str], patch_size: int = 40, stride: int = 10,
+                        scales: List[float] = [1, 0.9, 0.8, 0.7], compute_residual_stds: bool = False,
+                        ram_budget_mb: float = None):
+        """
+        Builds a PatchDataset from every non-black patch pair in the training data.
+
+        The patches are generated one slice at a time and written straight into a preallocated uint8 store, so the
+        full set of patches is never held as lists or float copies.
+
+        Parameters
+        ----------
+        train_data_dirs: The training data directories
+        patch_size: The size of each patch in pixels -> (patch_size, patch_size)
+        stride: The stride with which to slide the patch-taking window
+        scales: A list of scales at which we want to create image patches
+        compute_residual_stds: True if we also want a 'std' metric column of the residual standard deviations
+            (this is much slower than computing PSNRs)
+        ram_budget_mb: If given, raise a MemoryError before loading any patches if the estimated size of the dataset
+            is larger than this many MB
+
+        Returns
+        -------
+        A PatchDataset
+        """
+        print(f'Accessing training data in: {train_data_dirs}')
+
+        # Get an upper bound of the number of patches, and make sure that they fit in the RAM budget
+        max_patches = count_patch_windows(train_data_dirs, patch_size=patch_size, stride=stride, scales=scales)
+        estimated_mb = estimate_patch_store_bytes(max_patches, patch_size=patch_size,
+                                                  num_metrics=2 if compute_residual_stds else 1) / 1024 ** 2
+        print(f'Estimated size of the patch dataset: {estimated_mb:.1f} MB for at most {max_patches} patches')
+        if ram_budget_mb is not None and estimated_mb > ram_budget_mb:
+            raise MemoryError(f'The patch dataset of {train_data_dirs} needs an estimated {estimated_mb:.1f} MB, '
+                              f'which is over the RAM budget of {ram_budget_mb:.1f} MB')
+
+        x = np.empty((max_patches, patch_size, patch_size, 1), dtype='uint8')
+        y = np.empty((max_patches, patch_size, patch_size, 1), dtype='uint8')
+        metrics = {'psnr': np.empty(max_patches, dtype='float64')}
+        if compute_residual_stds:
+            metrics['std'] = np.empty(max_patches, dtype='float64')
+
+        num_patches = 0
+        for root_dir in train_data_dirs:
+            for file_name in _get_image_names(root_dir):
+
+                # Generate the patches of this slice from its cached pyramid levels
+                levels = pyramid_cache.get_pair_levels(root_dir, file_name, scales=scales)
+                clear_patches, blurry_patches = data_generator.generate_patch_pairs(clear_image=None,
+                                                                                    blurry_image=None,
+                                                                                    patch_size=patch_size,
+                                                                                    stride=stride,
+                                                                                    scales=scales,
+                                                                                    levels=levels)
+                if len(clear_patches) == 0:
+                    continue
+                clear_patches = np.array(clear_patches, dtype='uint8')[..., np.newaxis]
+                blurry_patches = np.array(blurry_patches, dtype='uint8')[..., np.newaxis]
+
+                # If the patch is black (i.e. the max px value < 10), just skip this training example
+                not_black = clear_patches.reshape(len(clear_patches), -1).max(axis=1) >= 10
+                clear_patches, blurry_patches = clear_patches[not_black], blurry_patches[not_black]
+
+                # Write the patches and their metrics into the store
+                end = num_patches + len(clear_patches)
+                x[num_patches:end] = clear_patches
+                y[num_patches:end] = blurry_patches
+                metrics['psnr'][num_patches:end] = get_patch_psnrs(clear_patches, blurry_patches)
+                if compute_residual_stds:
+                    metrics['std'][num_patches:end] = [
+                        data_generator.get_residual_std(clear_patch=x_patch, blurry_patch=y_patch)
+                        for x_patch, y_patch in zip(clear_patches, blurry_patches)]
+                num_patches = end
+
+        # Shrink the store down to the non-black patches
+        x.resize((num_patches, patch_size, patch_size, 1), refcheck=False)
+        y.resize((num_patches, patch_size, patch_size, 1), refcheck=False)
+        metrics = {name: values[:num_patches].copy() for name, values in metrics.items()}
+
+        return cls(x, y, metrics)
+
+    def __len__(self) -> int:
+        return len(self.x)
+
+    def get_range(self, low: float = None, high: float = None, metric: str = 'psnr') -> Tuple[int, int]:
+        """
+        Gets the positions, in the order of a metric, of the patches whose metric lies strictly between low and high
+
+        Parameters
+        ----------
+        low: The lower bound of the metric. If None, there is no lower bound
+        high: The upper bound of the metric. If None, there is no upper bound
+        metric: The name of the metric
+
+        Returns
+        -------
+        (start, stop): The patches in the range are self.order[metric][start:stop]
+        """
+        sorted_metric = self.sorted_metrics[metric]
+        start = 0 if low is None else int(np.searchsorted(sorted_metric, low, side='right'))
+        stop = len(sorted_metric) if high is None else int(np.searchsorted(sorted_metric, high, side='left'))
+        return start, max(start, stop)
+
+    def get_range_statistics(self, start: int, stop: int, metric: str = 'psnr') -> Dict[str, float]:
+        """
+        Gets the mean and second moment of the px values of the patches in a range from get_range
+
+        Returns
+        -------
+        A dictionary with the 'x', 'x_squared', 'y', and 'y_squared' means
+        """
+        return {key: (prefix_sums[stop] - prefix_sums[start]) / (stop - start)
+                for key, prefix_sums in self.prefix_sums[metric].items()}
+
+
+class StratifiedBatchSampler:
+    """
+    Samples standardized training batches from a PatchDataset, either from a single metric range (e.g. the PSNR
+    window of one expert), or with a target mix of several noise level classes. Selecting a subset is a lookup in the
+    dataset's index, rather than a rebuild of the dataset.
+    """
+
+    def __init__(self, dataset: PatchDataset, batch_size: int = 128, metric_range: Tuple[float, float] = None,
+                 class_mix: Dict[str, float] = None, class_windows: Dict[str, Tuple[float, float]] = None,
+                 metric: str = 'psnr', seed: int = None, shard_index: int = 0, num_shards: int = 1):
+        """
+        Constructor for StratifiedBatchSampler
+
+        Parameters
+        ----------
+        dataset: The PatchDataset to sample from
+        batch_size: The number of training examples in each batch
+        metric_range: An optional (low, high) range of the metric; only patches strictly inside it are sampled.
+            Either bound may be None. If neither metric_range nor class_mix is given, every patch is sampled
+        class_mix: An optional dictionary from class name to its fraction of each batch, e.g.
+            {'low': 0.2, 'medium': 0.4, 'high': 0.4}
+        class_windows: The (low, high) metric window of each class in class_mix. Defaults to
+            NOISE_LEVEL_PSNR_WINDOWS
+        metric: The name of the metric the ranges refer to
+        seed: An optional seed for the random number generator
+        shard_index: The shard of the dataset to sample from, when each worker of a distributed training run samples
+            from its own shard: every num_shards-th patch of each range, starting at its shard_index-th patch. The
+            batches of every shard are standardized with the statistics of the whole range, so that all workers agree
+        num_shards: The number of shards
+        """
+        if metric_range is not None and class_mix is not None:
+            raise ValueError('Only one of metric_range and class_mix may be given')
+
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.metric = metric
+        self.rng = np.random.default_rng(seed)
+        self.shard_index = shard_index
+        self.num_shards = num_shards
+
+        # Get the range of patches of each class, and the fraction of each batch that it makes up
+        if class_mix is not None:
+            class_windows = class_windows if class_windows is not None else NOISE_LEVEL_PSNR_WINDOWS
+            total = float(sum(class_mix.values()))
+            self.ranges = [dataset.get_range(*class_windows[name], metric=metric) for name in class_mix]
+            self.fractions = np.array([fraction / total for fraction in class_mix.values()])
+        else:
+            metric_range = metric_range if metric_range is not None else (None, None)
+            self.ranges = [dataset.get_range(*metric_range, metric=metric)]
+            self.fractions = np.array([1.0])
+
+        for (start, stop), fraction in zip(self.ranges, self.fractions):
+            if self._get_shard_size(start, stop) == 0 and fraction > 0:
+                raise ValueError(f'There are no patches to sample in one of the requested {metric} ranges')
+        print(f'Sampling from {[self._get_shard_size(start, stop) for start, stop in self.ranges]} patches of '
+              f'{len(dataset)}')
+
+        # Get the mean and standard deviation of the px values of the sampled distribution
+        moments = {key: 0.0 for key in ('x', 'x_squared', 'y', 'y_squared')}
+        for (start, stop), fraction in zip(self.ranges, self.fractions):
+            if fraction > 0:
+                for key, value in dataset.get_range_statistics(start, stop, metric=metric).items():
+                    moments[key] += fraction * value
+        self.x_mean = float(moments['x'])
+        self.x_std = float(np.sqrt(max(moments['x_squared'] - moments['x'] ** 2, 0.0)))
+        self.y_mean = float(moments['y'])
+        self.y_std = float(np.sqrt(max(moments['y_squared'] - moments['y'] ** 2, 0.0)))
+
+    def _get_shard_size(self, start: int, stop: int) -> int:
+        """ Gets the number of patches of this sampler's shard in a range of positions """
+        return len(range(start + self.shard_index, stop, self.num_shards))
+
+    def sample_indices(self) -> np.ndarray:
+        """
+        Gets the dataset indices of a random batch
+
+        Returns
+        -------
+        An array of batch_size indices into the dataset
+        """
+        # Split the batch between the classes
+        counts = self.rng.multinomial(self.batch_size, self.fractions)
+
+        # Draw random positions from this shard of each class's range of the metric's sort order
+        order = self.dataset.order[self.metric]
+        indices = [order[start + self.shard_index +
+                         self.num_shards * self.rng.integers(0, self._get_shard_size(start, stop), size=count)]
+                   for (start, stop), count in zip(self.ranges, counts) if count > 0]
+        return np.concatenate(indices)
+
+    def sample_batch(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Samples a standardized training batch
+
+        Returns
+        -------
+        (batch_y, batch_x): The standardized blurry and clear patches, as float32 arrays
+        """
+        indices = self.sample_indices()
+
+        # Standardize x and y with the statistics of the sampled distribution
+        batch_x = (self.dataset.x[indices].astype('float32') - self.x_mean) / (self.x_std if self.x_std else 1.0)
+        batch_y = (self.dataset.y[indices].astype('float32') - self.y_mean) / (self.y_std if self.y_std else 1.0)
+
+        return batch_y, batch_x
+
+    def __iter__(self):
+        # Loop the following indefinitely...
+        while True:
+            yield self.sample_batch()
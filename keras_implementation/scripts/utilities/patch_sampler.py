@@ -0,0 +1,365 @@
+"""
+Samples random training patches on the fly, without materializing the full set of patches
+"""
+
+import os
+import re
+import numpy as np
+from typing import List, Tuple
+from utilities import image_utils, data_generator, pyramid_cache
+
+
+class RandomPatchSampler:
+    """
+    Keeps only the decoded, histogram-matched, rescaled slices of the training data in memory, and draws random
+    (slice, scale, i, j) patch windows from them for each batch.
+
+    The windows are drawn uniformly from the same population of windows that data_generator.pair_data_generator
+    produces (the same scales and the same stride grid), and are accepted with the same rules as the training
+    generators in train.py: black patches are rejected, and, if PSNR thresholds are given, only patches whose PSNR
+    lies strictly between them are kept. Memory therefore scales with the size of the volumes rather than with the
+    number of patches.
+    """
+
+    def __init__(self, root_dirs: List[str], patch_size: int = 40, stride: int = 10,
+                 scales: List[float] = [1, 0.9, 0.8, 0.7], low_psnr_threshold: float = None,
+                 high_psnr_threshold: float = None, black_threshold: int = 10, use_image_id_range: bool = False,
+                 low_image_id: int = 34, high_image_id: int = 100, num_standardization_patches: int = 20000,
+                 standardization: Tuple[float, float, float, float] = None, seed: int = None):
+        """
+        Constructor for RandomPatchSampler
+
+        Parameters
+        ----------
+        root_dirs: The paths of the training data directories, each containing ClearImages and
+            CoregisteredBlurryImages
+        patch_size: The size of each patch in pixels -> (patch_size, patch_size)
+        stride: The stride of the grid of patch windows
+        scales: A list of scales at which we want to create image patches.
+            If None, this function simply performs no rescaling of the image to create patches
+        low_psnr_threshold: Only accept patches with a PSNR above this value. If None, there is no lower bound
+        high_psnr_threshold: Only accept patches with a PSNR below this value. If None, there is no upper bound
+        black_threshold: Reject patches whose clear patch has a max px value below this value
+        use_image_id_range: True if we wish to only sample from images between low_image_id and high_image_id
+        low_image_id: The lower image id for the range of images to sample from
+        high_image_id: The upper image id for the range of images to sample from
+        num_standardization_patches: The number of accepted patches used to estimate the mean and standard deviation
+            with which the batches are standardized
+        standardization: An optional, precomputed (x_mean, x_std, y_mean, y_std) with which to standardize the
+            batches instead, e.g. from data_generator.get_fold_standardization
+        seed: An optional seed for the random number generator
+        """
+        self.patch_size = patch_size
+        self.stride = stride
+        self.scales = scales
+        self.low_psnr_threshold = low_psnr_threshold
+        self.high_psnr_threshold = high_psnr_threshold
+        self.black_threshold = black_threshold
+        self.rng = np.random.default_rng(seed)
+
+        # Load the (rescaled) slices, and count the patch windows in each of them
+        self.clear_images, self.blurry_images = self._load_images(root_dirs, use_image_id_range, low_image_id,
+                                                                  high_image_id)
+        if len(self.clear_images) == 0:
+            raise ValueError(f'No images of at least {patch_size}x{patch_size} px were found in {root_dirs}')
+        self.num_rows = np.array([(image.shape[0] - patch_size) // stride + 1 for image in self.clear_images])
+        self.num_cols = np.array([(image.shape[1] - patch_size) // stride + 1 for image in self.clear_images])
+
+        # The cumulative number of windows, used to map a global window index to its image
+        self.window_offsets = np.cumsum(self.num_rows * self.num_cols)
+        self.num_windows = int(self.window_offsets[-1])
+
+        print(f'Sampling from {self.num_windows} patch windows in {len(self.clear_images)} rescaled slices')
+
+        # Estimate the mean and standard deviation of the accepted patches from a pilot sample, unless they are given
+        if standardization is not None:
+            self.x_mean, self.x_std, self.y_mean, self.y_std = standardization
+        else:
+            x, y = self.sample_patches(num_standardization_patches)
+            self.x_mean, self.x_std = float(x.mean()), float(x.std())
+            self.y_mean, self.y_std = float(y.mean()), float(y.std())
+
+    def _load_images(self, root_dirs: List[str], use_image_id_range: bool, low_image_id: int,
+                     high_image_id: int) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+        """
+        Gets the clear and blurry slices at every scale, with each blurry slice histogram matched to its clear slice
+
+        Returns
+        -------
+        (clear_images, blurry_images): Lists of uint8 images, one per (slice, scale)
+        """
+        clear_images = []
+        blurry_images = []
+
+        for root_dir in root_dirs:
+
+            for file_name in sorted(os.listdir(os.path.join(root_dir, 'ClearImages'))):
+                if not (file_name.endswith('.jpg') or file_name.endswith('.png')):
+                    continue
+
+                # If we wish to use the image_id range, skip this image if it isn't between low and high image_id
+                if use_image_id_range:
+                    file_id = int(re.findall(r'\d+', file_name)[0])
+                    if not low_image_id < file_id < high_image_id:
+                        continue
+
+                # Get the Clear and (histogram matched) Blurry Images at every scale from the pyramid cache
+                for clear_image_scaled, blurry_image_scaled in pyramid_cache.get_pair_levels(root_dir, file_name,
+                                                                                             scales=self.scales):
+
+                    # Skip images that are too small to hold a single patch
+                    if min(clear_image_scaled.shape) < self.patch_size:
+                        continue
+
+                    clear_images.append(clear_image_scaled)
+                    blurry_images.append(blurry_image_scaled)
+
+        return clear_images, blurry_images
+
+    def _draw_windows(self, num_windows: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Draws patch windows uniformly at random, and gathers their clear and blurry patches
+
+        Parameters
+        ----------
+        num_windows: The number of windows to draw
+
+        Returns
+        -------
+        (clear_patches, blurry_patches): uint8 arrays of shape (num_windows, patch_size, patch_size)
+        """
+        # Draw global window indices, then map each one to its image and its (i, j) position in that image
+        window_indices = self.rng.integers(0, self.num_windows, size=num_windows)
+        image_indices = np.searchsorted(self.window_offsets, window_indices, side='right')
+        local_indices = window_indices - np.concatenate(([0], self.window_offsets))[image_indices]
+        rows = local_indices // self.num_cols[image_indices] * self.stride
+        cols = local_indices % self.num_cols[image_indices] * self.stride
+
+        clear_patches = np.empty((num_windows, self.patch_size, self.patch_size), dtype='uint8')
+        blurry_patches = np.empty((num_windows, self.patch_size, self.patch_size), dtype='uint8')
+        for n, (image_index, i, j) in enumerate(zip(image_indices, rows, cols)):
+            clear_patches[n] = self.clear_images[image_index][i:i + self.patch_size, j:j + self.patch_size]
+            blurry_patches[n] = self.blurry_images[image_index][i:i + self.patch_size, j:j + self.patch_size]
+
+        return clear_patches, blurry_patches
+
+    def _accept(self, clear_patches: np.ndarray, blurry_patches: np.ndarray) -> np.ndarray:
+        """
+        Gets a boolean mask of the patch pairs that pass the black patch and PSNR acceptance rules
+        """
+        # If the patch is black (i.e. the max px value < 10), reject it
+        accepted = clear_patches.reshape(len(clear_patches), -1).max(axis=1) >= self.black_threshold
+
+        if self.low_psnr_threshold is not None or self.high_psnr_threshold is not None:
+            psnrs = data_generator.get_patch_psnrs(clear_patches, blurry_patches)
+
+            if self.low_psnr_threshold is not None:
+                accepted &= psnrs > self.low_psnr_threshold
+            if self.high_psnr_threshold is not None:
+                accepted &= psnrs < self.high_psnr_threshold
+
+        return accepted
+
+    def sample_patches(self, num_patches: int, max_draws: int = 1000) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Samples accepted patch pairs
+
+        Parameters
+        ----------
+        num_patches: The number of patch pairs to sample
+        max_draws: The maximum number of rounds of drawing windows before giving up
+
+        Returns
+        -------
+        (clear_patches, blurry_patches): uint8 arrays of shape (num_patches, patch_size, patch_size, 1)
+        """
+        clear_patches = []
+        blurry_patches = []
+        num_accepted = 0
+
+        for _ in range(max_draws):
+            # Draw a few more windows than we still need, since some of them will be rejected
+            clear_candidates, blurry_candidates = self._draw_windows(max(2 * (num_patches - num_accepted), 64))
+            accepted = self._accept(clear_candidates, blurry_candidates)
+            clear_patches.append(clear_candidates[accepted])
+            blurry_patches.append(blurry_candidates[accepted])
+            num_accepted += int(accepted.sum())
+
+            if num_accepted >= num_patches:
+                clear_patches = np.concatenate(clear_patches)[:num_patches]
+                blurry_patches = np.concatenate(blurry_patches)[:num_patches]
+                return clear_patches[..., np.newaxis], blurry_patches[..., np.newaxis]
+
+        raise ValueError(f'Only {num_accepted} of {num_patches} patches were accepted after {max_draws} draws. Check '
+                         f'the PSNR thresholds ({self.low_psnr_threshold}, {self.high_psnr_threshold})')
+
+    def sample_batch(self, batch_size: int = 128) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Samples a standardized training batch
+
+        Parameters
+        ----------
+        batch_size: The number of training examples in the batch
+
+        Returns
+        -------
+        (batch_y, batch_x): The standardized blurry and clear patches, as float32 arrays of shape
+            (batch_size, patch_size, patch_size, 1)
+        """
+        batch_x, batch_y = self.sample_patches(batch_size)
+
+        # Standardize x and y with the mean and standard deviation of the accepted patches
+        batch_x, _, _ = image_utils.standardize(batch_x, mean=self.x_mean, std=self.x_std)
+        batch_y, _, _ = image_utils.standardize(batch_y, mean=self.y_mean, std=self.y_std)
+
+        return batch_y, batch_x
+
+
+class RandomBrickSampler:
+    """
+    Keeps only the (histogram-matched, rescaled) training volumes, memory-mapped from the pyramid cache by default,
+    and draws random (volume, scale, i, j, k) bricks from them for each batch.
+
+    The bricks are drawn uniformly from the same scales and stride grid as data_generator.pair_3d_data_generator, over
+    the full extent of each rescaled volume, and black bricks are rejected. Memory therefore stays constant regardless
+    of the number of subjects, apart from the pages of the volumes that the OS keeps cached.
+    """
+
+    def __init__(self, root_dirs: List[str], brick_size: Tuple[int, int, int] = (20, 20, 20), stride: int = 10,
+                 scales: List[float] = [1., 0.9, 0.8, 0.7], black_threshold: int = 10, use_memmap: bool = True,
+                 num_standardization_bricks: int = 2000, seed: int = None):
+        """
+        Constructor for RandomBrickSampler
+
+        Parameters
+        ----------
+        root_dirs: The paths of the training data directories, each containing ClearImages and
+            CoregisteredBlurryImages
+        brick_size: The size of each brick in voxels -> (depth, height, width)
+        stride: The stride of the grid of bricks
+        scales: A list of scales at which we want to create bricks
+        black_threshold: Reject bricks whose clear brick has a max px value below this value
+        use_memmap: True if the volumes should be memory-mapped from the pyramid cache rather than held in memory
+        num_standardization_bricks: The number of accepted bricks used to estimate the mean and standard deviation
+            with which the batches are standardized
+        seed: An optional seed for the random number generator
+        """
+        self.brick_size = tuple(brick_size)
+        self.stride = stride
+        self.black_threshold = black_threshold
+        self.rng = np.random.default_rng(seed)
+
+        # Get the (rescaled) volumes of every data directory
+        self.clear_volumes = []
+        self.blurry_volumes = []
+        for root_dir in root_dirs:
+            for clear_volume, blurry_volume in pyramid_cache.get_volume_levels(root_dir, scales=scales,
+                                                                               mmap_mode='r' if use_memmap else None):
+                # Skip volumes that are too small to hold a single brick
+                if any(size < brick for size, brick in zip(clear_volume.shape, self.brick_size)):
+                    continue
+                self.clear_volumes.append(clear_volume)
+                self.blurry_volumes.append(blurry_volume)
+        if len(self.clear_volumes) == 0:
+            raise ValueError(f'No volumes of at least {self.brick_size} voxels were found in {root_dirs}')
+
+        # Count the bricks along each axis of each volume
+        self.grid_shapes = np.array([[(size - brick) // stride + 1 for size, brick in zip(volume.shape,
+                                                                                          self.brick_size)]
+                                     for volume in self.clear_volumes])
+
+        # The cumulative number of bricks, used to map a global brick index to its volume
+        self.brick_offsets = np.cumsum(np.prod(self.grid_shapes, axis=1))
+        self.num_bricks = int(self.brick_offsets[-1])
+
+        print(f'Sampling from {self.num_bricks} bricks in {len(self.clear_volumes)} rescaled volumes')
+
+        # Estimate the mean and standard deviation of the accepted bricks from a pilot sample
+        x, y = self.sample_bricks(num_standardization_bricks)
+        self.x_mean, self.x_std = float(x.mean()), float(x.std())
+        self.y_mean, self.y_std = float(y.mean()), float(y.std())
+
+    def _draw_bricks(self, num_bricks: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Draws bricks uniformly at random, and gathers their clear and blurry bricks
+
+        Parameters
+        ----------
+        num_bricks: The number of bricks to draw
+
+        Returns
+        -------
+        (clear_bricks, blurry_bricks): uint8 arrays of shape (num_bricks, depth, height, width)
+        """
+        # Draw global brick indices, then map each one to its volume and its (i, j, k) position in that volume
+        brick_indices = self.rng.integers(0, self.num_bricks, size=num_bricks)
+        volume_indices = np.searchsorted(self.brick_offsets, brick_indices, side='right')
+        local_indices = brick_indices - np.concatenate(([0], self.brick_offsets))[volume_indices]
+        grid_shapes = self.grid_shapes[volume_indices]
+        positions = np.stack([local_indices // (grid_shapes[:, 2] * grid_shapes[:, 1]),
+                              local_indices // grid_shapes[:, 2] % grid_shapes[:, 1],
+                              local_indices % grid_shapes[:, 2]], axis=1) * self.stride
+
+        depth, height, width = self.brick_size
+        clear_bricks = np.empty((num_bricks,) + self.brick_size, dtype='uint8')
+        blurry_bricks = np.empty((num_bricks,) + self.brick_size, dtype='uint8')
+        for n, (volume_index, (i, j, k)) in enumerate(zip(volume_indices, positions)):
+            clear_bricks[n] = self.clear_volumes[volume_index][i:i + depth, j:j + height, k:k + width]
+            blurry_bricks[n] = self.blurry_volumes[volume_index][i:i + depth, j:j + height, k:k + width]
+
+        return clear_bricks, blurry_bricks
+
+    def sample_bricks(self, num_bricks: int, max_draws: int = 1000) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Samples non-black brick pairs
+
+        Parameters
+        ----------
+        num_bricks: The number of brick pairs to sample
+        max_draws: The maximum number of rounds of drawing bricks before giving up
+
+        Returns
+        -------
+        (clear_bricks, blurry_bricks): uint8 arrays of shape (num_bricks, depth, height, width, 1)
+        """
+        clear_bricks = []
+        blurry_bricks = []
+        num_accepted = 0
+
+        for _ in range(max_draws):
+            # Draw a few more bricks than we still need, since some of them will be black
+            clear_candidates, blurry_candidates = self._draw_bricks(max(2 * (num_bricks - num_accepted), 16))
+
+            # If the brick is black (i.e. the max px value < 10), reject it
+            accepted = clear_candidates.reshape(len(clear_candidates), -1).max(axis=1) >= self.black_threshold
+            clear_bricks.append(clear_candidates[accepted])
+            blurry_bricks.append(blurry_candidates[accepted])
+            num_accepted += int(accepted.sum())
+
+            if num_accepted >= num_bricks:
+                clear_bricks = np.concatenate(clear_bricks)[:num_bricks]
+                blurry_bricks = np.concatenate(blurry_bricks)[:num_bricks]
+                return clear_bricks[..., np.newaxis], blurry_bricks[..., np.newaxis]
+
+        raise ValueError(f'Only {num_accepted} of {num_bricks} bricks were accepted after {max_draws} draws')
+
+    def sample_batch(self, batch_size: int = 128) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Samples a standardized training batch
+
+        Parameters
+        ----------
+        batch_size: The number of training examples in the batch
+
+        Returns
+        -------
+        (batch_y, batch_x): The standardized blurry and clear bricks, as float32 arrays of shape
+            (batch_size, depth, height, width, 1)
+        """
+        batch_x, batch_y = self.sample_bricks(batch_size)
+
+        # Standardize x and y with the mean and standard deviation of the accepted bricks
+        batch_x, _, _ = image_utils.standardize(batch_x, mean=self.x_mean, std=self.x_std)
+        batch_y, _, _ = image_utils.standardize(batch_y, mean=self.y_mean, std=self.y_std)
+
+        return batch_y, batch_x
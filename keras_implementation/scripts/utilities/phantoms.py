@@ -0,0 +1,101 @@
+"""
+Synthetic brain-like MRI phantoms, for benchmarking and testing HydraNet without real patient data
+"""
+
+import os
+import cv2
+import numpy as np
+from scipy.ndimage import gaussian_filter
+from typing import List, Tuple
+from utilities import noise_synthesis
+
+# The (center, radii, intensity) of each ellipsoid of a phantom, in normalized [-1, 1] (z, y, x) coordinates. Later
+# ellipsoids are painted over earlier ones
+PHANTOM_ELLIPSOIDS = [
+    ((0.0, 0.0, 0.0), (0.95, 0.85, 0.70), 200),  # Scalp and skull
+    ((0.0, 0.0, 0.0), (0.88, 0.78, 0.63), 30),  # Cerebrospinal fluid around the brain
+    ((0.0, 0.02, 0.0), (0.84, 0.74, 0.59), 110),  # Gray matter
+    ((0.0, 0.02, 0.0), (0.62, 0.56, 0.42), 160),  # White matter
+    ((0.05, -0.05, -0.12), (0.35, 0.28, 0.07), 40),  # Left lateral ventricle
+    ((0.05, -0.05, 0.12), (0.35, 0.28, 0.07), 40),  # Right lateral ventricle
+]
+
+
+def make_phantom_volume(shape: Tuple[int, int, int], seed: int = None, num_lesions: int = 4,
+                        texture_strength: float = 10.0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Makes a clear, brain-like phantom volume out of nested ellipsoids (skull, CSF, gray matter, white matter, and
+    ventricles), with a few random lesions and a smooth random texture inside the brain
+
+    Parameters
+    ----------
+    shape: The (depth, height, width) of the volume
+    seed: The seed of the random lesions and texture
+    num_lesions: The number of small, randomly placed ellipsoids of random intensity inside the white matter
+    texture_strength: The standard deviation of the smooth texture added to the brain, in px values
+
+    Returns
+    -------
+    (volume, mask): The uint8 phantom volume, and a uint8 mask of the head (255 inside, 0 outside)
+    """
+    rng = np.random.default_rng(seed)
+    z, y, x = np.meshgrid(*[np.linspace(-1, 1, size, dtype='float32') for size in shape], indexing='ij')
+
+    def inside(center, radii):
+        return ((z - center[0]) / radii[0]) ** 2 + ((y - center[1]) / radii[1]) ** 2 + \
+               ((x - center[2]) / radii[2]) ** 2 <= 1
+
+    # Paint the anatomy, then the lesions inside the white matter
+    volume = np.zeros(shape, dtype='float32')
+    for center, radii, intensity in PHANTOM_ELLIPSOIDS:
+        volume[inside(center, radii)] = intensity
+    for _ in range(num_lesions):
+        center = rng.uniform(-0.4, 0.4, size=3)
+        radii = rng.uniform(0.04, 0.1, size=3)
+        volume[inside(center, radii)] = rng.uniform(60, 230)
+
+    # Add a smooth texture to the brain, so that patches are not flat
+    brain = inside(*PHANTOM_ELLIPSOIDS[2][:2])
+    texture = gaussian_filter(rng.standard_normal(shape).astype('float32'), sigma=2)
+    texture *= texture_strength / max(float(texture.std()), 1e-8)
+    volume[brain] += texture[brain]
+
+    mask = inside(*PHANTOM_ELLIPSOIDS[0][:2]).astype('uint8') * 255
+    return np.clip(np.round(volume), 0, 255).astype('uint8'), mask
+
+
+def write_phantom_subject(root_dir: str, shape: Tuple[int, int, int], psnr_range: Tuple[float, float] = (15, 45),
+                          seed: int = None) -> List[float]:
+    """
+    Writes a phantom subject, one PNG per slice, in the layout of a HydraNet data directory:
+    <root_dir>/ClearImages, <root_dir>/CoregisteredBlurryImages, and <root_dir>/Masks.
+
+    Each slice gets its own level of Rician noise, drawn uniformly from psnr_range, so that a subject spans the low,
+    medium, and high noise categories.
+
+    Parameters
+    ----------
+    root_dir: The data directory to write
+    shape: The (depth, height, width) of the phantom volume; depth is the number of slices
+    psnr_range: The (lowest, highest) target PSNR in dB of the blurry slices
+    seed: The seed of the phantom and of its noise
+
+    Returns
+    -------
+    The target PSNR of each slice
+    """
+    rng = np.random.default_rng(seed)
+    volume, mask = make_phantom_volume(shape, seed=seed)
+    psnrs = [float(psnr) for psnr in rng.uniform(psnr_range[0], psnr_range[1], size=shape[0])]
+
+    for image_dir in ('ClearImages', 'CoregisteredBlurryImages', 'Masks'):
+        os.makedirs(os.path.join(root_dir, image_dir), exist_ok=True)
+
+    for i, psnr in enumerate(psnrs):
+        file_name = f'image{i:03d}.png'
+        blurry_slice = noise_synthesis.add_noise(volume[i], psnr, rng=int(rng.integers(2 ** 31)))
+        cv2.imwrite(os.path.join(root_dir, 'ClearImages', file_name), volume[i])
+        cv2.imwrite(os.path.join(root_dir, 'CoregisteredBlurryImages', file_name), blurry_slice)
+        cv2.imwrite(os.path.join(root_dir, 'Masks', file_name), mask[i])
+
+    return psnrs
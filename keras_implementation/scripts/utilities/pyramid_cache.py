@@ -0,0 +1,307 @@
+"""
+Caches the multi-scale pyramid levels of training slices and volumes alongside the dataset
+"""
+
+import os
+import cv2
+import json
+import hashlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from scipy.ndimage import zoom
+from typing import List, Tuple
+from utilities import image_utils
+from utilities.file_utils import atomic_write
+from utilities.result_cache import hash_file
+
+# The name of the directory, inside each data directory, in which pyramid levels are stored
+PYRAMID_DIR_NAME = 'Pyramid'
+
+
+def resize_image(image: np.ndarray, scale: float) -> np.ndarray:
+    """
+    Rescales a 2D image exactly as the patch generators in data_generator always have.
+
+    NOTE: cv2.resize takes its size as (width, height), so (height_scaled, width_scaled) is transposed here. We keep
+    this so that cached levels are identical to the ones the generators computed before, which only matters for
+    non-square images.
+
+    Parameters
+    ----------
+    image: The image to rescale
+    scale: The scale factor
+
+    Returns
+    -------
+    The rescaled image
+    """
+    height, width = image.shape
+    height_scaled, width_scaled = int(height * scale), int(width * scale)
+    return cv2.resize(image, (height_scaled, width_scaled), interpolation=cv2.INTER_CUBIC)
+
+
+def _get_scales_key(scales: List[float]) -> str:
+    """
+    Gets a short hash of a set of scales. It is part of the name of each cache file, so that the levels of different
+    sets of scales (e.g. the 4 training scales, and the single scale of inference's reference bank) are cached side by
+    side instead of evicting each other
+    """
+    return hashlib.sha256(repr([float(scale) for scale in scales]).encode()).hexdigest()[:8]
+
+
+def _hash_sources(paths: List[str], scales: List[float]) -> str:
+    """ Gets a hash of the contents of the source files and of the scales of their pyramid levels """
+    hasher = hashlib.sha256()
+    hasher.update(repr([float(scale) for scale in scales]).encode())
+    for path in paths:
+        hasher.update(hash_file(path).encode())
+    return hasher.hexdigest()
+
+
+def _load_levels(cache_path: str, source_hash: str, num_images: int) -> List[Tuple[np.ndarray, ...]]:
+    """
+    Loads the levels stored in a cache file, if it exists and was computed from the same sources
+
+    Returns
+    -------
+    A list with a tuple of num_images arrays per level, or None if the cache file is missing or stale
+    """
+    try:
+        with np.load(cache_path) as cached:
+            if str(cached['source_hash']) != source_hash:
+                return None
+            num_levels = int(cached['num_levels'])
+            return [tuple(cached[f'image_{n}_level_{level}'] for n in range(num_images))
+                    for level in range(num_levels)]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _save_levels(cache_path: str, source_hash: str, levels: List[Tuple[np.ndarray, ...]]) -> None:
+    """
+    Saves levels to a cache file. If the dataset directory isn't writable, the levels simply aren't cached.
+    """
+    arrays = {'source_hash': np.array(source_hash), 'num_levels': np.array(len(levels))}
+    for level, images in enumerate(levels):
+        for n, image in enumerate(images):
+            arrays[f'image_{n}_level_{level}'] = image
+
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        atomic_write(cache_path, lambda file: np.savez(file, **arrays), binary=True)
+    except OSError as error:
+        print(f'Could not cache pyramid levels in {cache_path}: {error}')
+
+
+def get_image_levels(image_path: str, scales: List[float] = [1, 0.9, 0.8, 0.7],
+                     use_cache: bool = True) -> List[np.ndarray]:
+    """
+    Gets the pyramid levels of a single grayscale image, e.g. <root_dir>/ClearImages/<file_name>. Cached levels are
+    stored in <root_dir>/Pyramid/<image_dir_name>/<file_name>.<scales key>.npz
+
+    Parameters
+    ----------
+    image_path: The path of the image
+    scales: The scales of the levels
+    use_cache: True if we may load and save cached levels
+
+    Returns
+    -------
+    A list with the rescaled image at each scale
+    """
+    image_dir, file_name = os.path.split(image_path)
+    cache_path = os.path.join(os.path.dirname(image_dir), PYRAMID_DIR_NAME, os.path.basename(image_dir),
+                              f'{file_name}.{_get_scales_key(scales)}.npz')
+    source_hash = _hash_sources([image_path], scales) if use_cache else None
+
+    if use_cache:
+        levels = _load_levels(cache_path, source_hash, num_images=1)
+        if levels is not None:
+            return [image for image, in levels]
+
+    image = cv2.imread(image_path, 0)
+    levels = [resize_image(image, scale) for scale in scales]
+
+    if use_cache:
+        _save_levels(cache_path, source_hash, [(image,) for image in levels])
+
+    return levels
+
+
+def get_pair_levels(root_dir: str, file_name: str, scales: List[float] = [1, 0.9, 0.8, 0.7],
+                    use_cache: bool = True) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Gets the pyramid levels of a clear slice and its blurry slice, with the blurry slice histogram matched to the clear
+    slice before rescaling (as data_generator.pair_data_generator does). Cached levels are stored in
+    <root_dir>/Pyramid/pairs/<file_name>.<scales key>.npz
+
+    Parameters
+    ----------
+    root_dir: The data directory housing ClearImages and CoregisteredBlurryImages
+    file_name: The file name of the slice
+    scales: The scales of the levels. If None, a single level of the unscaled slices is returned
+    use_cache: True if we may load and save cached levels
+
+    Returns
+    -------
+    A list with a tuple of the rescaled (clear, blurry) slices at each scale
+    """
+    clear_path = os.path.join(root_dir, 'ClearImages', file_name)
+    blurry_path = os.path.join(root_dir, 'CoregisteredBlurryImages', file_name)
+
+    # Without scales, there is nothing to cache
+    use_cache = use_cache and scales is not None
+    cache_path = os.path.join(root_dir, PYRAMID_DIR_NAME, 'pairs',
+                              f'{file_name}.{_get_scales_key(scales)}.npz') if use_cache else None
+    source_hash = _hash_sources([clear_path, blurry_path], scales) if use_cache else None
+
+    if use_cache:
+        levels = _load_levels(cache_path, source_hash, num_images=2)
+        if levels is not None:
+            return levels
+
+    # Read the Clear and Blurry Images, and histogram match the blurry image to the clear image
+    clear_image = cv2.imread(clear_path, 0)
+    blurry_image = cv2.imread(blurry_path, 0)
+    blurry_image = image_utils.hist_match(blurry_image, clear_image).astype('uint8')
+
+    if scales is None:
+        return [(clear_image, blurry_image)]
+
+    levels = [(resize_image(clear_image, scale), resize_image(blurry_image, scale)) for scale in scales]
+
+    if use_cache:
+        _save_levels(cache_path, source_hash, levels)
+
+    return levels
+
+
+def _load_volume_levels(cache_dir: str, source_hash: str, mmap_mode: str = None) -> List[Tuple[np.ndarray, ...]]:
+    """
+    Loads the volume levels stored in a cache directory, if they were computed from the same sources
+
+    Returns
+    -------
+    A list with a tuple of the (clear, blurry) volumes per level, or None if the levels are missing or stale
+    """
+    try:
+        with open(os.path.join(cache_dir, 'levels.json')) as file:
+            manifest = json.load(file)
+        if manifest['source_hash'] != source_hash:
+            return None
+        return [tuple(np.load(os.path.join(cache_dir, f'level_{level}_{name}.npy'), mmap_mode=mmap_mode)
+                      for name in ('clear', 'blurry'))
+                for level in range(manifest['num_levels'])]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _save_volume_levels(cache_dir: str, source_hash: str, levels: List[Tuple[np.ndarray, ...]]) -> None:
+    """
+    Saves volume levels to a cache directory, as one .npy file per volume so that they can be memory-mapped. The
+    manifest is written last, so that partially written levels are never loaded.
+    """
+    manifest_path = os.path.join(cache_dir, 'levels.json')
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+
+        for level, volumes in enumerate(levels):
+            for name, volume in zip(('clear', 'blurry'), volumes):
+                atomic_write(os.path.join(cache_dir, f'level_{level}_{name}.npy'),
+                             lambda file: np.save(file, volume), binary=True)
+
+        with open(manifest_path, 'w') as file:
+            json.dump({'source_hash': source_hash, 'num_levels': len(levels)}, file)
+    except OSError as error:
+        print(f'Could not cache pyramid levels in {cache_dir}: {error}')
+
+
+def get_volume_levels(root_dir: str, scales: List[float] = [1., 0.9, 0.8, 0.7], use_cache: bool = True,
+                      mmap_mode: str = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Gets the pyramid levels of the clear volume of a data directory and its blurry volume, with the blurry volume
+    histogram matched to the clear volume before rescaling (as data_generator.pair_3d_data_generator does). The levels
+    are computed in parallel with scipy.ndimage.zoom, and cached as .npy files in
+    <root_dir>/Pyramid/volume.<scales key>
+
+    Parameters
+    ----------
+    root_dir: The data directory housing ClearImages and CoregisteredBlurryImages
+    scales: The scales of the levels
+    use_cache: True if we may load and save cached levels
+    mmap_mode: If given (e.g. 'r'), cached levels are memory-mapped with this mode rather than read into memory
+
+    Returns
+    -------
+    A list with a tuple of the rescaled (clear, blurry) volumes at each scale
+    """
+    clear_image_dir = os.path.join(root_dir, 'ClearImages')
+    blurry_image_dir = os.path.join(root_dir, 'CoregisteredBlurryImages')
+    cache_dir = os.path.join(root_dir, PYRAMID_DIR_NAME, f'volume.{_get_scales_key(scales)}')
+    source_hash = None
+    if use_cache:
+        source_paths = [os.path.join(image_dir, file_name) for image_dir in (clear_image_dir, blurry_image_dir)
+                        for file_name in sorted(os.listdir(image_dir))
+                        if file_name.endswith('.jpg') or file_name.endswith('.png')]
+        source_hash = _hash_sources(source_paths, scales)
+        levels = _load_volume_levels(cache_dir, source_hash, mmap_mode=mmap_mode)
+        if levels is not None:
+            return levels
+
+    # Obtain 3D image volumes, and histogram match the blurry volume to the clear volume
+    clear_image_volume = image_utils.get_3d_image_volume(image_dir=clear_image_dir)
+    blurry_image_volume = image_utils.get_3d_image_volume(image_dir=blurry_image_dir)
+    blurry_image_volume = image_utils.hist_match(source=blurry_image_volume,
+                                                 template=clear_image_volume).astype('uint8')
+
+    # Rescale both volumes to every scale in parallel
+    with ThreadPoolExecutor(max_workers=min(2 * len(scales), os.cpu_count() or 1)) as executor:
+        clear_levels = executor.map(lambda scale: zoom(clear_image_volume, (scale, scale, scale)), scales)
+        blurry_levels = executor.map(lambda scale: zoom(blurry_image_volume, (scale, scale, scale)), scales)
+        levels = list(zip(clear_levels, blurry_levels))
+
+    if use_cache:
+        _save_volume_levels(cache_dir, source_hash, levels)
+
+        # Hand back memory-mapped levels, so that the computed ones can be freed
+        if mmap_mode is not None:
+            mapped_levels = _load_volume_levels(cache_dir, source_hash, mmap_mode=mmap_mode)
+            if mapped_levels is not None:
+                return mapped_levels
+
+    return levels
+
+
+def build_pyramids(root_dirs: List[str], scales: List[float] = [1, 0.9, 0.8, 0.7], include_volumes: bool = False,
+                   num_workers: int = None) -> None:
+    """
+    Computes and caches the pyramid levels of every slice pair (and, optionally, of the volumes) of several data
+    directories in parallel, so that later calls to the generators only load them. Levels that are already cached and
+    up to date are left alone.
+
+    Parameters
+    ----------
+    root_dirs: The data directories housing ClearImages and CoregisteredBlurryImages
+    scales: The scales of the levels
+    include_volumes: True if we also want the levels of the 3D volumes
+    num_workers: The number of threads to use. If None, the number of CPUs is used
+
+    Returns
+    -------
+    None
+    """
+    tasks = [(root_dir, file_name) for root_dir in root_dirs
+             for file_name in sorted(os.listdir(os.path.join(root_dir, 'ClearImages')))
+             if file_name.endswith('.jpg') or file_name.endswith('.png')]
+
+    # cv2 releases the GIL while resizing, so threads are enough to compute levels in parallel
+    with ThreadPoolExecutor(max_workers=num_workers or os.cpu_count()) as executor:
+        list(executor.map(lambda task: get_pair_levels(task[0], task[1], scales=scales), tasks))
+
+    if include_volumes:
+        for root_dir in root_dirs:
+            get_volume_levels(root_dir, scales=scales)
+
+    print(f'Built the pyramid levels of {len(tasks)} slices in {root_dirs}')
@@ -0,0 +1,197 @@
+"""
+A content-addressed, size-bounded on-disk cache of denoised images and their evaluation metrics
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+from typing import Dict, Optional
+from utilities.file_utils import atomic_write
+
+# Memoized file hashes, keyed by (path, size, modification time), so that model checkpoints are only hashed once
+_file_hashes = {}
+
+
+def hash_array(array: np.ndarray) -> str:
+    """
+    Gets a hash of the contents (and shape and dtype) of a numpy array
+
+    Parameters
+    ----------
+    array: The array to hash
+
+    Returns
+    -------
+    The hex digest of the array
+    """
+    array = np.ascontiguousarray(array)
+    hasher = hashlib.sha256()
+    hasher.update(f'{array.dtype.str}{array.shape}'.encode())
+    hasher.update(array.tobytes())
+    return hasher.hexdigest()
+
+
+def hash_file(path: str) -> str:
+    """
+    Gets a hash of the contents of a file, such as a model checkpoint
+
+    Parameters
+    ----------
+    path: The path of the file to hash
+
+    Returns
+    -------
+    The hex digest of the file
+    """
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_hashes:
+        hasher = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                hasher.update(chunk)
+        _file_hashes[memo_key] = hasher.hexdigest()
+    return _file_hashes[memo_key]
+
+
+def make_key(**parts) -> str:
+    """
+    Combines everything that a cached result depends on into a single cache key
+
+    Parameters
+    ----------
+    parts: JSON-serializable values (hashes, settings, etc.) that the cached result depends on
+
+    Returns
+    -------
+    The cache key
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    Stores denoised images and their metrics on disk under a key that is derived from everything the result depends
+    on (input hashes, model weight hashes, routing and patch settings). A result can therefore only ever be served for
+    exactly the inputs that produced it. When the cache grows past max_bytes, the least recently used entries are
+    evicted.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 2 * 1024 ** 3):
+        """
+        Constructor for ResultCache
+
+        Parameters
+        ----------
+        cache_dir: The directory in which the cache entries are stored
+        max_bytes: The maximum total size of the cache entries, in bytes
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # The total size of the cache entries, so that we only need to scan the cache directory when evicting
+        self.total_bytes = self._scan()[1]
+
+    def _entry_path(self, key: str) -> str:
+        """ Gets the path of the cache entry for a key """
+        return os.path.join(self.cache_dir, key[:2], key + '.npz')
+
+    def get(self, key: str) -> Optional[Dict]:
+        """
+        Gets a cached result
+
+        Parameters
+        ----------
+        key: The cache key, from make_key
+
+        Returns
+        -------
+        A dictionary with the cached 'metrics' (and 'image', if one was stored), or None on a cache miss
+        """
+        path = self._entry_path(key)
+        try:
+            with np.load(path) as entry:
+                result = {'metrics': json.loads(str(entry['metrics']))}
+                if 'image' in entry:
+                    result['image'] = entry['image']
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+
+        # Mark the entry as recently used (unless another process has just evicted it)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        return result
+
+    def put(self, key: str, image: np.ndarray = None, metrics: Dict = None) -> None:
+        """
+        Stores a result, then evicts the least recently used entries if the cache is over its size limit
+
+        Parameters
+        ----------
+        key: The cache key, from make_key
+        image: An optional image (e.g. a denoised slice) to store
+        metrics: Optional JSON-serializable metrics (e.g. PSNR and SSIM) to store
+
+        Returns
+        -------
+        None
+        """
+        path = self._entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        arrays = {'metrics': np.array(json.dumps(metrics if metrics is not None else {}))}
+        if image is not None:
+            arrays['image'] = image
+        if os.path.exists(path):
+            self.total_bytes -= os.path.getsize(path)
+        atomic_write(path, lambda file: np.savez(file, **arrays), binary=True)
+        self.total_bytes += os.path.getsize(path)
+
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def _scan(self):
+        """
+        Gets every cache entry and the total size of the cache
+
+        Returns
+        -------
+        A tuple of (a list of (modification time, size, path) tuples, the total size in bytes)
+        """
+        entries = []
+        total_bytes = 0
+        for root, _, file_names in os.walk(self.cache_dir):
+            for file_name in file_names:
+                if file_name.endswith('.npz'):
+                    stat = os.stat(os.path.join(root, file_name))
+                    entries.append((stat.st_mtime, stat.st_size, os.path.join(root, file_name)))
+                    total_bytes += stat.st_size
+        return entries, total_bytes
+
+    def evict(self) -> None:
+        """
+        Deletes the least recently used entries until the cache fits within max_bytes
+
+        Returns
+        -------
+        None
+        """
+        entries, self.total_bytes = self._scan()
+
+        # Evict the least recently used entries first
+        for _, size, path in sorted(entries):
+            if self.total_bytes <= self.max_bytes:
+                break
+            # Another process sharing the cache may have evicted the entry already
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.total_bytes -= size
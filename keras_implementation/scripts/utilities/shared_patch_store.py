@@ -0,0 +1,281 @@
+"""
+Publishes a PatchDataset as read-only memory-mapped files, so that concurrent training processes on the same machine
+share one copy of the patches instead of each holding its own
+"""
+
+import os
+import json
+import time
+import fcntl
+import atexit
+import shutil
+import hashlib
+import contextlib
+import numpy as np
+from typing import List
+from utilities import job_dag
+from utilities.file_utils import atomic_write
+from utilities.patch_dataset import PatchDataset
+
+# The prefix-sum keys of every metric of a PatchDataset
+_PREFIX_SUM_KEYS = ('x', 'x_squared', 'y', 'y_squared')
+
+
+def get_store_key(train_data_dirs: List[str], patch_size: int = 40, stride: int = 10,
+                  scales: List[float] = [1, 0.9, 0.8, 0.7], compute_residual_stds: bool = False) -> str:
+    """
+    Gets the key of the shared store of a PatchDataset, from its settings and the names, sizes and modification
+    times of its training images, so that processes only ever share a store built from the same data
+
+    Parameters
+    ----------
+    train_data_dirs: The training data directories
+    patch_size: The size of each patch in pixels -> (patch_size, patch_size)
+    stride: The stride with which to slide the patch-taking window
+    scales: A list of scales at which image patches are created
+    compute_residual_stds: True if the dataset has a 'std' metric column
+
+    Returns
+    -------
+    A hex digest
+    """
+    description = {
+        'train_data_dirs': [os.path.abspath(root_dir) for root_dir in train_data_dirs],
+        'images': [job_dag.fingerprint_path(os.path.join(root_dir, image_dir)) for root_dir in train_data_dirs
+                   for image_dir in ('ClearImages', 'CoregisteredBlurryImages')],
+        'patch_size': patch_size,
+        'stride': stride,
+        'scales': scales,
+        'compute_residual_stds': compute_residual_stds
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()[:32]
+
+
+def _is_process_alive(pid: int) -> bool:
+    """ True if a process with this id is running on this machine """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SharedPatchStore:
+    """
+    A PatchDataset published as .npy files in a directory (ideally on a RAM-backed filesystem such as /dev/shm), which
+    every process maps read-only, so the operating system keeps a single copy of each page.
+
+    Every process using the store holds a reference, as a file named after its process id in <store_dir>/refs. When
+    the last process releases its reference (explicitly, or when it exits), the store is deleted. References of
+    processes that died without releasing them are ignored. References are taken and released under an flock on
+    <store_dir>.lock, so a store is never deleted while another process is taking a reference to it.
+
+    One process builds and publishes the store, under the publish lock <store_dir>/publish.<generation>.lock, which
+    holds its process id. If the publisher dies, another process takes over by creating the next generation.
+    """
+
+    def __init__(self, store_dir: str):
+        """
+        Constructor for SharedPatchStore
+
+        Parameters
+        ----------
+        store_dir: The directory of this store, e.g. <shared directory>/<get_store_key(...)>
+        """
+        self.store_dir = store_dir
+        self.refs_dir = os.path.join(store_dir, 'refs')
+        self.manifest_path = os.path.join(store_dir, 'manifest.json')
+        self.refs_lock_path = store_dir.rstrip(os.sep) + '.lock'
+        self._holds_reference = False
+
+    @contextlib.contextmanager
+    def _refs_locked(self):
+        """ Holds the lock on the references of the store. The OS releases it if this process dies """
+        os.makedirs(os.path.dirname(os.path.abspath(self.refs_lock_path)), exist_ok=True)
+        with open(self.refs_lock_path, 'a') as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+    def acquire(self) -> None:
+        """ Takes a reference to the store, which is released when this process exits """
+        with self._refs_locked():
+            os.makedirs(self.refs_dir, exist_ok=True)
+            with open(os.path.join(self.refs_dir, str(os.getpid())), 'w'):
+                pass
+        if not self._holds_reference:
+            self._holds_reference = True
+            atexit.register(self.release)
+
+    def release(self) -> None:
+        """ Releases this process's reference, deleting the store if no live process still holds one """
+        if not self._holds_reference:
+            return
+        self._holds_reference = False
+        with self._refs_locked():
+            try:
+                os.remove(os.path.join(self.refs_dir, str(os.getpid())))
+                live_refs = [ref for ref in os.listdir(self.refs_dir) if _is_process_alive(int(ref))]
+            except FileNotFoundError:
+                return
+            if not live_refs:
+                shutil.rmtree(self.store_dir, ignore_errors=True)
+
+    def is_published(self) -> bool:
+        return os.path.exists(self.manifest_path)
+
+    def _lock_path(self, generation: int) -> str:
+        return os.path.join(self.store_dir, f'publish.{generation:06d}.lock')
+
+    def _get_lock_generation(self) -> int:
+        """ Gets the generation of the current publish lock, or -1 if the store has never been locked """
+        generations = [int(name.split('.')[1]) for name in os.listdir(self.store_dir)
+                       if name.startswith('publish.') and name.endswith('.lock')]
+        return max(generations, default=-1)
+
+    def _read_lock_pid(self, generation: int) -> int:
+        """ Reads the process id of the holder of a publish lock, or 0 if it doesn't exist """
+        try:
+            with open(self._lock_path(generation)) as file:
+                return int(file.read())
+        except FileNotFoundError:
+            return 0
+
+    def try_lock(self) -> bool:
+        """
+        Tries to become the process that publishes the store, taking over from a publisher that died
+
+        Returns
+        -------
+        True if this process should build and publish the dataset
+        """
+        generation = self._get_lock_generation()
+        if generation >= 0:
+            publisher_pid = self._read_lock_pid(generation)
+            if publisher_pid and _is_process_alive(publisher_pid):
+                return False
+
+        # Write our process id, and link it into place as the next generation of the lock. Linking fails if another
+        # process took that generation first, and the lock never exists without its pid
+        try:
+            atomic_write(self._lock_path(generation + 1), lambda file: file.write(str(os.getpid())), overwrite=False)
+        except FileExistsError:
+            return False
+
+        # Make sure that the lock is ours, and still the current one
+        return self._read_lock_pid(generation + 1) == os.getpid() and \
+            self._get_lock_generation() == generation + 1
+
+    def wait_until_published(self, poll_seconds: float = 5) -> bool:
+        """
+        Waits until another process has published the store
+
+        Returns
+        -------
+        True if the store was published, or False if its publisher died first and this process took over the publish
+        lock (so it should publish the store itself)
+        """
+        while not self.is_published():
+            if self.try_lock():
+                return False
+            time.sleep(poll_seconds)
+        return True
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.store_dir, name + '.npy')
+
+    def _save(self, name: str, array: np.ndarray) -> None:
+        """ Writes an array of the store atomically, so that it is never seen partially written """
+        atomic_write(self._path(name), lambda file: np.save(file, array), binary=True)
+
+    def publish(self, dataset: PatchDataset) -> None:
+        """
+        Writes a dataset, including its index, into the store. Each array is renamed into place once written, and the
+        manifest is written last, so other processes never attach to a partially written store
+
+        Parameters
+        ----------
+        dataset: The PatchDataset to publish
+
+        Returns
+        -------
+        None
+        """
+        self._save('x', dataset.x)
+        self._save('y', dataset.y)
+        for name in dataset.metrics:
+            self._save(f'metric_{name}', dataset.metrics[name])
+            self._save(f'order_{name}', dataset.order[name])
+            self._save(f'sorted_{name}', dataset.sorted_metrics[name])
+            for key in _PREFIX_SUM_KEYS:
+                self._save(f'prefix_{name}_{key}', dataset.prefix_sums[name][key])
+
+        # Keep the publish lock: once the manifest exists, no process tries to take it
+        manifest = {'metrics': list(dataset.metrics), 'num_patches': len(dataset)}
+        atomic_write(self.manifest_path, lambda file: json.dump(manifest, file))
+
+    def attach(self) -> PatchDataset:
+        """
+        Maps the published dataset into this process, read-only
+
+        Returns
+        -------
+        A PatchDataset whose arrays are read-only memory maps of the store
+        """
+        with open(self.manifest_path) as file:
+            manifest = json.load(file)
+
+        def load(name):
+            return np.load(self._path(name), mmap_mode='r')
+
+        metric_names = manifest['metrics']
+        return PatchDataset.from_index(load('x'), load('y'),
+                                       metrics={name: load(f'metric_{name}') for name in metric_names},
+                                       order={name: load(f'order_{name}') for name in metric_names},
+                                       sorted_metrics={name: load(f'sorted_{name}') for name in metric_names},
+                                       prefix_sums={name: {key: load(f'prefix_{name}_{key}')
+                                                           for key in _PREFIX_SUM_KEYS}
+                                                    for name in metric_names})
+
+
+def load_shared_dataset(shared_dir: str, train_data_dirs: List[str], patch_size: int = 40, stride: int = 10,
+                        scales: List[float] = [1, 0.9, 0.8, 0.7], compute_residual_stds: bool = False,
+                        ram_budget_mb: float = None) -> PatchDataset:
+    """
+    Gets a PatchDataset of the training data from a shared store, building and publishing it first if no other
+    process on this machine has. Arguments are as in PatchDataset.from_train_data.
+
+    Parameters
+    ----------
+    shared_dir: The directory that holds the shared stores, e.g. /dev/shm/hydranet
+
+    Returns
+    -------
+    A read-only PatchDataset, backed by the shared store
+    """
+    store = SharedPatchStore(os.path.join(shared_dir, get_store_key(train_data_dirs, patch_size=patch_size,
+                                                                    stride=stride, scales=scales,
+                                                                    compute_residual_stds=compute_residual_stds)))
+    store.acquire()
+
+    # Publish the store, unless another process is already publishing it, in which case wait for that process (and
+    # take over from it if it dies)
+    publishing = not store.is_published() and store.try_lock()
+    if not publishing and not store.is_published():
+        print(f'Waiting for another process to publish the patch dataset to {store.store_dir}')
+        publishing = not store.wait_until_published()
+    if publishing:
+        # Build the dataset in this process, then drop the private copy once it has been published
+        print(f'Publishing the patch dataset to {store.store_dir}')
+        dataset = PatchDataset.from_train_data(train_data_dirs, patch_size=patch_size, stride=stride,
+                                               scales=scales, compute_residual_stds=compute_residual_stds,
+                                               ram_budget_mb=ram_budget_mb)
+        store.publish(dataset)
+        del dataset
+
+    print(f'Attaching to the shared patch dataset in {store.store_dir}')
+    return store.attach()
@@ -0,0 +1,365 @@
+"""
+Streaming, mergeable statistics (mean/variance, histograms, and quantiles), which can be persisted per subject
+"""
+
+import os
+import json
+import math
+import numpy as np
+from typing import Dict, Optional
+from utilities.file_utils import atomic_write
+
+
+class RunningStats:
+    """
+    Running count, mean and variance, updated with batches of values using Welford's algorithm (in the parallel form
+    of Chan et al.), so that summaries of separate data can be merged exactly
+    """
+
+    def __init__(self, count: int = 0, mean: float = 0.0, m2: float = 0.0):
+        """
+        Constructor for RunningStats
+
+        Parameters
+        ----------
+        count: The number of values seen so far
+        mean: The mean of the values seen so far
+        m2: The sum of squared differences from the mean of the values seen so far
+        """
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+
+    def update(self, values: np.ndarray) -> None:
+        """
+        Adds a batch of values
+
+        Parameters
+        ----------
+        values: An array of values of any shape
+
+        Returns
+        -------
+        None
+        """
+        values = np.asarray(values, dtype='float64').ravel()
+        if len(values) == 0:
+            return
+        batch_mean = float(values.mean())
+        self.merge(RunningStats(len(values), batch_mean, float(np.square(values - batch_mean).sum())))
+
+    def merge(self, other: 'RunningStats') -> 'RunningStats':
+        """
+        Merges the values of another RunningStats into this one
+
+        Parameters
+        ----------
+        other: The RunningStats to merge in
+
+        Returns
+        -------
+        This RunningStats
+        """
+        count = self.count + other.count
+        if count == 0:
+            return self
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+        return self
+
+    @property
+    def variance(self) -> float:
+        """ The population variance of the values, as np.var computes it """
+        return self.m2 / self.count if self.count > 0 else 0.0
+
+    @property
+    def std(self) -> float:
+        """ The population standard deviation of the values, as np.std computes it """
+        return math.sqrt(self.variance)
+
+    def to_dict(self) -> Dict:
+        return {'type': 'RunningStats', 'count': self.count, 'mean': self.mean, 'm2': self.m2}
+
+    @classmethod
+    def from_dict(cls, summary: Dict) -> 'RunningStats':
+        return cls(summary['count'], summary['mean'], summary['m2'])
+
+
+class FixedHistogram:
+    """
+    A histogram with fixed, equal-width bins, e.g. of 8-bit px values. Histograms with the same bins can be merged
+    exactly.
+    """
+
+    def __init__(self, low: float = 0.0, high: float = 256.0, num_bins: int = 256, counts: np.ndarray = None):
+        """
+        Constructor for FixedHistogram
+
+        Parameters
+        ----------
+        low: The lower edge of the first bin
+        high: The upper edge of the last bin. Values outside of [low, high) are clipped into the first or last bin
+        num_bins: The number of bins
+        counts: Optional initial counts of each bin
+        """
+        self.low = low
+        self.high = high
+        self.num_bins = num_bins
+        self.counts = np.zeros(num_bins, dtype='int64') if counts is None else np.asarray(counts, dtype='int64')
+
+    def update(self, values: np.ndarray) -> None:
+        """
+        Adds a batch of values
+
+        Parameters
+        ----------
+        values: An array of values of any shape
+
+        Returns
+        -------
+        None
+        """
+        values = np.asarray(values).ravel()
+        bins = np.floor((values.astype('float64') - self.low) * (self.num_bins / (self.high - self.low)))
+        bins = np.clip(bins, 0, self.num_bins - 1).astype('int64')
+        self.counts += np.bincount(bins, minlength=self.num_bins)
+
+    def merge(self, other: 'FixedHistogram') -> 'FixedHistogram':
+        """
+        Merges the counts of another FixedHistogram, with the same bins, into this one
+
+        Parameters
+        ----------
+        other: The FixedHistogram to merge in
+
+        Returns
+        -------
+        This FixedHistogram
+        """
+        if (self.low, self.high, self.num_bins) != (other.low, other.high, other.num_bins):
+            raise ValueError('Only histograms with the same bins can be merged')
+        self.counts += other.counts
+        return self
+
+    @property
+    def count(self) -> int:
+        return int(self.counts.sum())
+
+    def quantile(self, q: float) -> float:
+        """
+        Gets an approximate quantile, interpolating linearly within a bin
+
+        Parameters
+        ----------
+        q: The quantile, in [0, 1]
+
+        Returns
+        -------
+        The value below which a fraction q of the values lie
+        """
+        if self.count == 0:
+            raise ValueError('Cannot get a quantile of an empty histogram')
+        cumulative_counts = np.cumsum(self.counts)
+        rank = q * self.count
+        bin_index = min(int(np.searchsorted(cumulative_counts, rank, side='left')), self.num_bins - 1)
+        previous_count = cumulative_counts[bin_index - 1] if bin_index > 0 else 0
+        fraction = (rank - previous_count) / self.counts[bin_index] if self.counts[bin_index] > 0 else 0.0
+        bin_width = (self.high - self.low) / self.num_bins
+        return self.low + (bin_index + fraction) * bin_width
+
+    def to_dict(self) -> Dict:
+        return {'type': 'FixedHistogram', 'low': self.low, 'high': self.high, 'num_bins': self.num_bins,
+                'counts': self.counts.tolist()}
+
+    @classmethod
+    def from_dict(cls, summary: Dict) -> 'FixedHistogram':
+        return cls(summary['low'], summary['high'], summary['num_bins'], summary['counts'])
+
+
+class QuantileSketch:
+    """
+    A mergeable quantile sketch of non-negative values, with logarithmically spaced buckets (as in DDSketch), so that
+    every quantile is within a relative error of relative_accuracy of the exact quantile, in a fixed amount of memory.
+    Values below min_value (including 0) are counted in a separate zero bucket.
+    """
+
+    def __init__(self, relative_accuracy: float = 0.01, min_value: float = 1e-6, buckets: Dict[int, int] = None,
+                 zero_count: int = 0):
+        """
+        Constructor for QuantileSketch
+
+        Parameters
+        ----------
+        relative_accuracy: The relative accuracy of the quantiles
+        min_value: Values below this are counted as 0
+        buckets: Optional initial counts of each bucket
+        zero_count: Optional initial count of the zero bucket
+        """
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.buckets = {} if buckets is None else {int(key): int(value) for key, value in buckets.items()}
+        self.zero_count = zero_count
+
+    def update(self, values: np.ndarray) -> None:
+        """
+        Adds a batch of values. Non-finite values are ignored.
+
+        Parameters
+        ----------
+        values: An array of non-negative values of any shape
+
+        Returns
+        -------
+        None
+        """
+        values = np.asarray(values, dtype='float64').ravel()
+        values = values[np.isfinite(values)]
+        if np.any(values < 0):
+            raise ValueError('QuantileSketch only supports non-negative values')
+
+        is_zero = values < self.min_value
+        self.zero_count += int(is_zero.sum())
+
+        # Get the bucket of each value, such that bucket k holds the values in (gamma^(k-1), gamma^k]
+        keys = np.ceil(np.log(values[~is_zero]) / math.log(self.gamma)).astype('int64')
+        for key, count in zip(*np.unique(keys, return_counts=True)):
+            self.buckets[int(key)] = self.buckets.get(int(key), 0) + int(count)
+
+    def merge(self, other: 'QuantileSketch') -> 'QuantileSketch':
+        """
+        Merges the counts of another QuantileSketch, with the same accuracy, into this one
+
+        Parameters
+        ----------
+        other: The QuantileSketch to merge in
+
+        Returns
+        -------
+        This QuantileSketch
+        """
+        if (self.relative_accuracy, self.min_value) != (other.relative_accuracy, other.min_value):
+            raise ValueError('Only sketches with the same accuracy can be merged')
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self.zero_count += other.zero_count
+        return self
+
+    @property
+    def count(self) -> int:
+        return self.zero_count + sum(self.buckets.values())
+
+    def quantile(self, q: float) -> float:
+        """
+        Gets an approximate quantile
+
+        Parameters
+        ----------
+        q: The quantile, in [0, 1]
+
+        Returns
+        -------
+        The value at rank q * (count - 1), as np.percentile uses, within the relative accuracy of the sketch
+        """
+        if self.count == 0:
+            raise ValueError('Cannot get a quantile of an empty sketch')
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return 0.0
+        cumulative_count = self.zero_count
+        for key in sorted(self.buckets):
+            cumulative_count += self.buckets[key]
+            if cumulative_count > rank:
+                # Return the value in the bucket with the lowest relative error to any value in the bucket
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+    def to_dict(self) -> Dict:
+        return {'type': 'QuantileSketch', 'relative_accuracy': self.relative_accuracy, 'min_value': self.min_value,
+                'buckets': {str(key): count for key, count in self.buckets.items()}, 'zero_count': self.zero_count}
+
+    @classmethod
+    def from_dict(cls, summary: Dict) -> 'QuantileSketch':
+        return cls(summary['relative_accuracy'], summary['min_value'], summary['buckets'], summary['zero_count'])
+
+
+# The statistics classes, by the 'type' that they save in their summaries
+_STATISTICS_TYPES = {statistics_type.__name__: statistics_type
+                     for statistics_type in (RunningStats, FixedHistogram, QuantileSketch)}
+
+
+def merge_statistics(statistics_list) -> Dict:
+    """
+    Merges several dictionaries of named statistics (e.g. one per subject) into one dictionary (e.g. for a fold)
+
+    Parameters
+    ----------
+    statistics_list: A list of dictionaries from name to a RunningStats, FixedHistogram, or QuantileSketch
+
+    Returns
+    -------
+    A dictionary of the merged statistics. The inputs are left unchanged
+    """
+    merged = {}
+    for statistics in statistics_list:
+        for name, statistic in statistics.items():
+            if name not in merged:
+                merged[name] = type(statistic).from_dict(statistic.to_dict())
+            else:
+                merged[name].merge(statistic)
+    return merged
+
+
+def save_statistics(path: str, key: str, fingerprint: str, statistics: Dict) -> None:
+    """
+    Saves a dictionary of named statistics to a JSON file, under a key (e.g. of the settings used to compute them).
+    Entries under other keys in the file are kept.
+
+    Parameters
+    ----------
+    path: The path of the JSON file
+    key: The key of this entry, e.g. a hash of the patch size, stride, and scales
+    fingerprint: A fingerprint of the source data, used to detect stale statistics in load_statistics
+    statistics: A dictionary from name to a RunningStats, FixedHistogram, or QuantileSketch
+
+    Returns
+    -------
+    None
+    """
+    entries = {}
+    if os.path.exists(path):
+        try:
+            with open(path) as file:
+                entries = json.load(file)
+        except ValueError:
+            entries = {}
+    entries[key] = {'fingerprint': fingerprint,
+                    'statistics': {name: statistic.to_dict() for name, statistic in statistics.items()}}
+    atomic_write(path, lambda file: json.dump(entries, file))
+
+
+def load_statistics(path: str, key: str, fingerprint: str) -> Optional[Dict]:
+    """
+    Loads a dictionary of named statistics saved by save_statistics
+
+    Parameters
+    ----------
+    path: The path of the JSON file
+    key: The key of the entry
+    fingerprint: The current fingerprint of the source data
+
+    Returns
+    -------
+    The dictionary of statistics, or None if there is no entry, or if it was computed from different source data
+    """
+    try:
+        with open(path) as file:
+            entry = json.load(file).get(key)
+    except (OSError, ValueError):
+        return None
+    if entry is None or entry['fingerprint'] != fingerprint:
+        return None
+    return {name: _STATISTICS_TYPES[summary['type']].from_dict(summary)
+            for name, summary in entry['statistics'].items()}
@@ -0,0 +1,141 @@
+"""
+Measures training throughput, to tell whether an epoch is slow because of the input pipeline or the model
+"""
+
+import os
+import csv
+import time
+import resource
+import threading
+from tensorflow.keras.callbacks import Callback
+from utilities import logger
+
+
+def get_peak_rss_mb() -> float:
+    """ Gets the peak resident memory of this process so far, in MB """
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class TimedGenerator:
+    """
+    Wraps a training batch generator, timing how long each batch takes to produce and counting its samples. Train on
+    iter(<TimedGenerator>). Keras may draw batches from a background thread, so the totals are guarded by a lock.
+    """
+
+    def __init__(self, generator):
+        """
+        Constructor for TimedGenerator
+
+        Parameters
+        ----------
+        generator: A generator (or other iterable) of (batch_y, batch_x) training batches
+        """
+        self.generator = iter(generator)
+        self.data_seconds = 0.0
+        self.num_batches = 0
+        self.num_samples = 0
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        # This is a generator function, as Keras only accepts a generator object, rather than any iterator
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(self.generator)
+            except StopIteration:
+                return
+            seconds = time.perf_counter() - start
+            with self._lock:
+                self.data_seconds += seconds
+                self.num_batches += 1
+                self.num_samples += len(batch[0])
+            yield batch
+
+    def get_totals(self):
+        """ Gets the (data_seconds, num_batches, num_samples) totals so far """
+        with self._lock:
+            return self.data_seconds, self.num_batches, self.num_samples
+
+
+class ThroughputCallback(Callback):
+    """
+    Records the data-wait time (spent producing batches) and compute time (the rest of each step), the samples per
+    second, and the peak RSS of training, per step into throughput_steps.csv and per epoch into throughput.csv, next
+    to the log.csv of the model. Warns when the input pipeline takes more than bottleneck_fraction of an epoch.
+
+    A batch is counted in the step (or epoch) during which it was produced, so batches that Keras prefetches are
+    counted before the step that trains on them.
+    """
+
+    def __init__(self, timed_generator: TimedGenerator, log_dir: str, bottleneck_fraction: float = 0.5):
+        """
+        Constructor for ThroughputCallback
+
+        Parameters
+        ----------
+        timed_generator: The TimedGenerator that the model is trained on
+        log_dir: The directory in which to write throughput.csv and throughput_steps.csv
+        bottleneck_fraction: The fraction of an epoch spent producing batches above which we warn that the input
+            pipeline is the bottleneck
+        """
+        super().__init__()
+        self.timed_generator = timed_generator
+        self.epoch_path = os.path.join(log_dir, 'throughput.csv')
+        self.step_path = os.path.join(log_dir, 'throughput_steps.csv')
+        self.bottleneck_fraction = bottleneck_fraction
+
+    @staticmethod
+    def _append_rows(path: str, header, rows) -> None:
+        """ Appends rows to a CSV file, writing its header first if the file is new """
+        is_new = not os.path.exists(path)
+        with open(path, 'a', newline='') as file:
+            writer = csv.writer(file)
+            if is_new:
+                writer.writerow(header)
+            writer.writerows(rows)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self.epoch_start = time.perf_counter()
+        self.epoch_totals = self.timed_generator.get_totals()
+        self.step_totals = self.epoch_totals
+        self.step_rows = []
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        step_seconds = time.perf_counter() - self.step_start
+        totals = self.timed_generator.get_totals()
+        data_seconds, _, num_samples = (total - previous for total, previous in zip(totals, self.step_totals))
+        self.step_totals = totals
+        self.step_rows.append([self.epoch + 1, batch + 1, f'{step_seconds:.6f}', f'{data_seconds:.6f}',
+                               f'{max(step_seconds - data_seconds, 0.0):.6f}',
+                               f'{num_samples / step_seconds if step_seconds > 0 else 0.0:.2f}'])
+
+    def on_epoch_end(self, epoch, logs=None):
+        epoch_seconds = time.perf_counter() - self.epoch_start
+        totals = self.timed_generator.get_totals()
+        data_seconds, num_batches, num_samples = (total - previous
+                                                  for total, previous in zip(totals, self.epoch_totals))
+        data_fraction = data_seconds / epoch_seconds if epoch_seconds > 0 else 0.0
+        samples_per_second = num_samples / epoch_seconds if epoch_seconds > 0 else 0.0
+        peak_rss_mb = get_peak_rss_mb()
+
+        # Write the rows of every step of this epoch at once, rather than opening the file on every step
+        self._append_rows(self.step_path,
+                          ['epoch', 'step', 'step_seconds', 'data_seconds', 'compute_seconds', 'samples_per_second'],
+                          self.step_rows)
+        self._append_rows(self.epoch_path,
+                          ['epoch', 'steps', 'epoch_seconds', 'data_seconds', 'compute_seconds', 'data_fraction',
+                           'samples_per_second', 'peak_rss_mb'],
+                          [[epoch + 1, len(self.step_rows), f'{epoch_seconds:.3f}', f'{data_seconds:.3f}',
+                            f'{max(epoch_seconds - data_seconds, 0.0):.3f}', f'{data_fraction:.4f}',
+                            f'{samples_per_second:.2f}', f'{peak_rss_mb:.1f}']])
+
+        logger.log(f'epoch {epoch + 1}: {samples_per_second:.1f} samples/s, {100 * data_fraction:.1f}% of '
+                   f'{epoch_seconds:.1f} s producing {num_batches} batches, peak RSS {peak_rss_mb:.1f} MB')
+        if data_fraction > self.bottleneck_fraction:
+            logger.log(f'WARNING: the input pipeline is the bottleneck, taking {100 * data_fraction:.1f}% of the '
+                       f'epoch. Consider --stratified_sampling or --online_sampling, or a faster generator')
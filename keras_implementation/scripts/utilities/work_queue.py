@@ -0,0 +1,269 @@
+"""
+A job queue on a shared filesystem, for spreading work across several machines without a scheduler
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+from utilities.file_utils import atomic_write
+
+
+def _write_json_atomically(path: str, contents: Dict) -> None:
+    """ Writes a JSON file atomically, so that readers never see a partially written file """
+    atomic_write(path, lambda file: json.dump(contents, file, default=float))
+
+
+def _read_json(path: str) -> Optional[Dict]:
+    """ Reads a JSON file, or returns None if it doesn't exist """
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+class WorkQueue:
+    """
+    A queue of jobs, kept in a directory on a filesystem shared by every worker:
+
+    - jobs/<job_id>.json holds the specification of each job
+    - leases/<job_id>.<generation>.lease is the lease of each claim of a job. A worker writes its lease to a uniquely
+      named temporary file, then hard links it into place, which fails if the name already exists, so only one worker
+      can claim each generation. The worker keeps touching its lease while the job runs, and a lease that hasn't been
+      touched for lease_seconds is considered abandoned by a dead worker. The job is then reclaimed by claiming the
+      next generation. The lease of the highest generation is the current one, and no lease is ever renamed or
+      removed while its job is being claimed, so a worker can't take over a lease that another worker just created
+    - done/<job_id>.json is the completion manifest of each job, holding its result
+
+    Lease expiry compares the modification time of the lease with the local clock, so the clocks of the machines
+    should agree to well within lease_seconds.
+    """
+
+    def __init__(self, queue_dir: str, lease_seconds: float = 600, worker_id: str = None):
+        """
+        Constructor for WorkQueue
+
+        Parameters
+        ----------
+        queue_dir: The shared directory of the queue
+        lease_seconds: How long a lease may go without being renewed before its job is reclaimed by another worker
+        worker_id: A name for this worker, recorded in its leases and manifests. If None, <host name>:<process id>
+        """
+        self.queue_dir = queue_dir
+        self.lease_seconds = lease_seconds
+        self.worker_id = worker_id if worker_id is not None else f'{socket.gethostname()}:{os.getpid()}'
+        self.jobs_dir = os.path.join(queue_dir, 'jobs')
+        self.leases_dir = os.path.join(queue_dir, 'leases')
+        self.done_dir = os.path.join(queue_dir, 'done')
+        for directory in (self.jobs_dir, self.leases_dir, self.done_dir):
+            os.makedirs(directory, exist_ok=True)
+
+        # The lease path that this worker holds for each job it has claimed
+        self.held_leases = {}
+
+    def _job_path(self, job_id: str) -> str:
+        return os.path.join(self.jobs_dir, job_id + '.json')
+
+    def _lease_path(self, job_id: str, generation: int) -> str:
+        return os.path.join(self.leases_dir, f'{job_id}.{generation:06d}.lease')
+
+    def _get_lease_generations(self) -> Dict[str, int]:
+        """ Gets the highest lease generation of every job that has ever been claimed """
+        generations = {}
+        for file_name in os.listdir(self.leases_dir):
+            job_id, _, generation = file_name[:-len('.lease')].rpartition('.')
+            if file_name.endswith('.lease') and generation.isdigit():
+                generations[job_id] = max(generations.get(job_id, -1), int(generation))
+        return generations
+
+    def _read_lease_owner(self, lease_path: str) -> Optional[str]:
+        """ Reads the claim token of a lease, or returns None if it doesn't exist """
+        lease = _read_json(lease_path)
+        return None if lease is None else lease['token']
+
+    def _is_expired(self, lease_path: str) -> bool:
+        """ True if a lease hasn't been renewed for lease_seconds (or has been released) """
+        try:
+            return time.time() - os.path.getmtime(lease_path) >= self.lease_seconds
+        except FileNotFoundError:
+            return True
+
+    def _done_path(self, job_id: str) -> str:
+        return os.path.join(self.done_dir, job_id + '.json')
+
+    def submit(self, jobs: Dict[str, Dict]) -> None:
+        """
+        Adds jobs to the queue. Every worker may submit the same jobs: jobs that already exist are left as they are
+
+        Parameters
+        ----------
+        jobs: A dictionary from job id (usable as a file name) to the JSON-serializable specification of the job
+
+        Returns
+        -------
+        None
+        """
+        for job_id, job in jobs.items():
+            existing_job = _read_json(self._job_path(job_id))
+            if existing_job is None:
+                _write_json_atomically(self._job_path(job_id), job)
+            elif existing_job != job:
+                raise ValueError(f"Job '{job_id}' already exists in {self.queue_dir} with a different specification. "
+                                 f"Use a new queue directory for a new run")
+
+    def get_job_ids(self) -> List[str]:
+        """ Gets the ids of every job in the queue, in sorted order """
+        return sorted(file_name[:-len('.json')] for file_name in os.listdir(self.jobs_dir)
+                      if file_name.endswith('.json'))
+
+    def is_done(self, job_id: str) -> bool:
+        return os.path.exists(self._done_path(job_id))
+
+    def is_finished(self) -> bool:
+        """ True if every job in the queue has a completion manifest """
+        return all(self.is_done(job_id) for job_id in self.get_job_ids())
+
+    def _try_lease(self, job_id: str, generation: int) -> bool:
+        """
+        Tries to claim the lease of a job. If the job has a current lease (of generation - 1), it must have expired,
+        and the job is reclaimed by claiming the next generation
+
+        Parameters
+        ----------
+        job_id: The id of the job
+        generation: The generation of the job's next lease, i.e. one past the highest generation seen
+
+        Returns
+        -------
+        True if this worker now holds the lease
+        """
+        if generation > 0 and not self._is_expired(self._lease_path(job_id, generation - 1)):
+            return False
+
+        # Write the lease with a unique token, and link it into place. Linking fails if another worker claimed this
+        # generation first, so the lease never exists without its owner
+        token = f'{self.worker_id}:{uuid.uuid4().hex}'
+        lease_path = self._lease_path(job_id, generation)
+        try:
+            atomic_write(lease_path, lambda file: json.dump({'worker_id': self.worker_id, 'token': token}, file),
+                         overwrite=False)
+        except FileExistsError:
+            return False
+
+        # Read the lease back, and make sure that it is ours and still the current one, before running the job
+        if self._read_lease_owner(lease_path) != token or \
+                self._get_lease_generations().get(job_id, -1) != generation:
+            return False
+        self.held_leases[job_id] = lease_path
+
+        # The job may have been completed between checking it and taking the lease
+        if self.is_done(job_id):
+            self.release(job_id)
+            return False
+        return True
+
+    def claim(self) -> Optional[Tuple[str, Dict]]:
+        """
+        Claims the next job that is neither done nor leased by a live worker
+
+        Returns
+        -------
+        A tuple of (job id, job specification), or None if there is no such job
+        """
+        generations = self._get_lease_generations()
+        for job_id in self.get_job_ids():
+            if not self.is_done(job_id) and self._try_lease(job_id, generations.get(job_id, -1) + 1):
+                return job_id, _read_json(self._job_path(job_id))
+        return None
+
+    def renew(self, job_id: str) -> None:
+        """ Renews the lease of a claimed job, so that it doesn't expire while the job is still running """
+        try:
+            os.utime(self.held_leases[job_id])
+        except (KeyError, FileNotFoundError):
+            pass
+
+    def release(self, job_id: str) -> None:
+        """
+        Gives up the lease of a claimed job, so that another worker can claim it right away. The lease is kept (so
+        that its generation stays taken), but marked as expired
+        """
+        lease_path = self.held_leases.pop(job_id, None)
+        if lease_path is None:
+            return
+        try:
+            os.utime(lease_path, (0, 0))
+        except FileNotFoundError:
+            pass
+
+    def complete(self, job_id: str, result: Dict) -> None:
+        """
+        Writes the completion manifest of a claimed job, then releases its lease
+
+        Parameters
+        ----------
+        job_id: The id of the job
+        result: The JSON-serializable result of the job
+
+        Returns
+        -------
+        None
+        """
+        _write_json_atomically(self._done_path(job_id), {'worker_id': self.worker_id, 'completed_at': time.time(),
+                                                         'result': result})
+        self.release(job_id)
+
+    def get_result(self, job_id: str) -> Optional[Dict]:
+        """ Gets the result of a job from its completion manifest, or None if the job isn't done """
+        manifest = _read_json(self._done_path(job_id))
+        return None if manifest is None else manifest['result']
+
+    def run(self, function: Callable[[Dict], Dict], wait_for_others: bool = True, poll_seconds: float = 10) -> int:
+        """
+        Claims and runs jobs until there are none left. The lease of each job is renewed in the background while
+        function runs, every lease_seconds / 3 seconds.
+
+        Parameters
+        ----------
+        function: The function run on each job specification, returning the JSON-serializable result of the job
+        wait_for_others: True if we wish to keep polling until every job is done, so that the jobs of workers that
+            die are reclaimed once their leases expire. If False, return as soon as no job can be claimed
+        poll_seconds: How long to wait between polls when every remaining job is leased by another worker
+
+        Returns
+        -------
+        The number of jobs run by this worker
+        """
+        num_jobs = 0
+        while True:
+            claimed = self.claim()
+            if claimed is None:
+                if not wait_for_others or self.is_finished():
+                    return num_jobs
+                time.sleep(poll_seconds)
+                continue
+            job_id, job = claimed
+
+            # Renew the lease in the background while the job runs
+            stop_renewing = threading.Event()
+
+            def renew_lease():
+                while not stop_renewing.wait(self.lease_seconds / 3):
+                    self.renew(job_id)
+
+            renewer = threading.Thread(target=renew_lease, daemon=True)
+            renewer.start()
+            try:
+                result = function(job)
+            except BaseException:
+                self.release(job_id)
+                raise
+            finally:
+                stop_renewing.set()
+                renewer.join()
+            self.complete(job_id, result)
+            num_jobs += 1